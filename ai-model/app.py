@@ -3,9 +3,48 @@ Flask API for fertilizer recommendation predictions
 """
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import joblib
+import collections
+import functools
+import json
 import numpy as np
 import os
+import threading
+import time
+import traceback
+from batching import BatchTimeout, batcher_from_env
+from encoding import (
+    CODES_VERSION,
+    CONTENT_TYPES,
+    JSON,
+    ScoredBatch,
+    code_catalog,
+    decode_request,
+    encode_compact,
+    json_results,
+    negotiate,
+    parse_fields,
+)
+from explain import Explainer
+from metrics import Registry, SlowRequestProfiler
+from input_log import input_log_from_env
+from lookup_grid import attach_grid
+from model_registry import ModelRegistry, parse_bundle_paths
+from model_store import FEATURE_FIELDS, read_model_set, validate_model_set
+from prediction_cache import PredictionCache, cache_from_env
+from tree_engine import compile_model_set
+from validation import SampleSchema, ValidationError
+# Scalar rule functions are re-exported for callers that import them from app
+from rules import (
+    CROP_TYPES,
+    analyze_deficiencies,
+    analyze_deficiencies_batch,
+    apply_crop_specific_adjustments,
+    apply_crop_specific_adjustments_batch,
+    apply_rules,
+    crop_rule_index,
+    generate_improvement_suggestions,
+    generate_improvement_suggestions_batch,
+)
 
 app = Flask(__name__)
 CORS(app)
@@ -13,13 +52,79 @@ CORS(app)
 # Get the directory where this script is located
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Load models
-fertilizer_model = None
-quantity_model = None
-health_model = None
-label_encoder = None
+# Current ModelSet. It is only ever replaced as a whole, so a request that reads
+# it once sees a consistent set of models even while a reload is swapping it.
+models = None
 
-MODEL_BUNDLE_PATH = os.getenv('MODEL_BUNDLE_PATH', os.path.join(BASE_DIR, 'model.pkl'))
+MODEL_BUNDLE_PATH = os.path.join(BASE_DIR, os.getenv('MODEL_BUNDLE_PATH', 'model.pkl'))
+
+# 'eager' loads at import (share models across forked workers with gunicorn --preload),
+# 'lazy' defers loading to the first request that needs them
+MODEL_LOAD_MODE = os.getenv('MODEL_LOAD_MODE', 'eager')
+# Passed to joblib.load; 'r' memory-maps numpy arrays stored in an uncompressed bundle
+MODEL_MMAP_MODE = os.getenv('MODEL_MMAP_MODE') or None
+# 'flat' runs small batches on the NumPy flat-array tree engine instead of scikit-learn
+INFERENCE_ENGINE = os.getenv('INFERENCE_ENGINE', 'sklearn')
+# Largest batch sent to the flat engine, bigger ones go to scikit-learn's compiled loops
+FLAT_ENGINE_MAX_ROWS = int(os.getenv('FLAT_ENGINE_MAX_ROWS', 512))
+# Directory built by `lookup_grid.py build`; in-range requests are answered from it
+LOOKUP_GRID_PATH = os.getenv('LOOKUP_GRID_PATH')
+# 'linear' interpolation between the surrounding points, leaving rows near a change of
+# fertilizer type to the models, or the 'nearest' grid point (faster, but can change the type)
+LOOKUP_GRID_MODE = os.getenv('LOOKUP_GRID_MODE', 'linear')
+# Seconds between checks of MODEL_BUNDLE_PATH for a new bundle, 0 disables watching
+MODEL_WATCH_INTERVAL = float(os.getenv('MODEL_WATCH_INTERVAL', 0))
+# Token required by POST /admin/reload, the endpoint is disabled when unset
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+# Extra named bundles ("name=path,..."), selected per request by the "model" field or X-Model header
+MODEL_BUNDLES = os.getenv('MODEL_BUNDLES')
+# Memory cap for the named bundles; least recently used ones are dropped beyond it, 0 keeps all
+MODEL_REGISTRY_MAX_MB = float(os.getenv('MODEL_REGISTRY_MAX_MB', 0))
+
+model_load_lock = threading.Lock()
+model_load_stats = {'attempted': False}
+model_reload_lock = threading.Lock()
+model_reload_status = {'state': 'idle'}
+model_watcher_pid = None
+
+# Raw model outputs keyed on quantized inputs, cleared when a different bundle is loaded
+prediction_cache = cache_from_env()
+
+# /explain results under the same quantized keys, sized by EXPLANATION_CACHE_SIZE
+explanation_cache = PredictionCache(int(os.getenv('EXPLANATION_CACHE_SIZE', 2000)),
+                                    prediction_cache.ttl, prediction_cache.precision)
+
+# Append-only log of scored inputs for drift detection and retraining (see
+# retrain.py), enabled by INPUT_LOG_DIR
+input_log = input_log_from_env()
+
+# Prometheus metrics, served as text on /metrics
+metrics_registry = Registry()
+STAGE_SECONDS = metrics_registry.histogram(
+    'prediction_stage_seconds', 'Time spent in each stage of a prediction request', ('stage',))
+REQUEST_SECONDS = metrics_registry.histogram(
+    'prediction_request_seconds', 'End-to-end latency of prediction requests', ('endpoint',))
+PREDICTIONS = metrics_registry.counter(
+    'predictions_total', 'Samples scored, by crop type', ('endpoint', 'crop_type'))
+PREDICTION_ERRORS = metrics_registry.counter(
+    'prediction_errors_total', 'Failed prediction requests, by crop type and reason',
+    ('endpoint', 'crop_type', 'reason'))
+MODEL_LOADS = metrics_registry.counter(
+    'model_loads_total', 'Model bundle load attempts, by result', ('result',))
+time_stage = STAGE_SECONDS.time
+
+# Crop label values are limited to the known crops so arbitrary input can't
+# create unbounded metric series
+METRIC_CROP_LABELS = frozenset(CROP_TYPES)
+
+# Requests slower than PROFILE_SLOW_MS (sampled at PROFILE_SAMPLE_RATE) have
+# their cProfile stats written to PROFILE_DIR; 0 disables profiling
+slow_request_profiler = SlowRequestProfiler(
+    slow_ms=float(os.getenv('PROFILE_SLOW_MS', 0)),
+    sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', 0.01)),
+    directory=os.path.join(BASE_DIR, os.getenv('PROFILE_DIR', 'profiles')),
+    max_dumps=int(os.getenv('PROFILE_MAX_DUMPS', 100)),
+)
 
 @app.route('/')
 def home():
@@ -28,334 +133,665 @@ def home():
         "message": "AI Model API is running"
     })
 
+def prepare_engine(model_set):
+    """Switch a freshly loaded ModelSet to the configured inference engine"""
+    # Compact bundles already hold flat-array models
+    if INFERENCE_ENGINE == 'flat' and model_set.engine == 'sklearn':
+        try:
+            return compile_model_set(model_set, FLAT_ENGINE_MAX_ROWS)
+        except (TypeError, ValueError) as e:
+            MODEL_LOADS.inc('flat_engine_unavailable')
+            print(f"Flat inference engine unavailable, using scikit-learn: {e}")
+    return model_set
+
+# Named bundles besides MODEL_BUNDLE_PATH, each loaded on its first request
+model_registry = ModelRegistry(parse_bundle_paths(MODEL_BUNDLES, BASE_DIR), prepare=prepare_engine,
+                               max_bytes=int(MODEL_REGISTRY_MAX_MB * 2**20), mmap_mode=MODEL_MMAP_MODE,
+                               resident=lambda: (models,))
+
 def load_models():
-    global fertilizer_model, quantity_model, health_model, label_encoder
+    """Load, validate and swap in the model bundle; keeps the current models on failure"""
+    global models
     try:
-        # Change to script directory to ensure relative paths work
-        original_dir = os.getcwd()
-        os.chdir(BASE_DIR)
-        
-        try:
-            if os.path.exists(MODEL_BUNDLE_PATH):
-                print(f"Loading bundled models from {MODEL_BUNDLE_PATH} ...")
-                bundle = joblib.load(MODEL_BUNDLE_PATH)
-                fertilizer_model = bundle['fertilizer_model']
-                quantity_model = bundle['quantity_model']
-                health_model = bundle['health_model']
-                label_encoder = bundle['label_encoder']
-                print("[OK] Model bundle loaded successfully!")
-                return
-
-            # Fallback to legacy individual files
-            print("Bundled model not found. Falling back to individual model files...")
-            fertilizer_model = joblib.load(os.path.join(BASE_DIR, 'fertilizer_type_model.pkl'))
-            quantity_model = joblib.load(os.path.join(BASE_DIR, 'fertilizer_quantity_model.pkl'))
-            health_model = joblib.load(os.path.join(BASE_DIR, 'soil_health_model.pkl'))
-            label_encoder = joblib.load(os.path.join(BASE_DIR, 'label_encoder.pkl'))
-            print("[OK] Individual models loaded successfully!")
-        finally:
-            # Restore original directory
-            os.chdir(original_dir)
+        new_models = read_model_set(MODEL_BUNDLE_PATH, BASE_DIR, MODEL_MMAP_MODE)
+        validate_model_set(new_models)
     except Exception as e:
+        MODEL_LOADS.inc('failed')
         print(f"Error loading models: {e}")
-        import traceback
         traceback.print_exc()
-        fertilizer_model = None
-        quantity_model = None
-        health_model = None
-        label_encoder = None
-
-load_models()
-
-def apply_crop_specific_adjustments(crop_type, fertilizer_type, quantity, nitrogen, phosphorus, potassium):
-    """Apply crop-specific adjustments to recommendations"""
-    
-    # Crop-specific preferences and requirements
-    crop_rules = {
-        'Wheat': {
-            'prefers': 'N',
-            'base_quantity': 60,
-            'needs_high_n': True
-        },
-        'Rice': {
-            'prefers': 'N',
-            'base_quantity': 80,
-            'needs_high_n': True
-        },
-        'Corn': {
-            'prefers': 'N',
-            'base_quantity': 70,
-            'needs_high_n': True
-        },
-        'Soybean': {
-            'prefers': 'P',
-            'base_quantity': 40,
-            'needs_high_p': True,
-            'fixes_n': True  # Fixes nitrogen, needs less
-        },
-        'Cotton': {
-            'prefers': 'K',
-            'base_quantity': 65,
-            'needs_high_k': True
-        },
-        'Tomato': {
-            'prefers': 'Mixed',
-            'base_quantity': 55,
-            'needs_balanced': True
-        },
-        'Potato': {
-            'prefers': 'P',
-            'base_quantity': 75,
-            'needs_high_p': True
-        },
-        'Sugarcane': {
-            'prefers': 'K',
-            'base_quantity': 90,
-            'needs_high_k': True
-        }
-    }
+        return False
     
-    crop_info = crop_rules.get(crop_type, {})
-    
-    # Adjust fertilizer type based on crop needs and preferences
-    # For crops that prefer specific nutrients, adjust even if balanced
-    if crop_info.get('prefers'):
-        prefer = crop_info['prefers']
-        
-        # If soil is balanced but crop prefers specific nutrient, consider that preference
-        if fertilizer_type == 'Organic':
-            # Check if we should recommend crop-specific fertilizer
-            if prefer == 'N' and nitrogen < 50:
-                fertilizer_type = 'N'
-            elif prefer == 'P' and phosphorus < 45:
-                fertilizer_type = 'P'
-            elif prefer == 'K' and potassium < 50:
-                fertilizer_type = 'K'
-            elif prefer == 'Mixed':
-                fertilizer_type = 'Mixed'
-    
-    # Adjust for deficiencies
-    if crop_info.get('needs_high_n') and nitrogen < 40:
-        if fertilizer_type == 'Organic' and nitrogen < 35:
-            fertilizer_type = 'N'
-    elif crop_info.get('needs_high_p') and phosphorus < 30:
-        if fertilizer_type == 'Organic' and phosphorus < 25:
-            fertilizer_type = 'P'
-    elif crop_info.get('needs_high_k') and potassium < 35:
-        if fertilizer_type == 'Organic' and potassium < 30:
-            fertilizer_type = 'K'
-    
-    # Adjust quantity based on crop-specific base quantities
-    if crop_info.get('base_quantity'):
-        base_qty = crop_info['base_quantity']
-        # Scale the quantity relative to crop-specific base
-        quantity_ratio = quantity / 50  # Original base was 50
-        quantity = base_qty * quantity_ratio
-        
-        # Additional adjustments
-        if crop_type in ['Rice', 'Sugarcane']:
-            quantity *= 1.1  # Need more fertilizer
-        elif crop_type == 'Soybean':
-            quantity *= 0.8  # Needs less (fixes N)
-    
-    return fertilizer_type, max(20, min(quantity, 200))  # Keep within reasonable bounds
-
-def analyze_deficiencies(nitrogen, phosphorus, potassium, ph):
-    """Analyze nutrient deficiencies"""
-    deficiencies = []
-    
-    if nitrogen < 30:
-        deficiencies.append({
-            'nutrient': 'Nitrogen',
-            'level': nitrogen,
-            'status': 'Deficient',
-            'severity': 'High' if nitrogen < 20 else 'Moderate',
-            'recommendation': 'Apply nitrogen-rich fertilizer immediately'
-        })
-    elif nitrogen > 70:
-        deficiencies.append({
-            'nutrient': 'Nitrogen',
-            'level': nitrogen,
-            'status': 'Excessive',
-            'severity': 'High' if nitrogen > 80 else 'Moderate',
-            'recommendation': 'Reduce nitrogen application'
-        })
+    new_models = prepare_engine(new_models)
     
-    if phosphorus < 25:
-        deficiencies.append({
-            'nutrient': 'Phosphorus',
-            'level': phosphorus,
-            'status': 'Deficient',
-            'severity': 'High' if phosphorus < 15 else 'Moderate',
-            'recommendation': 'Apply phosphorus-rich fertilizer'
-        })
-    elif phosphorus > 60:
-        deficiencies.append({
-            'nutrient': 'Phosphorus',
-            'level': phosphorus,
-            'status': 'Excessive',
-            'severity': 'High' if phosphorus > 70 else 'Moderate',
-            'recommendation': 'Reduce phosphorus application'
-        })
+    if LOOKUP_GRID_PATH:
+        try:
+            new_models = attach_grid(new_models, os.path.join(BASE_DIR, LOOKUP_GRID_PATH), LOOKUP_GRID_MODE)
+        except (OSError, ValueError) as e:
+            MODEL_LOADS.inc('lookup_grid_unavailable')
+            print(f"Lookup grid unavailable, using the models for every request: {e}")
     
-    if potassium < 30:
-        deficiencies.append({
-            'nutrient': 'Potassium',
-            'level': potassium,
-            'status': 'Deficient',
-            'severity': 'High' if potassium < 20 else 'Moderate',
-            'recommendation': 'Apply potassium-rich fertilizer'
+    previous = models
+    models = new_models
+    if previous is None or previous.fingerprint != new_models.fingerprint:
+        prediction_cache.clear()
+        explanation_cache.clear()
+    MODEL_LOADS.inc('ok')
+    print("[OK] Models loaded successfully!")
+    return True
+
+def resident_set_size():
+    """Current resident set size of this process in bytes (peak RSS where /proc is unavailable)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+def ensure_models_loaded():
+    """Load the models exactly once, timing the load and its memory cost"""
+    ensure_model_watcher()
+    if model_load_stats['attempted']:
+        return
+    with model_load_lock:
+        if model_load_stats['attempted']:
+            return
+        rss_before = resident_set_size()
+        started = time.perf_counter()
+        load_models()
+        model_load_stats.update({
+            'attempted': True,
+            'mode': MODEL_LOAD_MODE,
+            'mmap_mode': MODEL_MMAP_MODE,
+            'load_seconds': round(time.perf_counter() - started, 4),
+            'rss_mb_before': round(rss_before / 2**20, 1),
+            'rss_mb_after': round(resident_set_size() / 2**20, 1),
         })
-    elif potassium > 70:
-        deficiencies.append({
-            'nutrient': 'Potassium',
-            'level': potassium,
-            'status': 'Excessive',
-            'severity': 'High' if potassium > 80 else 'Moderate',
-            'recommendation': 'Reduce potassium application'
+
+def reload_models():
+    """Reload the bundle unless a reload is already running; returns False if one was"""
+    if not model_reload_lock.acquire(blocking=False):
+        return False
+    try:
+        model_reload_status.update({'state': 'reloading', 'started_at': time.time()})
+        started = time.perf_counter()
+        ok = load_models()
+        model_reload_status.update({
+            'state': 'idle',
+            'last_result': 'ok' if ok else 'failed',
+            'last_seconds': round(time.perf_counter() - started, 4),
+            'finished_at': time.time(),
         })
+        return True
+    finally:
+        model_reload_lock.release()
+
+def bundle_signature():
+    try:
+        stat = os.stat(MODEL_BUNDLE_PATH)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def watch_model_bundle():
+    """Poll MODEL_BUNDLE_PATH and reload once a changed file has stopped changing"""
+    seen = bundle_signature()
+    pending = None
+    while True:
+        time.sleep(MODEL_WATCH_INTERVAL)
+        current = bundle_signature()
+        if current is None or current == seen:
+            pending = None
+            continue
+        if current != pending:
+            # Still being written, wait for the next poll
+            pending = current
+            continue
+        seen = current
+        pending = None
+        print(f"Model bundle changed, reloading {MODEL_BUNDLE_PATH} ...")
+        reload_models()
+
+def ensure_model_watcher():
+    """Start the bundle watcher in this process (threads don't survive a fork)"""
+    global model_watcher_pid
+    if MODEL_WATCH_INTERVAL <= 0 or model_watcher_pid == os.getpid():
+        return
+    with model_load_lock:
+        if model_watcher_pid == os.getpid():
+            return
+        model_watcher_pid = os.getpid()
+        threading.Thread(target=watch_model_bundle, name='model-watcher', daemon=True).start()
+
+if MODEL_LOAD_MODE != 'lazy':
+    ensure_models_loaded()
+
+def health_status():
+    """Health report shared by the Flask and ASGI front ends"""
+    ensure_model_watcher()
+    current = models
+    return {
+        'status': 'healthy',
+        'models_loaded': current is not None,
+        'model_version': current.fingerprint[:12] if current else None,
+        'bundle_version': current.bundle_version if current else None,
+        'model_loaded_at': current.loaded_at if current else None,
+        'inference_engine': current.engine if current else None,
+        'lookup_grid': current.lookup_grid.mode if current and current.lookup_grid is not None else None,
+        'model_load': {key: value for key, value in model_load_stats.items() if key != 'attempted'},
+        'model_reload': model_reload_status,
+        'rss_mb': round(resident_set_size() / 2**20, 1),
+        'cache': prediction_cache.stats(),
+        'explanation_cache': explanation_cache.stats(),
+        'model_registry': model_registry.stats() if model_registry.enabled else None,
+        'input_log': {'rows': input_log.rows_logged, 'segments': input_log.segments_written} if input_log.enabled else None
+    }
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Health check endpoint"""
+    return jsonify(health_status())
+
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload():
+    """Load MODEL_BUNDLE_PATH in the background and swap it in once validated"""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin endpoints are disabled (ADMIN_TOKEN not set)'}), 403
+    if request.headers.get('X-Admin-Token') != ADMIN_TOKEN:
+        return jsonify({'error': 'Invalid admin token'}), 401
+    if model_reload_status['state'] == 'reloading':
+        return jsonify({'status': 'already_reloading'}), 409
     
-    ph_status = 'Optimal'
-    ph_recommendation = ''
-    if ph < 6.0:
-        ph_status = 'Acidic'
-        ph_recommendation = 'Apply lime to raise pH'
-    elif ph > 7.5:
-        ph_status = 'Alkaline'
-        ph_recommendation = 'Apply sulfur or organic matter to lower pH'
-    
-    deficiencies.append({
-        'nutrient': 'pH',
-        'level': ph,
-        'status': ph_status,
-        'severity': 'None' if 6.0 <= ph <= 7.5 else 'Moderate',
-        'recommendation': ph_recommendation if ph_recommendation else 'pH is in optimal range'
-    })
+    if request.args.get('wait') in ('1', 'true'):
+        if not reload_models():
+            return jsonify({'status': 'already_reloading'}), 409
+        status = 200 if model_reload_status.get('last_result') == 'ok' else 500
+        return jsonify({'status': model_reload_status.get('last_result'), 'model_version': models.fingerprint[:12] if models else None}), status
     
-    return deficiencies
-
-def generate_improvement_suggestions(nitrogen, phosphorus, potassium, ph, moisture, temperature, crop_type, fertilizer_type, health_score):
-    """Generate improvement suggestions"""
-    suggestions = []
-    
-    if health_score < 60:
-        suggestions.append("⚠️ Soil health is below optimal. Consider regular soil testing and balanced fertilization.")
-    
-    if fertilizer_type == 'Organic':
-        suggestions.append("✓ Use organic fertilizers like compost, manure, or bio-fertilizers for sustainable farming.")
-    elif fertilizer_type == 'Mixed':
-        suggestions.append("📊 Mixed fertilizer recommended. Use NPK blend based on specific crop requirements.")
-    
-    if moisture < 40:
-        suggestions.append("💧 Soil moisture is low. Implement proper irrigation practices.")
-    elif moisture > 60:
-        suggestions.append("🌧️ Soil moisture is high. Improve drainage to prevent waterlogging.")
-    
-    if temperature < 20:
-        suggestions.append("🌡️ Low temperature detected. Consider using mulch or protective covers.")
-    elif temperature > 30:
-        suggestions.append("🌡️ High temperature detected. Ensure adequate irrigation and shade management.")
-    
-    crop_suggestions = {
-        'Wheat': 'Apply nitrogen in split doses during tillering and flowering stages.',
-        'Rice': 'Maintain water level and apply balanced NPK during transplanting.',
-        'Corn': 'Apply nitrogen during V6 and tasseling stages for better yield.',
-        'Soybean': 'Inoculate seeds with Rhizobium for nitrogen fixation.',
-        'Cotton': 'Apply potassium during boll development stage.',
-        'Tomato': 'Maintain consistent moisture and apply calcium to prevent blossom end rot.',
-        'Potato': 'Apply phosphorus during tuber initiation for better development.',
-        'Sugarcane': 'Apply higher potassium during grand growth period.'
-    }
+    threading.Thread(target=reload_models, name='model-reload', daemon=True).start()
+    return jsonify({'status': 'reloading'}), 202
+
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', 50000))
+
+# Validates and converts request samples in one pass over a precompiled field table
+sample_schema = SampleSchema()
+
+def parse_sample(data):
+    """Extract numeric features and crop type from a single request payload; raises ValidationError"""
+    return sample_schema.parse(data)
+
+def predict_samples(model_set, values, crop_types):
+    """Run the models once over a batch of samples and apply the rules; returns a ScoredBatch"""
+    numeric, fertilizer_types, quantities, health_scores = model_outputs(model_set, values, crop_types)
+    
+    if input_log.enabled:
+        with time_stage('input_log'):
+            input_log.record(numeric, crop_types, fertilizer_types, quantities, health_scores)
+    
+    return build_results(values, crop_types, numeric, fertilizer_types, quantities, health_scores)
+
+def model_outputs(model_set, values, crop_types):
+    """Raw model outputs for a batch of samples, through the prediction cache;
+    returns (numeric, fertilizer_types, quantities, health_scores)"""
+    numeric = np.asarray(values, dtype=float).reshape(-1, len(FEATURE_FIELDS))
+    fertilizer_types = np.empty(len(numeric), dtype=object)
+    quantities = np.empty(len(numeric))
+    health_scores = np.empty(len(numeric))
     
-    if crop_type in crop_suggestions:
-        suggestions.append(f"🌾 {crop_suggestions[crop_type]}")
+    # Serve repeated readings from the cache, only the misses go to the models.
+    # Keys include the bundle fingerprint so in-flight requests on the previous
+    # models can't repopulate the cache with stale results after a swap.
+    keys = None
+    missing = np.arange(len(numeric))
+    if prediction_cache.enabled:
+        with time_stage('cache_lookup'):
+            keys = [
+                (model_set.fingerprint,) + prediction_cache.make_key(crop_type, row)
+                for crop_type, row in zip(crop_types, values)
+            ]
+            misses = []
+            for i, key in enumerate(keys):
+                cached = prediction_cache.get(key)
+                if cached is None:
+                    misses.append(i)
+                else:
+                    fertilizer_types[i], quantities[i], health_scores[i] = cached
+            missing = np.asarray(misses, dtype=int)
     
-    if len(suggestions) == 0:
-        suggestions.append("✓ Soil conditions are good. Maintain current practices and monitor regularly.")
+    if len(missing):
+        with time_stage('crop_encoding'):
+            features = np.column_stack([
+                numeric[missing],
+                model_set.encode_crop_types([crop_types[i] for i in missing])
+            ])
+        outputs = model_set.predict(features, stage=time_stage)
+        fertilizer_types[missing], quantities[missing], health_scores[missing] = outputs
+        if keys is not None:
+            with time_stage('cache_store'):
+                for i, fertilizer_type, quantity, health_score in zip(missing.tolist(), *outputs):
+                    prediction_cache.put(keys[i], (fertilizer_type, float(quantity), float(health_score)))
     
-    return suggestions
+    return numeric, fertilizer_types, quantities, health_scores
 
-@app.route('/health', methods=['GET'])
-def health():
-    """Health check endpoint"""
-    return jsonify({
-        'status': 'healthy',
-        'models_loaded': fertilizer_model is not None
-    })
+def build_results(values, crop_types, numeric, fertilizer_types, quantities, health_scores):
+    """Apply the vectorized rule layer to raw model outputs; returns a ScoredBatch"""
+    outputs = apply_rules(numeric, crop_types, fertilizer_types, quantities, health_scores, stage=time_stage)
+    
+    # Outputs are rounded to 2 decimals with Python's round, in every encoding
+    quantities = [round(quantity, 2) for quantity in outputs.quantities.tolist()]
+    health_scores = [round(score, 2) for score in np.asarray(health_scores, dtype=float).tolist()]
+    return ScoredBatch(values, crop_types, outputs.fertilizer_types, quantities, health_scores,
+                       outputs.status, outputs.severity, outputs.suggestion_flags)
+
+def crop_label(crop_type):
+    """Metric label for a crop: its name if known, 'other' for anything else"""
+    return crop_type if isinstance(crop_type, str) and crop_type in METRIC_CROP_LABELS else 'other'
+
+def model_failure(endpoint, crop_counts):
+    """Count an unexpected error of the model run and log its traceback; returns the 500 error body"""
+    traceback.print_exc()
+    for crop, count in crop_counts.items():
+        PREDICTION_ERRORS.inc(endpoint, crop, 'prediction_failed', amount=count)
+    return {'error': 'Internal error while running the models', 'code': 'prediction_failed'}, 500
+
+def instrumented(endpoint):
+    """Record the request latency of a view and sample it for slow-request profiling"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            with REQUEST_SECONDS.time(endpoint), slow_request_profiler.maybe_profile(endpoint):
+                return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def current_models(name=None):
+    """The ModelSet to use for a whole request: the named bundle, else the default one.
+
+    Without MODEL_BUNDLES the name is ignored and the default bundle answers,
+    as it did before bundles could be selected. Returns None if the models
+    could not be loaded; raises KeyError for unknown names.
+    """
+    if name is None or not model_registry.enabled:
+        ensure_models_loaded()
+        return models
+    if not isinstance(name, str):
+        raise KeyError(name)
+    return model_registry.get(name)
+
+def select_models(endpoint, name):
+    """(ModelSet, None) for a request, or (None, (error body, status)) if it can't be served"""
+    try:
+        model_set = current_models(name)
+    except KeyError:
+        PREDICTION_ERRORS.inc(endpoint, 'other', 'unknown_model')
+        return None, ({'error': f'Unknown model {name!r}, expected one of {sorted(model_registry.paths)}',
+                       'code': 'unknown_model'}, 404)
+    if model_set is None:
+        PREDICTION_ERRORS.inc(endpoint, 'other', 'models_not_loaded')
+        return None, ({'error': 'Models not loaded'}, 500)
+    return model_set, None
+
+def request_model_name(data, header):
+    """Bundle requested by a payload's "model" field, else by the X-Model header (None: default)"""
+    if isinstance(data, dict) and 'model' in data:
+        return data['model']
+    return header or None
+
+def read_batch_payload():
+    """Read a batch request body as a JSON array, {"samples": [...]}, NDJSON or MessagePack.
+
+    Returns (samples, requested model name).
+    """
+    mimetype = request.mimetype or ''
+    header = request.headers.get('X-Model')
+    if mimetype in ('application/x-ndjson', 'application/jsonl', 'application/x-jsonlines'):
+        text = request.get_data(as_text=True)
+        return [json.loads(line) for line in text.splitlines() if line.strip()], header or None
+    
+    data = decode_request(request.get_data(), mimetype)
+    if data is None:
+        data = request.get_json(force=True)
+    name = request_model_name(data, header)
+    if isinstance(data, dict):
+        data = data.get('samples')
+    if not isinstance(data, list):
+        raise ValueError('Expected a JSON array of samples or an object with a "samples" array')
+    return data, name
+
+def score_microbatch(model_set, samples):
+    """Score (values, crop_type) samples collected by the micro-batcher in one pass"""
+    batch = predict_samples(model_set, [values for values, _ in samples], [crop for _, crop in samples])
+    return [batch.row(i) for i in range(batch.count)]
+
+MICROBATCH_SIZE = metrics_registry.histogram(
+    'microbatch_size', 'Single-sample requests scored together per micro-batch', (),
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512))
+
+def record_microbatch(size, waits):
+    MICROBATCH_SIZE.observe(size)
+    for wait in waits:
+        STAGE_SECONDS.observe(wait, 'microbatch_wait')
+
+# Coalesces concurrent /predict calls into one batched inference when
+# MICROBATCH_MAX_WAIT_MS is set, None otherwise
+micro_batcher = batcher_from_env(score_microbatch, record_microbatch)
+
+def predict_one(model_set, values, crop_type):
+    """Score a single sample, through the micro-batcher when it is enabled; returns a one-row ScoredBatch"""
+    if micro_batcher is not None:
+        return micro_batcher.submit(model_set, (values, crop_type))
+    return predict_samples(model_set, [values], [crop_type])
+
+def predict_payload(data, model_header=None):
+    """Score one /predict payload; returns (ScoredBatch or error body, status) for any front end to encode"""
+    # Validate before touching the models, so bad input never reaches them
+    with time_stage('feature_extraction'):
+        try:
+            values, crop_type = parse_sample(data)
+        except ValidationError as e:
+            crop_type = data.get('crop_type') if isinstance(data, dict) else None
+            PREDICTION_ERRORS.inc('predict', crop_label(crop_type), e.code)
+            return e.to_dict(), 400
+    
+    model_set, error = select_models('predict', request_model_name(data, model_header))
+    if error:
+        return error
+    
+    try:
+        response = predict_one(model_set, values, crop_type)
+    except BatchTimeout:
+        PREDICTION_ERRORS.inc('predict', crop_label(crop_type), 'deadline_exceeded')
+        return {'error': 'Prediction deadline exceeded', 'code': 'deadline_exceeded'}, 503
+    except Exception:
+        return model_failure('predict', {crop_label(crop_type): 1})
+    PREDICTIONS.inc('predict', crop_label(crop_type))
+    return response, 200
+
+def predict_batch_payload(samples, model_name=None):
+    """Score a parsed /predict/batch payload; returns (ScoredBatch or error body, status)"""
+    if len(samples) > MAX_BATCH_SIZE:
+        PREDICTION_ERRORS.inc('predict_batch', 'other', 'batch_too_large')
+        return {'error': f'Batch too large: {len(samples)} samples (max {MAX_BATCH_SIZE})'}, 413
+    
+    with time_stage('feature_extraction'):
+        try:
+            values, crop_types = sample_schema.parse_batch(samples)
+        except ValidationError as e:
+            sample = samples[e.index]
+            crop_type = sample.get('crop_type') if isinstance(sample, dict) else None
+            PREDICTION_ERRORS.inc('predict_batch', crop_label(crop_type), e.code)
+            return e.to_dict(), 400
+    
+    model_set, error = select_models('predict_batch', model_name)
+    if error:
+        return error
+    
+    if not samples:
+        return ScoredBatch.empty(), 200
+    
+    crop_counts = collections.Counter(map(crop_label, crop_types))
+    try:
+        batch = predict_samples(model_set, values, crop_types)
+    except Exception:
+        return model_failure('predict_batch', crop_counts)
+    
+    for crop, count in crop_counts.items():
+        PREDICTIONS.inc('predict_batch', crop, amount=count)
+    return batch, 200
+
+MAX_EXPLAIN_BATCH_SIZE = int(os.getenv('MAX_EXPLAIN_BATCH_SIZE', 1000))
+
+# Explainers by model fingerprint, for the default and the named bundles
+explainers = {}
+explainer_lock = threading.Lock()
+
+def current_explainer(model_set):
+    """Explainer for a ModelSet, built on first use and dropped once its bundle is unloaded"""
+    with explainer_lock:
+        explainer = explainers.get(model_set.fingerprint)
+        if explainer is None:
+            live = model_registry.fingerprints() | {models.fingerprint if models else None}
+            for fingerprint in [key for key in explainers if key not in live]:
+                del explainers[fingerprint]
+            explainer = explainers[model_set.fingerprint] = Explainer(model_set)
+        return explainer
+
+def explain_samples(model_set, values, crop_types):
+    """Per-feature explanations of a batch of validated samples, one result dict per sample"""
+    explanations = [None] * len(values)
+    keys = None
+    missing = list(range(len(values)))
+    if explanation_cache.enabled:
+        with time_stage('cache_lookup'):
+            keys = [
+                (model_set.fingerprint,) + explanation_cache.make_key(crop_type, row)
+                for crop_type, row in zip(crop_types, values)
+            ]
+            missing = []
+            for i, key in enumerate(keys):
+                explanations[i] = explanation_cache.get(key)
+                if explanations[i] is None:
+                    missing.append(i)
+    
+    if missing:
+        with time_stage('crop_encoding'):
+            features = np.column_stack([
+                np.asarray([values[i] for i in missing], dtype=float).reshape(-1, len(FEATURE_FIELDS)),
+                model_set.encode_crop_types([crop_types[i] for i in missing])
+            ])
+        with time_stage('explanation'):
+            computed = current_explainer(model_set).explain(features)
+        for i, explanation in zip(missing, computed):
+            explanations[i] = explanation
+            if keys is not None:
+                explanation_cache.put(keys[i], explanation)
+    
+    # The outputs /predict serves for these readings, prediction cache and lookup grid included
+    numeric, model_types, model_quantities, _ = model_outputs(model_set, values, crop_types)
+    with time_stage('rule_layer'):
+        served_types, served_quantities = apply_crop_specific_adjustments_batch(
+            crop_rule_index(crop_types), model_types, model_quantities,
+            numeric[:, 0], numeric[:, 1], numeric[:, 2]
+        )
+    
+    names = [name for name, _ in FEATURE_FIELDS]
+    results = []
+    for row, crop_type, explanation, fertilizer_type, served_type, served_quantity in zip(
+        values, crop_types, explanations, model_types.tolist(), served_types.tolist(), served_quantities.tolist()
+    ):
+        # Cached explanations are shared, so the served values go on copies
+        explanation = dict(explanation)
+        explanation['fertilizer_type'] = {
+            **explanation['fertilizer_type'],
+            'served_value': served_type,
+            'adjusted_by_rules': served_type != fertilizer_type,
+        }
+        explanation['quantity_kg_per_acre'] = {
+            **explanation['quantity_kg_per_acre'],
+            'served_value': round(served_quantity, 2),
+        }
+        results.append({'input_data': {**dict(zip(names, row)), 'crop_type': crop_type}, 'explanation': explanation})
+    return results
+
+def explain_payload(data, model_header=None):
+    """Explain one /explain payload; returns (result or error body, status)"""
+    with time_stage('feature_extraction'):
+        try:
+            values, crop_type = parse_sample(data)
+        except ValidationError as e:
+            crop_type = data.get('crop_type') if isinstance(data, dict) else None
+            PREDICTION_ERRORS.inc('explain', crop_label(crop_type), e.code)
+            return e.to_dict(), 400
+    
+    model_set, error = select_models('explain', request_model_name(data, model_header))
+    if error:
+        return error
+    
+    try:
+        result = explain_samples(model_set, [values], [crop_type])[0]
+    except Exception:
+        return model_failure('explain', {crop_label(crop_type): 1})
+    PREDICTIONS.inc('explain', crop_label(crop_type))
+    return result, 200
+
+def explain_batch_payload(samples, model_name=None):
+    """Explain a parsed /explain/batch payload; returns ({"count", "results"} or error body, status)"""
+    if len(samples) > MAX_EXPLAIN_BATCH_SIZE:
+        PREDICTION_ERRORS.inc('explain_batch', 'other', 'batch_too_large')
+        return {'error': f'Batch too large: {len(samples)} samples (max {MAX_EXPLAIN_BATCH_SIZE})'}, 413
+    
+    with time_stage('feature_extraction'):
+        try:
+            values, crop_types = sample_schema.parse_batch(samples)
+        except ValidationError as e:
+            sample = samples[e.index]
+            crop_type = sample.get('crop_type') if isinstance(sample, dict) else None
+            PREDICTION_ERRORS.inc('explain_batch', crop_label(crop_type), e.code)
+            return e.to_dict(), 400
+    
+    model_set, error = select_models('explain_batch', model_name)
+    if error:
+        return error
+    
+    crop_counts = collections.Counter(map(crop_label, crop_types))
+    try:
+        results = explain_samples(model_set, values, crop_types) if samples else []
+    except Exception:
+        return model_failure('explain_batch', crop_counts)
+    
+    for crop, count in crop_counts.items():
+        PREDICTIONS.inc('explain_batch', crop, amount=count)
+    return {'count': len(results), 'results': results}, 200
+
+def render_result(result, fmt, fields, single):
+    """Response body for a scoring result: bytes for compact encodings, a JSON-ready object otherwise"""
+    if not isinstance(result, ScoredBatch):
+        # Errors are always JSON
+        return result
+    if fmt != JSON:
+        with time_stage('serialization'):
+            return encode_compact(result, fmt, fields, single)
+    with time_stage('response_build'):
+        results = json_results(result, fields)
+    return results[0] if single else {'count': result.count, 'results': results}
+
+def respond(result, status, fmt, fields, single):
+    body = render_result(result, fmt, fields, single)
+    if isinstance(body, bytes):
+        return app.response_class(body, status=status, content_type=CONTENT_TYPES[fmt],
+                                  headers={'X-Codes-Version': CODES_VERSION})
+    with time_stage('serialization'):
+        return jsonify(body), status
+
+def response_options():
+    """Negotiated encoding and fields= selection of the current request"""
+    return negotiate(request.headers.get('Accept')), parse_fields(request.args.get('fields'))
 
 @app.route('/predict', methods=['POST'])
+@instrumented('predict')
 def predict():
     """Main prediction endpoint"""
     try:
-        if fertilizer_model is None or quantity_model is None or health_model is None:
-            return jsonify({'error': 'Models not loaded'}), 500
-        
-        data = request.json
-        
-        # Extract features
-        nitrogen = float(data.get('nitrogen', 0))
-        phosphorus = float(data.get('phosphorus', 0))
-        potassium = float(data.get('potassium', 0))
-        ph = float(data.get('ph', 7.0))
-        moisture = float(data.get('moisture', 50))
-        temperature = float(data.get('temperature', 25))
-        crop_type = data.get('crop_type', 'Wheat')
-        
-        # Encode crop type
-        if crop_type in label_encoder.classes_:
-            crop_encoded = label_encoder.transform([crop_type])[0]
-        else:
-            crop_encoded = 0  # Default to first crop
-        
-        # Prepare feature array
-        features = np.array([[nitrogen, phosphorus, potassium, ph, moisture, temperature, crop_encoded]])
-        
-        # Predict
-        fertilizer_type = fertilizer_model.predict(features)[0]
-        quantity = float(quantity_model.predict(features)[0])
-        health_score = float(health_model.predict(features)[0])
-        
-        # Apply crop-specific adjustments to make recommendations more crop-aware
-        fertilizer_type, quantity = apply_crop_specific_adjustments(
-            crop_type, fertilizer_type, quantity, nitrogen, phosphorus, potassium
-        )
-        
-        # Analyze deficiencies
-        deficiencies = analyze_deficiencies(nitrogen, phosphorus, potassium, ph)
-        
-        # Generate suggestions
-        suggestions = generate_improvement_suggestions(
-            nitrogen, phosphorus, potassium, ph, moisture, temperature, 
-            crop_type, fertilizer_type, health_score
-        )
-        
-        # Prepare response
-        response = {
-            'fertilizer_type': fertilizer_type,
-            'quantity_kg_per_acre': round(quantity, 2),
-            'soil_health_score': round(health_score, 2),
-            'deficiency_analysis': deficiencies,
-            'improvement_suggestions': suggestions,
-            'input_data': {
-                'nitrogen': nitrogen,
-                'phosphorus': phosphorus,
-                'potassium': potassium,
-                'ph': ph,
-                'moisture': moisture,
-                'temperature': temperature,
-                'crop_type': crop_type
-            }
-        }
-        
-        return jsonify(response), 200
-        
+        fmt, fields = response_options()
+        with time_stage('json_parse'):
+            data = decode_request(request.get_data(), request.mimetype)
+            if data is None:
+                data = request.json
     except Exception as e:
+        PREDICTION_ERRORS.inc('predict', 'other', 'invalid_payload')
+        return jsonify({'error': str(e), 'code': 'invalid_payload'}), 400
+    
+    result, status = predict_payload(data, request.headers.get('X-Model'))
+    return respond(result, status, fmt, fields, single=True)
+
+@app.route('/predict/batch', methods=['POST'])
+@instrumented('predict_batch')
+def predict_batch():
+    """Batch prediction endpoint, scores all samples with one call per model"""
+    try:
+        fmt, fields = response_options()
+    except ValueError as e:
+        PREDICTION_ERRORS.inc('predict_batch', 'other', 'invalid_payload')
         return jsonify({'error': str(e)}), 400
+    try:
+        with time_stage('json_parse'):
+            samples, model_name = read_batch_payload()
+    except Exception as e:
+        PREDICTION_ERRORS.inc('predict_batch', 'other', 'invalid_payload')
+        return jsonify({'error': f'Invalid batch payload: {e}', 'code': 'invalid_payload'}), 400
+    
+    result, status = predict_batch_payload(samples, model_name)
+    return respond(result, status, fmt, fields, single=False)
 
-if __name__ == '__main__':
-    # Load models before starting the server
-    load_models()
+@app.route('/explain', methods=['POST'])
+@instrumented('explain')
+def explain():
+    """Per-feature contributions to each model output for one sample"""
+    try:
+        with time_stage('json_parse'):
+            data = decode_request(request.get_data(), request.mimetype)
+            if data is None:
+                data = request.json
+    except Exception as e:
+        PREDICTION_ERRORS.inc('explain', 'other', 'invalid_payload')
+        return jsonify({'error': str(e), 'code': 'invalid_payload'}), 400
+    
+    result, status = explain_payload(data, request.headers.get('X-Model'))
+    return jsonify(result), status
+
+@app.route('/explain/batch', methods=['POST'])
+@instrumented('explain_batch')
+def explain_batch():
+    """Explanations for a batch of samples, computed in one pass per model"""
+    try:
+        with time_stage('json_parse'):
+            samples, model_name = read_batch_payload()
+    except Exception as e:
+        PREDICTION_ERRORS.inc('explain_batch', 'other', 'invalid_payload')
+        return jsonify({'error': f'Invalid batch payload: {e}', 'code': 'invalid_payload'}), 400
     
+    result, status = explain_batch_payload(samples, model_name)
+    return jsonify(result), status
+
+@app.route('/codes', methods=['GET'])
+def codes():
+    """Code tables for the compact (msgpack/binary) encodings"""
+    return jsonify({'version': CODES_VERSION, **code_catalog()})
+
+def model_metrics():
+    current = models
+    if current is None:
+        return []
+    return [((current.fingerprint[:12], current.engine, current.layout), 1)]
+
+def cache_metrics(field):
+    return lambda: [((), prediction_cache.stats()[field])]
+
+metrics_registry.callback('model_info', 'Loaded model bundle (value is always 1)',
+                          ('version', 'engine', 'layout'), model_metrics)
+metrics_registry.callback('model_loaded_timestamp_seconds', 'When the current bundle was loaded', (),
+                          lambda: [((), models.loaded_at if models else None)])
+for field in ('hits', 'misses', 'evictions', 'expirations', 'invalidations'):
+    metrics_registry.callback(f'prediction_cache_{field}_total', f'Prediction cache {field}', (),
+                              cache_metrics(field), metric_type='counter')
+metrics_registry.callback('prediction_cache_entries', 'Entries in the prediction cache', (),
+                          cache_metrics('size'))
+metrics_registry.callback('input_log_rows_total', 'Scored rows written to the input log', (),
+                          lambda: [((), input_log.rows_logged)], metric_type='counter')
+metrics_registry.callback('slow_request_profiles_total', 'cProfile dumps written for slow requests', (),
+                          lambda: [((), slow_request_profiler.dumped)], metric_type='counter')
+metrics_registry.callback('process_resident_memory_bytes', 'Resident set size of this process', (),
+                          lambda: [((), resident_set_size())])
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus text-format metrics for this worker process"""
+    return app.response_class(metrics_registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+if __name__ == '__main__':
+    # Models are loaded once at import, or on the first request with MODEL_LOAD_MODE=lazy
     port = int(os.environ.get('PORT', 5000))
     print(f"Starting Flask API server on port {port}...")
     # debug=False in production for security
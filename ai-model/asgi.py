@@ -0,0 +1,326 @@
+"""
+ASGI entry point for the AI model service
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+    python asgi.py
+
+Serves the same contract as app.py (/, /health, /metrics, /codes, /predict,
+/predict/batch, /explain, /explain/batch, /admin/reload, with the same
+response encodings) without a web framework. The event loop only reads request
+bodies and writes responses; parsing, inference and serialization run on a
+bounded thread pool. When every worker is busy and the queue is full, requests
+are rejected at once with 429, and requests that miss their deadline get 503,
+so clients fail fast instead of waiting out their own timeouts.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import app as service
+from encoding import CODES_VERSION, CONTENT_TYPES, code_catalog, decode_request, negotiate, parse_fields
+
+# Inference threads; scikit-learn's tree traversal releases the GIL
+ASGI_WORKERS = int(os.getenv('ASGI_WORKERS', os.cpu_count() or 1))
+# Requests allowed to wait for a worker before new ones get 429
+ASGI_MAX_QUEUE = int(os.getenv('ASGI_MAX_QUEUE', 16 * ASGI_WORKERS))
+# Time from arrival to response (queueing included) before a request gets 503
+REQUEST_DEADLINE_MS = float(os.getenv('REQUEST_DEADLINE_MS', 5000))
+# Largest request body accepted, bigger ones get 413 without being buffered
+ASGI_MAX_BODY_BYTES = int(os.getenv('ASGI_MAX_BODY_BYTES', 64 * 2**20))
+
+# Preflight answer when the browser doesn't list the headers it wants to send
+CORS_ALLOW_HEADERS = b'Content-Type, Accept, X-Model'
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/jsonl', 'application/x-jsonlines')
+
+REJECTED = service.metrics_registry.counter(
+    'requests_rejected_total', 'Requests refused by the ASGI front end, by reason', ('endpoint', 'reason'))
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class InferencePool:
+    """Thread pool with a bounded number of admitted jobs (running plus queued)"""
+
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self.capacity = workers + max_queue
+        self.admitted = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='inference')
+        self._lock = threading.Lock()
+
+    def try_submit(self, fn, *args):
+        """Start fn(*args) on the pool, or return None if the pool is full"""
+        with self._lock:
+            if self.admitted >= self.capacity:
+                return None
+            self.admitted += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self._lock:
+            self.admitted -= 1
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+pool = InferencePool(ASGI_WORKERS, ASGI_MAX_QUEUE)
+
+service.metrics_registry.callback(
+    'inference_pool_admitted', 'Requests running or queued on the inference pool', (),
+    lambda: [((), pool.admitted)])
+service.metrics_registry.callback(
+    'inference_pool_capacity', 'Maximum requests running or queued on the inference pool', (),
+    lambda: [((), pool.capacity)])
+
+
+def encode_json(body):
+    return json.dumps(body, separators=(',', ':')).encode()
+
+
+def decode_sample(body, content_type, model_header):
+    """(sample, model name) of a /predict or /explain body; raises ValueError if it can't be read"""
+    data = decode_request(body, content_type)
+    if data is None:
+        data = json.loads(body)
+    return data, model_header
+
+
+def decode_batch(body, content_type, model_header):
+    """(samples, model name) of a batch body: JSON array, {"samples": [...]}, NDJSON or MessagePack"""
+    model_name = model_header
+    try:
+        if content_type in NDJSON_TYPES:
+            samples = [json.loads(line) for line in body.decode().splitlines() if line.strip()]
+        else:
+            samples = decode_request(body, content_type)
+            if samples is None:
+                samples = json.loads(body)
+            model_name = service.request_model_name(samples, model_header)
+            if isinstance(samples, dict):
+                samples = samples.get('samples')
+            if not isinstance(samples, list):
+                raise ValueError('Expected a JSON array of samples or an object with a "samples" array')
+    except Exception as e:
+        raise ValueError(f'Invalid batch payload: {e}') from e
+    return samples, model_name
+
+
+def run_prediction(endpoint, decode, score, body, content_type, model_header, fmt, fields, deadline):
+    """Worker-thread side of a prediction: decode, score and encode, or give up if too late.
+
+    Returns (body, status, content type, extra headers).
+    """
+    if time.monotonic() > deadline:
+        raise DeadlineExceeded()
+    with service.slow_request_profiler.maybe_profile(endpoint):
+        try:
+            # Only the body decoding counts as json_parse; scoring times its own stages
+            with service.time_stage('json_parse'):
+                data, model_name = decode(body, content_type, model_header)
+        except ValueError as e:
+            # Malformed JSON or MessagePack
+            service.PREDICTION_ERRORS.inc(endpoint, 'other', 'invalid_payload')
+            result, status = {'error': str(e), 'code': 'invalid_payload'}, 400
+        else:
+            result, status = score(data, model_name)
+        payload = service.render_result(result, fmt, fields, single=endpoint == 'predict')
+        if isinstance(payload, bytes):
+            return payload, status, CONTENT_TYPES[fmt].encode(), [(b'x-codes-version', CODES_VERSION.encode())]
+        with service.time_stage('serialization'):
+            return encode_json(payload), status, b'application/json', []
+
+
+PREDICT_ROUTES = {
+    '/predict': ('predict', decode_sample, service.predict_payload),
+    '/predict/batch': ('predict_batch', decode_batch, service.predict_batch_payload),
+    '/explain': ('explain', decode_sample, service.explain_payload),
+    '/explain/batch': ('explain_batch', decode_batch, service.explain_batch_payload),
+}
+
+
+async def read_body(receive, limit):
+    """Read the whole request body, or return None once it exceeds limit bytes.
+
+    Raises ClientDisconnected if the client goes away first.
+    """
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+async def send_response(send, status, body, content_type=b'application/json', headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type),
+            (b'content-length', str(len(body)).encode()),
+            (b'access-control-allow-origin', b'*'),
+            *headers,
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def handle_predict(scope, receive, send, endpoint, decode, score):
+    started = time.monotonic()
+    deadline = started + REQUEST_DEADLINE_MS / 1000
+    try:
+        try:
+            body = await read_body(receive, ASGI_MAX_BODY_BYTES)
+        except ClientDisconnected:
+            # Nobody is left to answer, and the body size is unknown
+            return
+        if body is None:
+            REJECTED.inc(endpoint, 'body_too_large')
+            await send_response(send, 413, encode_json({'error': 'Request body too large'}))
+            return
+
+        headers = dict(scope['headers'])
+        content_type = headers.get(b'content-type', b'').decode().split(';')[0].strip()
+        fmt = negotiate(headers.get(b'accept', b'').decode())
+        try:
+            query = parse_qs(scope.get('query_string', b'').decode())
+            fields = parse_fields(query.get('fields', [None])[-1])
+        except ValueError as e:
+            service.PREDICTION_ERRORS.inc(endpoint, 'other', 'invalid_payload')
+            await send_response(send, 400, encode_json({'error': str(e)}))
+            return
+
+        model_header = headers.get(b'x-model', b'').decode() or None
+        future = pool.try_submit(run_prediction, endpoint, decode, score, body, content_type, model_header,
+                                 fmt, fields, deadline)
+        if future is None:
+            REJECTED.inc(endpoint, 'queue_full')
+            await send_response(send, 429, encode_json({'error': 'Server busy, retry shortly'}),
+                                headers=[(b'retry-after', b'1')])
+            return
+
+        try:
+            payload, status, response_type, extra_headers = await asyncio.wait_for(
+                asyncio.wrap_future(future), timeout=max(deadline - time.monotonic(), 0))
+        except (asyncio.TimeoutError, DeadlineExceeded):
+            # A job that already started runs to completion, one still queued is skipped
+            future.cancel()
+            REJECTED.inc(endpoint, 'deadline_exceeded')
+            await send_response(send, 503, encode_json({'error': 'Prediction deadline exceeded'}),
+                                headers=[(b'retry-after', b'1')])
+            return
+        await send_response(send, status, payload, content_type=response_type, headers=extra_headers)
+    finally:
+        service.REQUEST_SECONDS.observe(time.monotonic() - started, endpoint)
+
+
+async def run_off_loop(fn):
+    return await asyncio.get_running_loop().run_in_executor(None, fn)
+
+
+async def handle_admin_reload(scope, send):
+    """POST /admin/reload, as in app.py: reload MODEL_BUNDLE_PATH in the background or, with ?wait=1, inline"""
+    if not service.ADMIN_TOKEN:
+        await send_response(send, 403, encode_json({'error': 'Admin endpoints are disabled (ADMIN_TOKEN not set)'}))
+        return
+    if dict(scope['headers']).get(b'x-admin-token', b'').decode() != service.ADMIN_TOKEN:
+        await send_response(send, 401, encode_json({'error': 'Invalid admin token'}))
+        return
+    if service.model_reload_status['state'] == 'reloading':
+        await send_response(send, 409, encode_json({'status': 'already_reloading'}))
+        return
+
+    query = parse_qs(scope.get('query_string', b'').decode())
+    if query.get('wait', [None])[-1] in ('1', 'true'):
+        if not await run_off_loop(service.reload_models):
+            await send_response(send, 409, encode_json({'status': 'already_reloading'}))
+            return
+        result = service.model_reload_status.get('last_result')
+        version = service.models.fingerprint[:12] if service.models else None
+        await send_response(send, 200 if result == 'ok' else 500,
+                            encode_json({'status': result, 'model_version': version}))
+        return
+
+    threading.Thread(target=service.reload_models, name='model-reload', daemon=True).start()
+    await send_response(send, 202, encode_json({'status': 'reloading'}))
+
+
+async def http(scope, receive, send):
+    path = scope['path'].rstrip('/') or '/'
+    method = scope['method']
+
+    if method == 'OPTIONS':
+        # Allow whatever headers the preflight asks for (Accept, X-Model, ...), as Flask-CORS does
+        requested = dict(scope['headers']).get(b'access-control-request-headers') or CORS_ALLOW_HEADERS
+        await send_response(send, 204, b'', headers=[
+            (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+            (b'access-control-allow-headers', requested),
+        ])
+    elif path in PREDICT_ROUTES and method == 'POST':
+        await handle_predict(scope, receive, send, *PREDICT_ROUTES[path])
+    elif path == '/health' and method == 'GET':
+        await send_response(send, 200, encode_json(await run_off_loop(service.health_status)))
+    elif path == '/metrics' and method == 'GET':
+        await send_response(send, 200, service.metrics_registry.render().encode(),
+                            content_type=b'text/plain; version=0.0.4; charset=utf-8')
+    elif path == '/codes' and method == 'GET':
+        await send_response(send, 200, encode_json({'version': CODES_VERSION, **code_catalog()}))
+    elif path == '/' and method == 'GET':
+        await send_response(send, 200, encode_json({'status': 'online', 'message': 'AI Model API is running'}))
+    elif path == '/admin/reload' and method == 'POST':
+        await handle_admin_reload(scope, send)
+    elif path in PREDICT_ROUTES or path in ('/', '/health', '/metrics', '/codes', '/admin/reload'):
+        await send_response(send, 405, encode_json({'error': 'Method not allowed'}))
+    else:
+        await send_response(send, 404, encode_json({'error': 'Not found'}))
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Loads the models here when MODEL_LOAD_MODE=lazy deferred it at import
+            await run_off_loop(service.ensure_models_loaded)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            pool.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http':
+        await http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit('uvicorn is required to serve asgi.py directly: pip install uvicorn')
+    port = int(os.environ.get('PORT', 5000))
+    print(f"Starting ASGI server on port {port} with {ASGI_WORKERS} inference threads...")
+    uvicorn.run(application, host='0.0.0.0', port=port)
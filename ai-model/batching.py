@@ -0,0 +1,128 @@
+"""
+Server-side micro-batching of concurrent single-sample predictions.
+
+Request threads hand their sample to ``MicroBatcher.submit`` and block. A
+dispatcher thread takes the first waiting sample, collects more for up to
+``max_wait_ms`` or until ``max_batch_size`` are waiting, scores them with one
+call to ``run_batch`` and hands each caller its own result. Samples are
+grouped by key (the ModelSet they were read with), so a batch never mixes
+models across a hot reload.
+
+A caller waits at most ``timeout`` seconds for its result and then gets
+BatchTimeout; a sample still queued by then is dropped unscored.
+"""
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+
+class BatchTimeout(Exception):
+    pass
+
+
+class MicroBatcher:
+    def __init__(self, run_batch, max_batch_size=64, max_wait_ms=2.0, workers=1, on_batch=None, timeout=None):
+        """``run_batch(key, items)`` returns one result per item; ``on_batch(size, waits)``
+        is called after every batch with the seconds each request spent queued"""
+        self.run_batch = run_batch
+        self.timeout = timeout
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.workers = workers
+        self.on_batch = on_batch
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._dispatcher_pid = None
+
+    def submit(self, key, item):
+        """Score one item as part of the next batch and return its result (or raise its error)"""
+        self._ensure_dispatchers()
+        future = Future()
+        self._queue.put((key, item, future, time.perf_counter()))
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # Fails only if a dispatcher already took the sample; its result is then discarded
+            future.cancel()
+            raise BatchTimeout(f'No result within {self.timeout:g}s') from None
+
+    def _ensure_dispatchers(self):
+        # Threads don't survive a fork, so each worker process starts its own
+        if self._dispatcher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._dispatcher_pid == os.getpid():
+                return
+            self._dispatcher_pid = os.getpid()
+            for i in range(self.workers):
+                threading.Thread(target=self._dispatch_forever, name=f'microbatch-{i}', daemon=True).start()
+
+    def _collect(self):
+        """Block for one entry, then gather more until the window closes or the batch is full"""
+        pending = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(pending) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return pending
+
+    def _dispatch_forever(self):
+        while True:
+            pending = []
+            try:
+                # Samples whose caller timed out were cancelled and are skipped
+                pending = [entry for entry in self._collect() if entry[2].set_running_or_notify_cancel()]
+                groups = {}
+                for entry in pending:
+                    groups.setdefault(id(entry[0]), []).append(entry)
+                for entries in groups.values():
+                    self._run(entries)
+            except Exception as e:
+                # A dead dispatcher would leave every later caller waiting, so fail this round and go on
+                traceback.print_exc()
+                for _, _, future, _ in pending:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _run(self, entries):
+        started = time.perf_counter()
+        try:
+            results = self.run_batch(entries[0][0], [item for _, item, _, _ in entries])
+        except Exception as e:
+            if len(entries) == 1:
+                entries[0][2].set_exception(e)
+                return
+            # Score the requests one by one so a bad sample only fails its own request
+            for entry in entries:
+                self._run([entry])
+            return
+
+        for (_, _, future, _), result in zip(entries, results):
+            future.set_result(result)
+        if self.on_batch is not None:
+            self.on_batch(len(entries), [started - queued_at for _, _, _, queued_at in entries])
+
+
+def batcher_from_env(run_batch, on_batch=None):
+    """MicroBatcher configured by MICROBATCH_MAX_WAIT_MS / _MAX_SIZE / _WORKERS and REQUEST_DEADLINE_MS,
+    or None when disabled"""
+    max_wait_ms = float(os.getenv('MICROBATCH_MAX_WAIT_MS', 0))
+    if max_wait_ms <= 0:
+        return None
+    return MicroBatcher(
+        run_batch,
+        max_batch_size=int(os.getenv('MICROBATCH_MAX_SIZE', 64)),
+        max_wait_ms=max_wait_ms,
+        workers=int(os.getenv('MICROBATCH_WORKERS', 1)),
+        on_batch=on_batch,
+        # The same budget asgi.py gives a whole request
+        timeout=float(os.getenv('REQUEST_DEADLINE_MS', 5000)) / 1000,
+    )
@@ -0,0 +1,265 @@
+"""
+Benchmark harness for the AI model service
+
+Drives app.py through Flask's test client with synthetic rows from
+generate_dataset.py and writes a machine-readable JSON report:
+
+    python benchmarks/bench_service.py --bundle model.pkl --output benchmarks/results.json
+    python benchmarks/bench_service.py --baseline benchmarks/baseline.json   # fail on regressions
+    python benchmarks/bench_service.py --save-baseline benchmarks/baseline.json
+
+Measured: model load time, single-request latency percentiles, batch
+throughput at several batch sizes, time per prediction stage (feature build,
+each model call, rule layer, JSON serialization) and peak RSS.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+AI_MODEL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, AI_MODEL_DIR)
+
+import numpy as np
+
+DEFAULT_BATCH_SIZES = (1, 10, 100, 1000, 10000)
+
+
+def synthetic_samples(n_samples, seed=0):
+    """Request payloads drawn from the same distribution as the training data"""
+    from generate_dataset import sample_features
+    df = sample_features(np.random.RandomState(seed), n_samples)
+    return df.to_dict(orient='records')
+
+
+def percentiles(values_ms):
+    values = np.asarray(values_ms)
+    return {
+        'p50_ms': float(np.percentile(values, 50)),
+        'p95_ms': float(np.percentile(values, 95)),
+        'p99_ms': float(np.percentile(values, 99)),
+        'mean_ms': float(values.mean()),
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (peak if sys.platform == 'darwin' else peak * 1024) / 2**20
+
+
+def bench_model_load(app, rounds):
+    from model_store import read_model_set, validate_model_set
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        validate_model_set(read_model_set(app.MODEL_BUNDLE_PATH, app.BASE_DIR, app.MODEL_MMAP_MODE))
+        timings.append((time.perf_counter() - started) * 1000)
+    return {'first_load_s': app.model_load_stats.get('load_seconds'), **percentiles(timings)}
+
+
+def bench_single(client, samples, requests, warmup=20):
+    for sample in samples[:warmup]:
+        client.post('/predict', json=sample)
+    timings = []
+    for i in range(requests):
+        sample = samples[i % len(samples)]
+        started = time.perf_counter()
+        response = client.post('/predict', json=sample)
+        timings.append((time.perf_counter() - started) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError(f'/predict failed: {response.get_json()}')
+    return {'requests': requests, **percentiles(timings)}
+
+
+def bench_batches(client, samples, batch_sizes, min_seconds):
+    results = {}
+    for size in batch_sizes:
+        payload = json.dumps(samples[:size])
+        client.post('/predict/batch', data=payload, content_type='application/json')
+        rounds = 0
+        started = time.perf_counter()
+        while True:
+            response = client.post('/predict/batch', data=payload, content_type='application/json')
+            if response.status_code != 200:
+                raise RuntimeError(f'/predict/batch failed: {response.get_json()}')
+            rounds += 1
+            elapsed = time.perf_counter() - started
+            if elapsed >= min_seconds:
+                break
+        results[str(size)] = {
+            'rounds': rounds,
+            'request_ms': elapsed / rounds * 1000,
+            'rows_per_s': size * rounds / elapsed,
+        }
+    return results
+
+
+def bench_stages(app, samples, batch_size, rounds):
+    """Time each stage of predict_samples separately on the same batch"""
+    model_set = app.current_models()
+    batch = samples[:batch_size]
+    stages = {}
+
+    def timed(name, fn):
+        fn()
+        started = time.perf_counter()
+        for _ in range(rounds):
+            result = fn()
+        stages[name] = (time.perf_counter() - started) / rounds * 1000
+        return result
+
+    def build_features():
+        parsed = [app.parse_sample(sample) for sample in batch]
+        values = [row for row, _ in parsed]
+        crop_types = [crop for _, crop in parsed]
+        numeric = np.asarray(values, dtype=float)
+        features = np.column_stack([numeric, model_set.encode_crop_types(crop_types)])
+        return values, crop_types, numeric, features
+
+    values, crop_types, numeric, features = timed('feature_build_ms', build_features)
+
+    predictors = model_set.active_models(len(features))
+    if model_set.fused_model is not None:
+        outputs = timed('fused_model_ms', lambda: predictors[0].predict_all(features))
+    else:
+        fertilizer_model, quantity_model, health_model = predictors
+        outputs = (
+            timed('fertilizer_model_ms', lambda: fertilizer_model.predict(features)),
+            timed('quantity_model_ms', lambda: quantity_model.predict(features)),
+            timed('health_model_ms', lambda: health_model.predict(features)),
+        )
+
+    scored = timed('rule_layer_ms', lambda: app.build_results(values, crop_types, numeric, *outputs))
+    results = timed('response_build_ms', lambda: app.json_results(scored))
+    with app.app.app_context():
+        timed('json_serialization_ms', lambda: app.jsonify({'count': len(results), 'results': results}).get_data())
+    for fmt in ('msgpack', 'binary'):
+        if app.negotiate(app.CONTENT_TYPES[fmt]) == fmt:
+            timed(f'{fmt}_serialization_ms', lambda: app.encode_compact(scored, fmt))
+    return stages
+
+
+def run(args):
+    if args.bundle:
+        os.environ['MODEL_BUNDLE_PATH'] = os.path.abspath(args.bundle)
+    if not args.cache:
+        # Measure the models, not the cache
+        os.environ['PREDICTION_CACHE_SIZE'] = '0'
+
+    import_started = time.perf_counter()
+    import app
+    import_seconds = time.perf_counter() - import_started
+    if app.current_models() is None:
+        raise SystemExit(f'No models could be loaded from {app.MODEL_BUNDLE_PATH}')
+
+    client = app.app.test_client()
+    samples = synthetic_samples(max(max(args.batch_sizes), args.requests), seed=args.seed)
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'bundle': app.MODEL_BUNDLE_PATH,
+            'model_version': app.models.fingerprint[:12],
+            'inference_engine': app.models.engine,
+            'layout': app.models.layout,
+        },
+        'metrics': {
+            'import_s': import_seconds,
+            'model_load': bench_model_load(app, args.load_rounds),
+            'single_request': bench_single(client, samples, args.requests),
+            'batch': bench_batches(client, samples, args.batch_sizes, args.min_seconds),
+            'stages_single': bench_stages(app, samples, 1, args.stage_rounds),
+            'stages_batch': bench_stages(app, samples, args.stage_batch_size, max(1, args.stage_rounds // 10)),
+            'peak_rss_mb': peak_rss_mb(),
+        },
+    }
+    return results
+
+
+def flatten(metrics, prefix=''):
+    flat = {}
+    for key, value in metrics.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = float(value)
+    return flat
+
+
+def higher_is_better(name):
+    return name.endswith('per_s')
+
+
+def compare(results, baseline, tolerance):
+    """Print metric changes against a baseline; returns the names of regressed metrics"""
+    current = flatten(results['metrics'])
+    previous = flatten(baseline['metrics'])
+    regressions = []
+    print(f"\n{'metric':<45}{'baseline':>14}{'current':>14}{'change':>10}")
+    for name in sorted(set(current) & set(previous)):
+        if name.endswith(('rounds', 'requests')) or previous[name] == 0:
+            continue
+        change = (current[name] - previous[name]) / previous[name]
+        worse = -change if higher_is_better(name) else change
+        flag = '  REGRESSION' if worse > tolerance else ''
+        if flag:
+            regressions.append(name)
+        print(f"{name:<45}{previous[name]:>14.4f}{current[name]:>14.4f}{change:>+10.1%}{flag}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the AI model service')
+    parser.add_argument('--bundle', help='model bundle to benchmark (default: MODEL_BUNDLE_PATH / model.pkl)')
+    parser.add_argument('--output', default=os.path.join(AI_MODEL_DIR, 'benchmarks', 'results.json'))
+    parser.add_argument('--baseline', help='baseline JSON to compare against; exits 1 on regressions')
+    parser.add_argument('--save-baseline', help='also write the results to this baseline path')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed relative slowdown before a metric counts as regressed')
+    parser.add_argument('--requests', type=int, default=500, help='single /predict requests to time')
+    parser.add_argument('--batch-sizes', type=lambda s: [int(v) for v in s.split(',')],
+                        default=list(DEFAULT_BATCH_SIZES), help='comma-separated batch sizes')
+    parser.add_argument('--min-seconds', type=float, default=1.0, help='minimum time per batch size')
+    parser.add_argument('--load-rounds', type=int, default=3, help='timed model loads')
+    parser.add_argument('--stage-rounds', type=int, default=200, help='timed rounds per stage')
+    parser.add_argument('--stage-batch-size', type=int, default=1000, help='batch size for stage timing')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic rows')
+    parser.add_argument('--cache', action='store_true', help='keep the prediction cache enabled')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to: {path}")
+
+    metrics = results['metrics']
+    single = metrics['single_request']
+    print(f"single /predict: p50 {single['p50_ms']:.2f} ms, p95 {single['p95_ms']:.2f} ms, "
+          f"p99 {single['p99_ms']:.2f} ms")
+    for size, batch in metrics['batch'].items():
+        print(f"batch {size:>6}: {batch['rows_per_s']:>10.0f} rows/s ({batch['request_ms']:.1f} ms/request)")
+    print(f"peak RSS: {metrics['peak_rss_mb']:.1f} MB")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
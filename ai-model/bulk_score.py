@@ -0,0 +1,239 @@
+"""
+Offline bulk scoring of CSV/Parquet soil readings with the /predict logic
+
+    python bulk_score.py surveys.csv scored/
+    python bulk_score.py surveys.parquet scored/ --workers 8 --chunk-size 200000 --format parquet
+    python bulk_score.py surveys.csv scored/ --resume     # continue after an interruption
+
+The input needs the /predict request fields as columns (nitrogen, phosphorus,
+potassium, ph, moisture, temperature, crop_type); missing ones get the same
+defaults as the API. Chunks are scored in a process pool where each worker
+loads the model bundle once. Every chunk is written to its own part file in
+the output directory (part-00000.csv, ...), renamed into place only when
+complete, so --resume skips finished chunks and redoes the rest.
+
+Each output row has the input readings, the adjusted fertilizer type, the
+quantity and soil health score rounded like /predict, and a status and
+severity column per nutrient (nitrogen, phosphorus, potassium, ph). Status is
+the API label, or 'Normal' when the API reports nothing for that nutrient;
+severity is 0 (none), 1 (moderate) or 2 (high).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+
+from dataset_io import infer_format
+from model_store import DEFAULT_CROP_TYPE, FEATURE_FIELDS, read_model_set, validate_model_set
+from rules import DEFICIENCY_NUTRIENTS, SEVERITY_NONE, STATUS_LABELS, STATUS_NONE, apply_rules
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Resolved against BASE_DIR like app.py, so a run scores with the bundle the service serves
+DEFAULT_BUNDLE_PATH = os.path.join(BASE_DIR, os.getenv('MODEL_BUNDLE_PATH', 'model.pkl'))
+MANIFEST_FILE = 'manifest.json'
+OUTPUT_FORMATS = ('csv', 'parquet')
+
+FIELD_NAMES = [name for name, _ in FEATURE_FIELDS]
+
+# The API leaves nutrients without a finding out of deficiency_analysis; here they
+# read 'Normal' (pandas would load a literal 'None' back as NaN). Severity is
+# written as its code: 0 none, 1 moderate, 2 high.
+BULK_STATUS_LABELS = np.asarray(('Normal',) + STATUS_LABELS[STATUS_NONE + 1:], dtype=object)
+
+# Set in each worker process by init_worker
+worker_models = None
+
+
+def init_worker(bundle_path, mmap_mode):
+    """Process pool initializer: load and validate the models once per worker"""
+    global worker_models
+    worker_models = read_model_set(bundle_path, BASE_DIR, mmap_mode)
+    validate_model_set(worker_models)
+
+
+def read_chunks(path, fmt, chunk_size):
+    """Yield DataFrames of up to chunk_size rows with the request columns that are present"""
+    wanted = set(FIELD_NAMES) | {'crop_type'}
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        columns = [name for name in parquet_file.schema_arrow.names if name in wanted]
+        for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols=lambda column: column in wanted, chunksize=chunk_size,
+                               float_precision='round_trip')
+
+
+def count_rows(path, fmt):
+    """Row count for progress reporting, None when it would need a full scan"""
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    return None
+
+
+def chunk_inputs(df):
+    """Numeric readings and crop types of a chunk, with the API defaults for missing values"""
+    numeric = np.empty((len(df), len(FEATURE_FIELDS)))
+    for column, (name, default) in enumerate(FEATURE_FIELDS):
+        numeric[:, column] = df[name].fillna(default).to_numpy(dtype=float) if name in df else default
+    if 'crop_type' in df:
+        crop_types = df['crop_type'].astype(object).where(df['crop_type'].notna(), DEFAULT_CROP_TYPE)
+        crop_types = crop_types.astype(str).to_numpy(dtype=object)
+    else:
+        crop_types = np.full(len(df), DEFAULT_CROP_TYPE, dtype=object)
+    return numeric, crop_types
+
+
+def score_chunk(numeric, crop_types):
+    """Score a chunk with the worker's models; returns the output DataFrame"""
+    features = np.column_stack([numeric, worker_models.encode_crop_types(crop_types)])
+    fertilizer_types, quantities, health_scores = worker_models.predict(features)
+    outputs = apply_rules(numeric, crop_types, fertilizer_types, quantities, health_scores)
+
+    df = pd.DataFrame(numeric, columns=FIELD_NAMES)
+    df['crop_type'] = crop_types
+    df['fertilizer_type'] = outputs.fertilizer_types
+    # Python round, like the API responses
+    df['quantity_kg_per_acre'] = [round(value, 2) for value in np.asarray(outputs.quantities, dtype=float).tolist()]
+    df['soil_health_score'] = [round(value, 2) for value in np.asarray(health_scores, dtype=float).tolist()]
+    # Severity only means something for nutrients the API reports
+    severity = np.where(outputs.status == STATUS_NONE, SEVERITY_NONE, outputs.severity).astype(np.int8)
+    for column, nutrient in enumerate(DEFICIENCY_NUTRIENTS):
+        df[f'{nutrient.lower()}_status'] = BULK_STATUS_LABELS[outputs.status[:, column]]
+        df[f'{nutrient.lower()}_severity'] = severity[:, column]
+    return df
+
+
+def part_path(output_dir, index, fmt):
+    return os.path.join(output_dir, f'part-{index:05d}.{fmt}')
+
+
+def write_part(index, numeric, crop_types, output_dir, fmt):
+    """Worker task: score one chunk and publish its part file atomically; returns the row count"""
+    df = score_chunk(numeric, crop_types)
+    path = part_path(output_dir, index, fmt)
+    tmp_path = f'{path}.tmp-{os.getpid()}'
+    if fmt == 'parquet':
+        df.to_parquet(tmp_path, index=False)
+    else:
+        df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return len(df)
+
+
+def check_manifest(output_dir, manifest, resume):
+    """Refuse to mix parts from runs with a different input, chunking or bundle"""
+    path = os.path.join(output_dir, MANIFEST_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            previous = json.load(f)
+        if not resume:
+            raise SystemExit(f'{output_dir} already holds a scoring run; pass --resume to continue it')
+        changed = [key for key in ('input', 'chunk_size', 'format', 'model_version') if previous.get(key) != manifest[key]]
+        if changed:
+            raise SystemExit(f'Cannot resume: {", ".join(changed)} differs from the run in {output_dir}')
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def print_progress(done_rows, total_rows, done_chunks, started):
+    elapsed = time.perf_counter() - started
+    rate = done_rows / elapsed if elapsed else 0.0
+    if total_rows:
+        eta = (total_rows - done_rows) / rate if rate else float('inf')
+        print(f"  {done_rows:,}/{total_rows:,} rows ({done_rows / total_rows:.1%}), "
+              f"{done_chunks} chunks, {rate:,.0f} rows/s, ETA {eta:.0f}s", flush=True)
+    else:
+        print(f"  {done_rows:,} rows, {done_chunks} chunks, {rate:,.0f} rows/s", flush=True)
+
+
+def run(args):
+    fmt = args.input_format or infer_format(args.input)
+    if fmt not in ('csv', 'parquet'):
+        raise SystemExit(f'Unsupported input format {fmt!r}, expected csv or parquet')
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Loaded once here to fingerprint the bundle and fail fast on a bad one
+    model_set = read_model_set(args.bundle, BASE_DIR, args.mmap_mode)
+    validate_model_set(model_set)
+    check_manifest(args.output_dir, {
+        'input': os.path.abspath(args.input),
+        'chunk_size': args.chunk_size,
+        'format': args.format,
+        'model_version': model_set.fingerprint[:12],
+    }, args.resume)
+    del model_set
+    # Parts from workers killed mid-write are never renamed into place
+    for name in os.listdir(args.output_dir):
+        if '.tmp-' in name:
+            os.remove(os.path.join(args.output_dir, name))
+
+    total_rows = count_rows(args.input, fmt)
+    workers = args.workers or os.cpu_count() or 1
+    print(f"Scoring {args.input} with {workers} workers, {args.chunk_size:,} rows per chunk")
+
+    started = time.perf_counter()
+    progress = {'rows': 0, 'chunks': 0, 'skipped': 0}
+    pending = set()
+
+    def collect(block):
+        nonlocal pending
+        finished, pending = wait(pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in finished:
+            progress['rows'] += future.result()
+            progress['chunks'] += 1
+        if finished:
+            print_progress(progress['rows'], total_rows, progress['chunks'] + progress['skipped'], started)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(args.bundle, args.mmap_mode)) as pool:
+        for index, df in enumerate(read_chunks(args.input, fmt, args.chunk_size)):
+            if os.path.exists(part_path(args.output_dir, index, args.format)):
+                progress['skipped'] += 1
+                progress['rows'] += len(df)
+                continue
+            # Keep at most two chunks per worker in flight to bound memory
+            while len(pending) >= 2 * workers:
+                collect(block=True)
+            numeric, crop_types = chunk_inputs(df)
+            pending.add(pool.submit(write_part, index, numeric, crop_types, args.output_dir, args.format))
+            collect(block=False)
+
+        while pending:
+            collect(block=True)
+
+    elapsed = time.perf_counter() - started
+    print(f"[OK] Scored {progress['chunks']} chunks ({progress['skipped']} already done) in {elapsed:.1f}s "
+          f"into {args.output_dir}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Score a CSV/Parquet file of soil readings offline')
+    parser.add_argument('input', help='CSV or Parquet file with the /predict request fields as columns')
+    parser.add_argument('output_dir', help='directory for the part files')
+    parser.add_argument('--bundle', default=DEFAULT_BUNDLE_PATH,
+                        help='model bundle (default: MODEL_BUNDLE_PATH or model.pkl)')
+    parser.add_argument('--workers', type=int, help='worker processes (default: CPU count)')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='rows per chunk and part file')
+    parser.add_argument('--input-format', choices=('csv', 'parquet'), help='override the format inferred from the extension')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, default='csv', help='part file format')
+    parser.add_argument('--mmap-mode', default=os.getenv('MODEL_MMAP_MODE') or None,
+                        help="joblib mmap_mode for the bundle (e.g. 'r')")
+    parser.add_argument('--resume', action='store_true', help='continue a previous run, skipping finished chunks')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    run(parse_args(argv))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
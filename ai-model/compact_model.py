@@ -0,0 +1,316 @@
+"""
+Shrink a model bundle into a pruned, reduced-precision compact bundle
+
+    python compact_model.py model.pkl model_compact.pkl
+    python compact_model.py model.pkl model_compact.pkl --max-accuracy-drop 0.002 --max-error-increase 0.02
+
+Each forest is pruned in three ways:
+
+- sibling leaves whose values differ by at most --merge-tolerance are merged
+  into their parent (the default 0 only merges identical leaves, which never
+  changes a prediction)
+- subtrees below a depth cap collapse into their root node's value
+- only the first k trees are kept
+
+The pruning has to stay within an accuracy budget relative to the original
+bundle:
+
+- fertilizer type accuracy may drop by at most --max-accuracy-drop
+- the quantity and health score MAE may grow by at most --max-error-increase
+  (a fraction)
+
+The budget is measured on held-out rows labelled by the generate_dataset.py
+rules, or on --data. For every depth cap the smallest k that stays in budget
+is read off cumulative per-tree predictions. The cap and k with the fewest
+nodes win. A forest that no candidate keeps in budget (e.g. a
+--merge-tolerance that already costs more than the budget allows) is kept
+unpruned, and still stored in the compact format.
+
+The result is a 'compact' bundle (see model_store.py):
+
+- flat node arrays with int8 features, float32 thresholds and values, and
+  int16 class probabilities
+- loaded by load_models() like any other bundle, running on the flat-array
+  engine
+
+The tool prints file size, load time, model memory, latency and accuracy
+next to the original. Selection and the final report use separate halves of
+the validation rows.
+"""
+import argparse
+import os
+import sys
+import time
+
+import joblib
+import numpy as np
+
+import train_model
+from dataset_io import CROP_CLASSES, encode_classes
+from generate_dataset import label_chunk, sample_features
+from model_store import read_model_set, validate_model_set
+from tree_engine import MODEL_FIELDS, flat_forest_from_trees, tree_arrays, tree_estimators
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def node_depths(left, right):
+    """Depth of every node of a tree given its child arrays (-1 for leaves)"""
+    depth = np.zeros(len(left), dtype=np.intp)
+    frontier = np.array([0])
+    level = 0
+    while len(frontier):
+        depth[frontier] = level
+        internal = frontier[left[frontier] != -1]
+        frontier = np.concatenate([left[internal], right[internal]])
+        level += 1
+    return depth
+
+
+def prune_tree(tree, max_depth=None, merge_tolerance=0.0):
+    """Cap the depth of a tree (see ``tree_arrays``) and merge near-identical sibling leaves"""
+    left, right, value = tree['left'], tree['right'], tree['value']
+    depth = node_depths(left, right)
+    leaf = left == -1
+    if max_depth is not None:
+        leaf = leaf | (depth >= max_depth)
+    # Bottom-up, so merged parents can merge again one level higher
+    for level in range(int(depth.max()) - 1, -1, -1):
+        nodes = np.flatnonzero(~leaf & (depth == level))
+        l, r = left[nodes], right[nodes]
+        mergeable = leaf[l] & leaf[r] & (np.abs(value[l] - value[r]).max(axis=1) <= merge_tolerance)
+        leaf[nodes[mergeable]] = True
+
+    # Keep the nodes still reachable from the root, in their original order
+    keep = np.zeros(len(left), dtype=bool)
+    frontier = np.array([0])
+    while len(frontier):
+        keep[frontier] = True
+        internal = frontier[~leaf[frontier]]
+        frontier = np.concatenate([left[internal], right[internal]])
+    new_index = np.cumsum(keep) - 1
+    kept_leaf = leaf[keep]
+    return {
+        'feature': tree['feature'][keep],
+        'threshold': tree['threshold'][keep],
+        'left': np.where(kept_leaf, -1, new_index[left[keep]]),
+        'right': np.where(kept_leaf, -1, new_index[right[keep]]),
+        'missing_left': tree['missing_left'][keep],
+        'value': value[keep],
+        'depth': int(depth[keep].max()),
+    }
+
+
+def cumulative_predictions(trees, X, n_features, classes):
+    """Mean output of the first k trees for every k, shape (n_trees, n_samples, n_outputs)"""
+    flat = flat_forest_from_trees(trees, n_features, classes)
+    per_tree = flat.value[flat.apply(X).T]
+    return np.cumsum(per_tree, axis=0) / np.arange(1, len(trees) + 1)[:, None, None]
+
+
+def model_budget(field, model, y, budget):
+    """(metric, within) for one model: per-k scores of cumulative predictions and the in-budget mask"""
+    if field == 'fertilizer_model':
+        classes = np.asarray(model.classes_, dtype=str)
+        accuracy = lambda cum: (classes[np.argmax(cum, axis=2)] == y['type']).mean(axis=1)
+        return accuracy, lambda cum, base: accuracy(cum) >= base - budget['accuracy_drop']
+    target = y['quantity'] if field == 'quantity_model' else y['health']
+    mae = lambda cum: np.abs(cum[:, :, 0] - target).mean(axis=1)
+    return mae, lambda cum, base: mae(cum) <= base * (1 + budget['error_increase'])
+
+
+def fused_budget(bundle, y, budget):
+    """(metric, within) for a fused forest, whose budget covers all three targets"""
+    classes = np.asarray(bundle['fertilizer_classes'], dtype=str)
+    mean, scale = bundle['target_mean'], bundle['target_scale']
+
+    def metrics(cum):
+        raw = cum * scale + mean
+        accuracy = (classes[np.argmax(raw[:, :, :len(classes)], axis=2)] == y['type']).mean(axis=1)
+        quantity_mae = np.abs(raw[:, :, len(classes)] - y['quantity']).mean(axis=1)
+        health_mae = np.abs(raw[:, :, len(classes) + 1] - y['health']).mean(axis=1)
+        return np.stack([accuracy, quantity_mae, health_mae])
+
+    def within(cum, base):
+        accuracy, quantity_mae, health_mae = metrics(cum)
+        limit = 1 + budget['error_increase']
+        return ((accuracy >= base[0] - budget['accuracy_drop'])
+                & (quantity_mae <= base[1] * limit) & (health_mae <= base[2] * limit))
+
+    return metrics, within
+
+
+def search_pruning(model, X, metric, within, merge_tolerance):
+    """Prune one forest: the (depth cap, tree count) with the fewest nodes that stays in budget"""
+    classes = getattr(model, 'classes_', None)
+    trees = [tree_arrays(estimator, classes) for estimator in tree_estimators(model)]
+    original_depth = max(tree['depth'] for tree in trees)
+    baseline = metric(cumulative_predictions(trees, X, model.n_features_in_, classes))[..., -1]
+
+    best = None
+    for max_depth in [None] + list(range(original_depth - 1, 1, -1)):
+        pruned = [prune_tree(tree, max_depth, merge_tolerance) for tree in trees]
+        ok = within(cumulative_predictions(pruned, X, model.n_features_in_, classes), baseline)
+        # Smallest k from which every larger forest stays in budget too
+        stable = np.flip(np.logical_and.accumulate(np.flip(ok)))
+        if not stable.any():
+            # Shallower caps only lose more accuracy
+            break
+        k = int(np.argmax(stable)) + 1
+        nodes = sum(len(tree['left']) for tree in pruned[:k])
+        if best is None or nodes < best['nodes']:
+            best = {'max_depth': max_depth, 'n_trees': k, 'nodes': nodes, 'trees': pruned[:k]}
+
+    if best is None:
+        # Even the leaf merges alone break the budget; keep the forest as it is
+        print(f"Warning: no pruning of this {len(trees)}-tree forest stays within the budget, keeping it unpruned")
+        best = {'max_depth': None, 'n_trees': len(trees), 'nodes': sum(len(tree['left']) for tree in trees),
+                'trees': trees}
+
+    flat = flat_forest_from_trees(best['trees'], model.n_features_in_, classes)
+    summary = {
+        'trees': [len(trees), best['n_trees']],
+        'nodes': [sum(len(tree['left']) for tree in trees), best['nodes']],
+        'depth': [original_depth, flat.depth],
+    }
+    return flat, summary
+
+
+def validation_set(args):
+    """Labelled (X, targets) rows the original bundle was not trained on"""
+    if args.data:
+        X, y_type, y_quantity, y_health = train_model.load_training_data(args.data)
+        X = np.asarray(X)
+    else:
+        df = label_chunk(sample_features(np.random.RandomState(args.seed), args.samples))
+        X = np.column_stack([df[['nitrogen', 'phosphorus', 'potassium', 'ph', 'moisture', 'temperature']].to_numpy(),
+                             encode_classes(df['crop_type'], CROP_CLASSES)])
+        y_type = df['fertilizer_type'].to_numpy(dtype=object)
+        y_quantity = df['quantity_kg_per_acre'].to_numpy(dtype=float)
+        y_health = df['soil_health_score'].to_numpy(dtype=float)
+    return X, np.asarray(y_type, dtype=str), np.asarray(y_quantity, dtype=float), np.asarray(y_health, dtype=float)
+
+
+def compact_bundle(bundle, X, y, args):
+    """Prune every forest of a separate or fused bundle into a compact bundle dict"""
+    budget = {'accuracy_drop': args.max_accuracy_drop, 'error_increase': args.max_error_increase}
+    layout = bundle.get('layout', 'separate')
+    if layout not in ('separate', 'fused'):
+        raise SystemExit(f"Cannot compact a '{layout}' bundle")
+
+    compact = {'layout': 'compact', 'model_layout': layout, 'label_encoder': bundle['label_encoder'], 'models': {}}
+    compaction = {}
+    if layout == 'fused':
+        metric, within = fused_budget(bundle, y, budget)
+        flat, compaction['fused_model'] = search_pruning(bundle['fused_model'], X, metric, within, args.merge_tolerance)
+        compact['models']['fused_model'] = flat.to_compact_arrays()
+        for key in ('fertilizer_classes', 'target_mean', 'target_scale'):
+            compact[key] = bundle[key]
+    else:
+        for field in MODEL_FIELDS:
+            metric, within = model_budget(field, bundle[field], y, budget)
+            flat, compaction[field] = search_pruning(bundle[field], X, metric, within, args.merge_tolerance)
+            compact['models'][field] = flat.to_compact_arrays()
+
+    compact['metadata'] = dict(bundle.get('metadata', {}), compaction={
+        'models': compaction,
+        'budget': budget,
+        'merge_tolerance': args.merge_tolerance,
+        'validation_rows': int(len(X)),
+    })
+    return compact
+
+
+def sklearn_model_bytes(model_set):
+    """Node and value array bytes of the scikit-learn trees in a ModelSet"""
+    models = [model_set.fused_model.forest] if model_set.fused_model is not None else [
+        model_set.fertilizer_model, model_set.quantity_model, model_set.health_model]
+    total = 0
+    for model in models:
+        for estimator in tree_estimators(model):
+            state = estimator.tree_.__getstate__()
+            total += state['nodes'].nbytes + state['values'].nbytes
+    return total
+
+
+def flat_model_bytes(model_set):
+    if model_set.fused_model is not None:
+        return model_set.fused_model.forest.nbytes
+    return sum(model.nbytes for model in (model_set.fertilizer_model, model_set.quantity_model, model_set.health_model))
+
+
+def load_seconds(path, rounds=3):
+    """Best-of-rounds time to load and validate a bundle, as load_models() does"""
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        validate_model_set(read_model_set(path, BASE_DIR))
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def print_report(args, original, compact, compaction, X, y):
+    print(f"\n{'model':<18}{'trees':>14}{'nodes':>20}{'depth':>10}")
+    for field, summary in compaction.items():
+        trees, nodes, depth = summary['trees'], summary['nodes'], summary['depth']
+        print(f"{field:<18}{f'{trees[0]} -> {trees[1]}':>14}{f'{nodes[0]:,} -> {nodes[1]:,}':>20}"
+              f"{f'{depth[0]} -> {depth[1]}':>10}")
+
+    sizes = {'original': os.path.getsize(args.bundle), 'compact': os.path.getsize(args.output)}
+    loads = {'original': load_seconds(args.bundle), 'compact': load_seconds(args.output)}
+    memory = {'original': sklearn_model_bytes(read_model_set(args.bundle, BASE_DIR)),
+              'compact': flat_model_bytes(read_model_set(args.output, BASE_DIR))}
+    print(f"\n{'':<10}{'file MB':>12}{'load ms':>12}{'model MB':>12}")
+    for name in ('original', 'compact'):
+        print(f"{name:<10}{sizes[name] / 2**20:>12.2f}{loads[name] * 1000:>12.1f}{memory[name] / 2**20:>12.2f}")
+    print(f"{'change':<10}{sizes['compact'] / sizes['original'] - 1:>12.1%}"
+          f"{loads['compact'] / loads['original'] - 1:>12.1%}{memory['compact'] / memory['original'] - 1:>12.1%}")
+
+    results = {
+        'original': train_model.evaluate(original, X, *y),
+        'compact': train_model.evaluate(compact, X, *y),
+    }
+    train_model.print_comparison(results)
+    deltas = {key: results['compact'][key] - results['original'][key] for key in results['original']}
+    print(f"{'delta':<10}" + ''.join(f"{deltas[column]:>18.4f}" for column in
+                                     ('type_accuracy', 'quantity_mae', 'quantity_r2', 'health_mae', 'health_r2',
+                                      'single_ms', 'batch_rows_per_s')))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Prune a model bundle into a compact reduced-precision bundle')
+    parser.add_argument('bundle', help='separate or fused model.pkl bundle')
+    parser.add_argument('output', help='where to write the compact bundle')
+    parser.add_argument('--max-accuracy-drop', type=float, default=0.005,
+                        help='allowed drop in fertilizer type accuracy (absolute)')
+    parser.add_argument('--max-error-increase', type=float, default=0.05,
+                        help='allowed relative increase of the quantity and health score MAE')
+    parser.add_argument('--merge-tolerance', type=float, default=0.0,
+                        help='largest difference between sibling leaf values that are merged')
+    parser.add_argument('--data', help='labelled validation dataset (default: freshly generated rows)')
+    parser.add_argument('--samples', type=int, default=20000, help='generated validation rows')
+    parser.add_argument('--seed', type=int, default=2024, help='seed for the generated validation rows')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    bundle = joblib.load(args.bundle)
+    X, *targets = validation_set(args)
+    # One half picks the pruning, the other reports on it
+    half = len(X) // 2
+    y_select = dict(zip(('type', 'quantity', 'health'), (target[:half] for target in targets)))
+
+    started = time.perf_counter()
+    compact = compact_bundle(bundle, X[:half], y_select, args)
+    # Uncompressed so MODEL_MMAP_MODE can memory-map the arrays
+    joblib.dump(compact, args.output)
+    print(f"[OK] Compacted {args.bundle} in {time.perf_counter() - started:.1f}s, saved to {args.output}")
+
+    print_report(args, bundle, compact, compact['metadata']['compaction']['models'],
+                 X[half:], [target[half:] for target in targets])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
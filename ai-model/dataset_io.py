@@ -0,0 +1,233 @@
+"""
+Readers and writers for the generated soil/fertilizer dataset.
+
+Three on-disk formats are supported:
+
+- ``csv``: the original text format.
+- ``parquet``: typed columns, crop and fertilizer type stored as dictionary
+  (categorical) columns. Requires pyarrow.
+- ``npy``: a directory of raw ``.npy`` arrays (``features.npy`` holds the
+  7-column model feature matrix) that can be opened with
+  ``np.load(mmap_mode='r')`` without copying or parsing.
+
+``load_feature_matrix`` returns the feature matrix in the column order the
+models expect, with crop_type encoded like the bundled LabelEncoder
+(alphabetical class order).
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+FEATURE_COLUMNS = ['nitrogen', 'phosphorus', 'potassium', 'ph', 'moisture', 'temperature']
+MODEL_COLUMNS = FEATURE_COLUMNS + ['crop_type']
+TARGET_COLUMNS = ['fertilizer_type', 'quantity_kg_per_acre', 'soil_health_score']
+
+# LabelEncoder sorts its classes, so codes are positions in these sorted tuples
+CROP_CLASSES = ('Corn', 'Cotton', 'Potato', 'Rice', 'Soybean', 'Sugarcane', 'Tomato', 'Wheat')
+FERTILIZER_CLASSES = ('K', 'Mixed', 'N', 'Organic', 'P')
+
+FORMATS = ('csv', 'parquet', 'npy')
+NPY_META_FILE = 'meta.json'
+
+
+def infer_format(path):
+    """Guess the dataset format from a path"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.parquet', '.pq'):
+        return 'parquet'
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('', '.npy') or os.path.isdir(path):
+        return 'npy'
+    raise ValueError(f"Cannot infer dataset format from '{path}', expected one of {FORMATS}")
+
+
+def encode_classes(values, classes):
+    """Map labels to their position in a sorted class tuple"""
+    classes = np.asarray(classes)
+    values = np.asarray(values, dtype=str)
+    positions = np.minimum(np.searchsorted(classes, values), len(classes) - 1)
+    if not np.array_equal(classes[positions], values):
+        unknown = sorted(set(values[classes[positions] != values].tolist()))
+        raise ValueError(f"Unknown labels {unknown[:5]}, expected one of {tuple(classes)}")
+    return positions
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("The parquet format requires pyarrow (pip install pyarrow)") from e
+    return pyarrow, pyarrow.parquet
+
+
+class CsvWriter:
+    """Append chunks to a single CSV file"""
+
+    def __init__(self, path, n_samples=None):
+        self.path = path
+        self._first = True
+
+    def write(self, df):
+        df.to_csv(self.path, index=False, mode='w' if self._first else 'a', header=self._first)
+        self._first = False
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    """Append chunks as row groups of a single Parquet file with typed columns"""
+
+    def __init__(self, path, n_samples=None):
+        pa, pq = _require_pyarrow()
+        self._pa = pa
+        self._crop_dictionary = pa.array(CROP_CLASSES)
+        self._fertilizer_dictionary = pa.array(FERTILIZER_CLASSES)
+        category = pa.dictionary(pa.int8(), pa.string())
+        self.schema = pa.schema(
+            [(column, pa.float64()) for column in FEATURE_COLUMNS]
+            + [('crop_type', category), ('fertilizer_type', category),
+               ('quantity_kg_per_acre', pa.float64()), ('soil_health_score', pa.float64())]
+        )
+        self._writer = pq.ParquetWriter(path, self.schema)
+
+    def _category(self, values, classes, dictionary):
+        codes = self._pa.array(encode_classes(values, classes).astype(np.int8))
+        return self._pa.DictionaryArray.from_arrays(codes, dictionary)
+
+    def write(self, df):
+        pa = self._pa
+        columns = [pa.array(df[column].to_numpy(dtype=float)) for column in FEATURE_COLUMNS]
+        columns.append(self._category(df['crop_type'], CROP_CLASSES, self._crop_dictionary))
+        columns.append(self._category(df['fertilizer_type'], FERTILIZER_CLASSES, self._fertilizer_dictionary))
+        columns.append(pa.array(df['quantity_kg_per_acre'].to_numpy(dtype=float)))
+        columns.append(pa.array(df['soil_health_score'].to_numpy(dtype=float)))
+        self._writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self._writer.close()
+
+
+class NpyWriter:
+    """Write chunks into preallocated, memory-mapped .npy arrays in a directory"""
+
+    def __init__(self, path, n_samples):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.n_samples = n_samples
+        self._offset = 0
+        open_memmap = np.lib.format.open_memmap
+        self.features = open_memmap(os.path.join(path, 'features.npy'), mode='w+',
+                                    dtype=np.float64, shape=(n_samples, len(MODEL_COLUMNS)))
+        self.fertilizer_type = open_memmap(os.path.join(path, 'fertilizer_type.npy'), mode='w+',
+                                           dtype=np.int8, shape=(n_samples,))
+        self.quantity = open_memmap(os.path.join(path, 'quantity_kg_per_acre.npy'), mode='w+',
+                                    dtype=np.float64, shape=(n_samples,))
+        self.health = open_memmap(os.path.join(path, 'soil_health_score.npy'), mode='w+',
+                                  dtype=np.float64, shape=(n_samples,))
+
+    def write(self, df):
+        rows = slice(self._offset, self._offset + len(df))
+        self.features[rows, :len(FEATURE_COLUMNS)] = df[FEATURE_COLUMNS].to_numpy(dtype=float)
+        self.features[rows, -1] = encode_classes(df['crop_type'], CROP_CLASSES)
+        self.fertilizer_type[rows] = encode_classes(df['fertilizer_type'], FERTILIZER_CLASSES)
+        self.quantity[rows] = df['quantity_kg_per_acre'].to_numpy(dtype=float)
+        self.health[rows] = df['soil_health_score'].to_numpy(dtype=float)
+        self._offset += len(df)
+
+    def close(self):
+        for array in (self.features, self.fertilizer_type, self.quantity, self.health):
+            array.flush()
+        meta = {
+            'rows': self._offset,
+            'feature_columns': MODEL_COLUMNS,
+            'crop_classes': list(CROP_CLASSES),
+            'fertilizer_classes': list(FERTILIZER_CLASSES),
+        }
+        with open(os.path.join(self.path, NPY_META_FILE), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+
+WRITERS = {'csv': CsvWriter, 'parquet': ParquetWriter, 'npy': NpyWriter}
+
+
+def open_writer(path, fmt=None, n_samples=None):
+    """Create a chunk writer for the given format (inferred from path if omitted)"""
+    fmt = fmt or infer_format(path)
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown dataset format '{fmt}', expected one of {FORMATS}")
+    return WRITERS[fmt](path, n_samples)
+
+
+def _load_npy(path, name, mmap=True):
+    return np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r' if mmap else None)
+
+
+def load_feature_matrix(path, fmt=None, mmap=True):
+    """Return the (n, 7) float64 feature matrix in model column order.
+
+    For the npy format the array is memory-mapped read-only and no data is
+    copied; the other formats decode only the feature columns.
+    """
+    fmt = fmt or infer_format(path)
+    if fmt == 'npy':
+        return _load_npy(path, 'features', mmap)
+
+    if fmt == 'parquet':
+        _, pq = _require_pyarrow()
+        table = pq.read_table(path, columns=MODEL_COLUMNS)
+        df = table.to_pandas()
+    else:
+        df = pd.read_csv(path, usecols=MODEL_COLUMNS, float_precision='round_trip')
+
+    features = np.empty((len(df), len(MODEL_COLUMNS)), dtype=np.float64)
+    features[:, :len(FEATURE_COLUMNS)] = df[FEATURE_COLUMNS].to_numpy(dtype=float)
+    features[:, -1] = encode_classes(df['crop_type'].astype(str), CROP_CLASSES)
+    return features
+
+
+def load_targets(path, fmt=None, mmap=True):
+    """Return a dict of the three target arrays (fertilizer type as class labels)"""
+    fmt = fmt or infer_format(path)
+    if fmt == 'npy':
+        codes = _load_npy(path, 'fertilizer_type', mmap)
+        return {
+            'fertilizer_type': np.asarray(FERTILIZER_CLASSES, dtype=object)[codes],
+            'quantity_kg_per_acre': _load_npy(path, 'quantity_kg_per_acre', mmap),
+            'soil_health_score': _load_npy(path, 'soil_health_score', mmap),
+        }
+
+    if fmt == 'parquet':
+        _, pq = _require_pyarrow()
+        df = pq.read_table(path, columns=TARGET_COLUMNS).to_pandas()
+    else:
+        df = pd.read_csv(path, usecols=TARGET_COLUMNS, float_precision='round_trip')
+    return {
+        'fertilizer_type': df['fertilizer_type'].astype(str).to_numpy(dtype=object),
+        'quantity_kg_per_acre': df['quantity_kg_per_acre'].to_numpy(dtype=float),
+        'soil_health_score': df['soil_health_score'].to_numpy(dtype=float),
+    }
+
+
+def load_dataset(path, fmt=None):
+    """Load the full dataset as a DataFrame with the original CSV columns"""
+    fmt = fmt or infer_format(path)
+    if fmt == 'csv':
+        return pd.read_csv(path, float_precision='round_trip')
+    if fmt == 'parquet':
+        _, pq = _require_pyarrow()
+        df = pq.read_table(path).to_pandas()
+        for column in ('crop_type', 'fertilizer_type'):
+            df[column] = df[column].astype(str)
+        return df
+
+    features = load_feature_matrix(path, fmt, mmap=False)
+    df = pd.DataFrame(features[:, :len(FEATURE_COLUMNS)], columns=FEATURE_COLUMNS)
+    df['crop_type'] = np.asarray(CROP_CLASSES, dtype=object)[features[:, -1].astype(int)]
+    for column, values in load_targets(path, fmt, mmap=False).items():
+        df[column] = values
+    return df
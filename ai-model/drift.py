@@ -0,0 +1,137 @@
+"""
+Streaming feature-distribution statistics and drift scores.
+
+``FeatureStats`` keeps a fixed-bin histogram per model feature, the crop mix
+and the first two moments. It is updated chunk by chunk, two stats over the
+same bin edges can be merged by adding them, and it round-trips through a
+plain dict so the training distribution can be stored in a bundle's metadata.
+
+The bin edges are the deciles of the reference (training) data, and drift is
+the Population Stability Index between the reference histogram and the one
+of newly logged inputs:
+
+    PSI = sum((actual - expected) * ln(actual / expected))
+
+By convention a PSI below 0.1 means no real change, 0.1-0.25 a moderate shift
+and above 0.25 a major one.
+"""
+import numpy as np
+
+from dataset_io import CROP_CLASSES, FEATURE_COLUMNS
+
+DEFAULT_BINS = 10
+# Floor for empty bins, so the log in the PSI stays finite
+PSI_EPSILON = 1e-4
+
+
+class FeatureStats:
+    """Histograms over fixed inner bin edges (n_features, bins - 1) plus crop counts and moments"""
+
+    def __init__(self, edges):
+        self.edges = np.asarray(edges, dtype=float)
+        n_features, n_edges = self.edges.shape
+        self.counts = np.zeros((n_features, n_edges + 1), dtype=np.int64)
+        # One slot per crop class plus a last one for unknown crops
+        self.crop_counts = np.zeros(len(CROP_CLASSES) + 1, dtype=np.int64)
+        self.count = 0
+        self.sum = np.zeros(n_features)
+        self.sum_sq = np.zeros(n_features)
+
+    @classmethod
+    def reference(cls, features, bins=DEFAULT_BINS):
+        """Stats of a reference feature matrix (n, 7) binned at its own quantiles"""
+        features = np.asarray(features, dtype=float)
+        values = features[:, :len(FEATURE_COLUMNS)]
+        edges = np.quantile(values, np.linspace(0, 1, bins + 1)[1:-1], axis=0).T
+        stats = cls(edges)
+        stats.update(values, features[:, len(FEATURE_COLUMNS)].astype(np.intp))
+        return stats
+
+    def empty_like(self):
+        return FeatureStats(self.edges)
+
+    def update(self, values, crop_codes):
+        """Add a chunk of readings (n, 6) and crop codes (-1 for unknown crops)"""
+        values = np.asarray(values, dtype=float)
+        if not len(values):
+            return self
+        for column in range(len(self.edges)):
+            bins = np.searchsorted(self.edges[column], values[:, column], side='right')
+            self.counts[column] += np.bincount(bins, minlength=self.counts.shape[1])
+        crop_codes = np.asarray(crop_codes, dtype=np.intp)
+        known = (crop_codes >= 0) & (crop_codes < len(CROP_CLASSES))
+        self.crop_counts += np.bincount(np.where(known, crop_codes, len(CROP_CLASSES)),
+                                        minlength=len(self.crop_counts))
+        self.count += len(values)
+        self.sum += values.sum(axis=0)
+        self.sum_sq += np.square(values).sum(axis=0)
+        return self
+
+    def merge(self, other):
+        """Stats of both inputs together; the bin edges must match"""
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Cannot merge feature stats with different bin edges')
+        merged = self.empty_like()
+        merged.counts = self.counts + other.counts
+        merged.crop_counts = self.crop_counts + other.crop_counts
+        merged.count = self.count + other.count
+        merged.sum = self.sum + other.sum
+        merged.sum_sq = self.sum_sq + other.sum_sq
+        return merged
+
+    @property
+    def mean(self):
+        return self.sum / max(self.count, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(np.maximum(self.sum_sq / max(self.count, 1) - self.mean ** 2, 0))
+
+    def to_dict(self):
+        return {
+            'edges': self.edges.tolist(),
+            'counts': self.counts.tolist(),
+            'crop_counts': self.crop_counts.tolist(),
+            'count': int(self.count),
+            'sum': self.sum.tolist(),
+            'sum_sq': self.sum_sq.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data['edges'])
+        stats.counts = np.asarray(data['counts'], dtype=np.int64)
+        stats.crop_counts = np.asarray(data['crop_counts'], dtype=np.int64)
+        stats.count = int(data['count'])
+        stats.sum = np.asarray(data['sum'], dtype=float)
+        stats.sum_sq = np.asarray(data['sum_sq'], dtype=float)
+        return stats
+
+
+def psi(expected_counts, actual_counts):
+    """Population Stability Index between two histograms over the same bins"""
+    expected = np.asarray(expected_counts, dtype=float)
+    actual = np.asarray(actual_counts, dtype=float)
+    expected = np.maximum(expected / max(expected.sum(), 1), PSI_EPSILON)
+    actual = np.maximum(actual / max(actual.sum(), 1), PSI_EPSILON)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+def drift_report(reference, current):
+    """PSI per feature and for the crop mix, with the mean shift in reference standard deviations"""
+    features = {}
+    for column, name in enumerate(FEATURE_COLUMNS):
+        scale = reference.std[column] or 1.0
+        features[name] = {
+            'psi': psi(reference.counts[column], current.counts[column]),
+            'mean_shift': float((current.mean[column] - reference.mean[column]) / scale),
+        }
+    crop_psi = psi(reference.crop_counts, current.crop_counts)
+    return {
+        'rows': int(current.count),
+        'reference_rows': int(reference.count),
+        'features': features,
+        'crop_type_psi': crop_psi,
+        'unknown_crop_rows': int(current.crop_counts[-1]),
+        'max_psi': max([crop_psi] + [entry['psi'] for entry in features.values()]),
+    }
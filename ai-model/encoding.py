@@ -0,0 +1,292 @@
+"""
+Response encodings for the prediction endpoints.
+
+Scoring produces a columnar ``ScoredBatch``. It is encoded as one of:
+
+- ``json`` (default): the original verbose responses, deficiency and
+  suggestion texts included.
+- ``msgpack`` (``Accept: application/msgpack``): the same fields with
+  fertilizer types, deficiency statuses/severities and suggestions sent as
+  enum codes. A single prediction is a map; a batch is a map of columns.
+- ``binary`` (``Accept: application/vnd.fertilizer.binary``): a fixed
+  little-endian columnar layout, see ``encode_binary``.
+
+The code tables are the rule catalogs in rules.py and are served by
+GET /codes; ``CODES_VERSION`` changes whenever they do. ``fields=`` selects
+which response fields are encoded, in every format.
+"""
+import hashlib
+import json
+import struct
+from typing import Any, NamedTuple
+
+import numpy as np
+
+from dataset_io import FERTILIZER_CLASSES
+from rules import (
+    CROP_TYPES,
+    DEFICIENCY_NUTRIENTS,
+    DEFICIENCY_RECOMMENDATIONS,
+    SEVERITY_LABELS,
+    STATUS_LABELS,
+    SUGGESTIONS,
+    deficiency_reports,
+    suggestion_messages,
+)
+
+try:
+    import msgpack
+except ImportError:  # optional, msgpack is only offered when installed
+    msgpack = None
+
+JSON, MSGPACK, BINARY = 'json', 'msgpack', 'binary'
+CONTENT_TYPES = {
+    JSON: 'application/json',
+    MSGPACK: 'application/msgpack',
+    BINARY: 'application/vnd.fertilizer.binary',
+}
+MEDIA_TYPES = {
+    'application/json': JSON,
+    'application/msgpack': MSGPACK,
+    'application/x-msgpack': MSGPACK,
+    'application/vnd.fertilizer.binary': BINARY,
+}
+
+RESPONSE_FIELDS = (
+    'fertilizer_type',
+    'quantity_kg_per_acre',
+    'soil_health_score',
+    'deficiency_analysis',
+    'improvement_suggestions',
+    'input_data',
+)
+INPUT_FIELDS = ('nitrogen', 'phosphorus', 'potassium', 'ph', 'moisture', 'temperature')
+
+BINARY_MAGIC = b'FRT1'
+BINARY_VERSION = 1
+# magic, version, field mask (bit i = RESPONSE_FIELDS[i]), row count
+BINARY_HEADER = struct.Struct('<4sBHI')
+# Code for a fertilizer type or crop missing from the code tables
+UNKNOWN_CODE = 255
+
+_FERTILIZER_CODES = {name: code for code, name in enumerate(FERTILIZER_CLASSES)}
+_CROP_CODES = {name: code for code, name in enumerate(CROP_TYPES)}
+# The binary format packs the suggestions into a uint16 bitmask; a 17th suggestion
+# needs a wider mask and a new BINARY_VERSION
+if len(SUGGESTIONS) > 16:
+    raise RuntimeError(f'{len(SUGGESTIONS)} improvement suggestions no longer fit the uint16 binary bitmask')
+_SUGGESTION_BITS = (1 << np.arange(len(SUGGESTIONS))).astype(np.uint16)
+
+
+def code_catalog():
+    """Code tables for the compact encodings, as served by GET /codes"""
+    return {
+        'fertilizer_types': list(FERTILIZER_CLASSES),
+        'crop_types': list(CROP_TYPES),
+        'nutrients': list(DEFICIENCY_NUTRIENTS),
+        'statuses': list(STATUS_LABELS),
+        'severities': list(SEVERITY_LABELS),
+        'recommendations': {
+            nutrient: {STATUS_LABELS[status]: text
+                       for (name, status), text in DEFICIENCY_RECOMMENDATIONS.items() if name == nutrient}
+            for nutrient in DEFICIENCY_NUTRIENTS
+        },
+        'suggestions': list(SUGGESTIONS),
+        'response_fields': list(RESPONSE_FIELDS),
+    }
+
+
+CODES_VERSION = hashlib.sha256(json.dumps(code_catalog(), sort_keys=True).encode()).hexdigest()[:12]
+
+
+class ScoredBatch(NamedTuple):
+    """Scored samples in columns: inputs, rounded outputs and rule codes"""
+    values: Any             # (n, 6) request readings
+    crop_types: Any         # n crop types as sent
+    fertilizer_types: Any   # n fertilizer type labels, after crop adjustments
+    quantities: Any         # n floats rounded to 2 decimals
+    health_scores: Any      # n floats rounded to 2 decimals
+    status: Any             # (n, 4) int8 status codes per DEFICIENCY_NUTRIENTS
+    severity: Any           # (n, 4) int8 severity codes
+    suggestion_flags: Any   # (n, len(SUGGESTIONS)) bool
+
+    @property
+    def count(self):
+        return len(self.crop_types)
+
+    def row(self, i):
+        """One-sample ScoredBatch for row i"""
+        return ScoredBatch(
+            self.values[i:i + 1], self.crop_types[i:i + 1], self.fertilizer_types[i:i + 1],
+            self.quantities[i:i + 1], self.health_scores[i:i + 1],
+            self.status[i:i + 1], self.severity[i:i + 1], self.suggestion_flags[i:i + 1],
+        )
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty((0, len(INPUT_FIELDS))), [], np.empty(0, dtype=object), [], [],
+                   np.empty((0, len(DEFICIENCY_NUTRIENTS)), dtype=np.int8),
+                   np.empty((0, len(DEFICIENCY_NUTRIENTS)), dtype=np.int8),
+                   np.empty((0, len(SUGGESTIONS)), dtype=bool))
+
+
+def negotiate(accept):
+    """Pick the response encoding from an Accept header (JSON unless a compact type is preferred)"""
+    best, best_quality = JSON, 0.0
+    for position, item in enumerate((accept or '').split(',')):
+        media_type, *params = (part.strip() for part in item.split(';'))
+        fmt = MEDIA_TYPES.get(media_type.lower())
+        if fmt is None or (fmt == MSGPACK and msgpack is None):
+            continue
+        quality = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > best_quality:
+            best, best_quality = fmt, quality
+    return best
+
+
+def parse_fields(param):
+    """Response fields selected by a fields= query parameter (all when absent)"""
+    if not param:
+        return RESPONSE_FIELDS
+    fields = [name.strip() for name in param.split(',') if name.strip()]
+    unknown = sorted(set(fields) - set(RESPONSE_FIELDS))
+    if unknown:
+        raise ValueError(f"Unknown fields {unknown}, expected any of {list(RESPONSE_FIELDS)}")
+    return tuple(name for name in RESPONSE_FIELDS if name in fields)
+
+
+def decode_request(body, mimetype):
+    """Decode a MessagePack request body; returns None for other content types"""
+    if MEDIA_TYPES.get(mimetype) != MSGPACK:
+        return None
+    if msgpack is None:
+        raise ValueError('MessagePack request bodies require the msgpack package')
+    try:
+        return msgpack.unpackb(body, raw=False)
+    except (msgpack.UnpackException, ValueError) as e:
+        # msgpack's FormatError and ExtraData carry no message of their own
+        raise ValueError(f'Invalid MessagePack request body: {str(e) or type(e).__name__}') from e
+
+
+def json_results(batch, fields=RESPONSE_FIELDS):
+    """Expand a ScoredBatch into the verbose per-sample JSON objects"""
+    deficiencies = suggestions = None
+    if 'deficiency_analysis' in fields:
+        deficiencies = deficiency_reports(np.asarray(batch.values)[:, :4], batch.status, batch.severity)
+    if 'improvement_suggestions' in fields:
+        suggestions = suggestion_messages(batch.suggestion_flags)
+
+    results = []
+    for i, (row, crop_type) in enumerate(zip(batch.values, batch.crop_types)):
+        result = {}
+        if 'fertilizer_type' in fields:
+            result['fertilizer_type'] = batch.fertilizer_types[i]
+        if 'quantity_kg_per_acre' in fields:
+            result['quantity_kg_per_acre'] = batch.quantities[i]
+        if 'soil_health_score' in fields:
+            result['soil_health_score'] = batch.health_scores[i]
+        if deficiencies is not None:
+            result['deficiency_analysis'] = deficiencies[i]
+        if suggestions is not None:
+            result['improvement_suggestions'] = suggestions[i]
+        if 'input_data' in fields:
+            nitrogen, phosphorus, potassium, ph, moisture, temperature = row
+            result['input_data'] = {
+                'nitrogen': nitrogen,
+                'phosphorus': phosphorus,
+                'potassium': potassium,
+                'ph': ph,
+                'moisture': moisture,
+                'temperature': temperature,
+                'crop_type': crop_type
+            }
+        results.append(result)
+    return results
+
+
+def _fertilizer_codes(batch):
+    return [_FERTILIZER_CODES.get(name, UNKNOWN_CODE) for name in batch.fertilizer_types]
+
+
+def _suggestion_codes(batch):
+    return [np.flatnonzero(row).tolist() for row in batch.suggestion_flags]
+
+
+def compact_columns(batch, fields=RESPONSE_FIELDS):
+    """Coded columns of a ScoredBatch, keyed like the msgpack maps"""
+    columns = {}
+    if 'fertilizer_type' in fields:
+        columns['fertilizer_type'] = _fertilizer_codes(batch)
+    if 'quantity_kg_per_acre' in fields:
+        columns['quantity_kg_per_acre'] = list(batch.quantities)
+    if 'soil_health_score' in fields:
+        columns['soil_health_score'] = list(batch.health_scores)
+    if 'deficiency_analysis' in fields:
+        columns['deficiency_status'] = np.asarray(batch.status).tolist()
+        columns['deficiency_severity'] = np.asarray(batch.severity).tolist()
+    if 'improvement_suggestions' in fields:
+        columns['improvement_suggestions'] = _suggestion_codes(batch)
+    if 'input_data' in fields:
+        columns['input_data'] = [list(row) + [crop] for row, crop in zip(np.asarray(batch.values).tolist(), batch.crop_types)]
+    return columns
+
+
+def encode_msgpack(batch, fields=RESPONSE_FIELDS, single=False):
+    """MessagePack: a map of coded fields for a single sample, a map of columns for a batch"""
+    columns = compact_columns(batch, fields)
+    if single:
+        return msgpack.packb({name: column[0] for name, column in columns.items()}, use_bin_type=True)
+    return msgpack.packb({'count': batch.count, **columns}, use_bin_type=True)
+
+
+def _hundredths(values):
+    return np.rint(np.asarray(values, dtype=float) * 100).astype('<i4')
+
+
+def encode_binary(batch, fields=RESPONSE_FIELDS):
+    """Fixed little-endian columnar layout.
+
+    Header: 4-byte magic b'FRT1', uint8 version, uint16 field mask (bit i set
+    when RESPONSE_FIELDS[i] is present), uint32 row count. Then one section
+    per present field, in RESPONSE_FIELDS order:
+
+    - fertilizer_type: uint8[n] codes (255 = unknown)
+    - quantity_kg_per_acre, soil_health_score: int32[n] in hundredths
+    - deficiency_analysis: uint8[n, 4] status codes, then uint8[n, 4] severity codes
+    - improvement_suggestions: uint16[n] bitmask, bit i = suggestion code i
+      (at most 16 suggestion codes fit, checked at import)
+    - input_data: float64[n, 6] readings, then uint8[n] crop codes (255 = not a known crop)
+    """
+    mask = sum(1 << i for i, name in enumerate(RESPONSE_FIELDS) if name in fields)
+    parts = [BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, mask, batch.count)]
+    if 'fertilizer_type' in fields:
+        parts.append(np.asarray(_fertilizer_codes(batch), dtype=np.uint8).tobytes())
+    if 'quantity_kg_per_acre' in fields:
+        parts.append(_hundredths(batch.quantities).tobytes())
+    if 'soil_health_score' in fields:
+        parts.append(_hundredths(batch.health_scores).tobytes())
+    if 'deficiency_analysis' in fields:
+        parts.append(np.asarray(batch.status, dtype=np.uint8).tobytes())
+        parts.append(np.asarray(batch.severity, dtype=np.uint8).tobytes())
+    if 'improvement_suggestions' in fields:
+        flags = np.asarray(batch.suggestion_flags, dtype=bool)
+        parts.append((flags * _SUGGESTION_BITS).sum(axis=1, dtype=np.uint16).astype('<u2').tobytes())
+    if 'input_data' in fields:
+        parts.append(np.asarray(batch.values, dtype='<f8').reshape(-1, len(INPUT_FIELDS)).tobytes())
+        crops = [_CROP_CODES.get(crop, UNKNOWN_CODE) if isinstance(crop, str) else UNKNOWN_CODE
+                 for crop in batch.crop_types]
+        parts.append(np.asarray(crops, dtype=np.uint8).tobytes())
+    return b''.join(parts)
+
+
+def encode_compact(batch, fmt, fields=RESPONSE_FIELDS, single=False):
+    """Encode a ScoredBatch as msgpack or binary bytes"""
+    if fmt == MSGPACK:
+        return encode_msgpack(batch, fields, single)
+    return encode_binary(batch, fields)
@@ -0,0 +1,104 @@
+"""
+Per-feature explanations of the three model outputs.
+
+``Explainer`` runs ``FlatForest.contributions`` (path contributions over the
+per-node value arrays) for every model of a ModelSet. The flat-engine and
+compact bundles already hold FlatForests; scikit-learn models are flattened
+once, when the first explanation is requested.
+
+Each target is explained as
+
+    value = base_value + sum(contributions.values())
+
+where ``base_value`` is the mean training output and each contribution is
+what the splits on that feature added along the sample's paths. Explanations
+cover the raw model outputs. The rule layer then adjusts the quantity for the
+crop and can replace the fertilizer type, so the service reports the served
+values next to them. For the fertilizer type the value is the predicted
+class's probability (the mean indicator of a fused forest).
+"""
+import numpy as np
+
+from model_store import FEATURE_FIELDS
+from tree_engine import MODEL_FIELDS, FlatForest, flatten_model
+
+FEATURE_NAMES = tuple(name for name, _ in FEATURE_FIELDS) + ('crop_type',)
+PRECISION = 4
+
+
+def as_flat(model):
+    return model if isinstance(model, FlatForest) else flatten_model(model)
+
+
+def explain_target(base_values, contributions, index):
+    """One target's explanation dict from its base value and (n_features,) contributions"""
+    return {
+        'base_value': round(float(base_values[index]), PRECISION),
+        'contributions': {name: round(value, PRECISION)
+                          for name, value in zip(FEATURE_NAMES, contributions[:, index].tolist())},
+    }
+
+
+class Explainer:
+    """Path-contribution explanations for the models of one ModelSet"""
+
+    def __init__(self, model_set):
+        self.fingerprint = model_set.fingerprint
+        fused = model_set.fused_model
+        if fused is not None:
+            self.fused = fused
+            self.forests = (as_flat(fused.forest),)
+        else:
+            self.fused = None
+            self.forests = tuple(as_flat(getattr(model_set, field)) for field in MODEL_FIELDS)
+
+    def explain(self, features):
+        """One {target: explanation} dict per row of a (n, 7) feature matrix"""
+        if self.fused is not None:
+            return self._explain_fused(features)
+
+        fertilizer, quantity, health = self.forests
+        type_bias, type_contributions, probabilities = fertilizer.contributions(features)
+        quantity_bias, quantity_contributions, quantities = quantity.contributions(features)
+        health_bias, health_contributions, health_scores = health.contributions(features)
+        predicted = np.argmax(probabilities, axis=1)
+
+        explanations = []
+        for row, class_index in enumerate(predicted.tolist()):
+            fertilizer_type = explain_target(type_bias, type_contributions[row], class_index)
+            fertilizer_type['value'] = str(fertilizer.classes_[class_index])
+            fertilizer_type['probability'] = round(float(probabilities[row, class_index]), PRECISION)
+            explanations.append({
+                'fertilizer_type': fertilizer_type,
+                'quantity_kg_per_acre': self._regression(quantity_bias, quantity_contributions[row], quantities[row]),
+                'soil_health_score': self._regression(health_bias, health_contributions[row], health_scores[row]),
+            })
+        return explanations
+
+    def _explain_fused(self, features):
+        # The forest predicts standardized targets; scale back to the original units
+        bias, contributions, outputs = self.forests[0].contributions(features)
+        scale = self.fused.target_scale
+        bias = bias * scale + self.fused.target_mean
+        contributions = contributions * scale
+        outputs = outputs * scale + self.fused.target_mean
+        n_classes = len(self.fused.fertilizer_classes)
+        predicted = np.argmax(outputs[:, :n_classes], axis=1)
+
+        explanations = []
+        for row, class_index in enumerate(predicted.tolist()):
+            fertilizer_type = explain_target(bias, contributions[row], class_index)
+            fertilizer_type['value'] = str(self.fused.fertilizer_classes[class_index])
+            fertilizer_type['probability'] = round(float(outputs[row, class_index]), PRECISION)
+            explanations.append({
+                'fertilizer_type': fertilizer_type,
+                'quantity_kg_per_acre': self._regression(bias, contributions[row], outputs[row], n_classes),
+                'soil_health_score': self._regression(bias, contributions[row], outputs[row], n_classes + 1),
+            })
+        return explanations
+
+    @staticmethod
+    def _regression(bias, contributions, outputs, index=0):
+        explanation = explain_target(bias, contributions, index)
+        explanation['value'] = round(float(outputs[index]), PRECISION)
+        return explanation
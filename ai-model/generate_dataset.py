@@ -1,28 +1,79 @@
 """
 Script to generate sample fertilizer recommendation dataset
+
+Rows are generated and labelled in chunks with vectorized rules, so the
+dataset size is only bounded by disk space:
+
+    python generate_dataset.py --samples 10000000 --chunk-size 1000000
+
+Besides CSV, the dataset can be written as Parquet or as memory-mappable
+.npy arrays (see dataset_io.py):
+
+    python generate_dataset.py --samples 10000000 --format npy
 """
-import pandas as pd
-import numpy as np
+import argparse
 import os
 
-np.random.seed(42)
+import numpy as np
+import pandas as pd
+
+from dataset_io import FORMATS, open_writer
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 OUTPUT_PATH = os.path.join(BASE_DIR, 'soil_fertilizer_dataset.csv')
+DEFAULT_OUTPUTS = {
+    'csv': OUTPUT_PATH,
+    'parquet': os.path.join(BASE_DIR, 'soil_fertilizer_dataset.parquet'),
+    'npy': os.path.join(BASE_DIR, 'soil_fertilizer_dataset_npy'),
+}
+
+DEFAULT_SAMPLES = 2000
+DEFAULT_SEED = 42
+DEFAULT_CHUNK_SIZE = 1_000_000
+
+CROP_TYPES = ['Wheat', 'Rice', 'Corn', 'Soybean', 'Cotton', 'Tomato', 'Potato', 'Sugarcane']
+FEATURE_COLUMNS = ['nitrogen', 'phosphorus', 'potassium', 'ph', 'moisture', 'temperature']
+LABEL_COLUMNS = ['fertilizer_type', 'quantity_kg_per_acre', 'soil_health_score']
 
-# Generate sample data
-n_samples = 2000
-
-data = {
-    'nitrogen': np.random.uniform(0, 100, n_samples),
-    'phosphorus': np.random.uniform(0, 100, n_samples),
-    'potassium': np.random.uniform(0, 100, n_samples),
-    'ph': np.random.uniform(4.0, 8.5, n_samples),
-    'moisture': np.random.uniform(20, 80, n_samples),
-    'temperature': np.random.uniform(15, 35, n_samples),
-    'crop_type': np.random.choice(['Wheat', 'Rice', 'Corn', 'Soybean', 'Cotton', 'Tomato', 'Potato', 'Sugarcane'], n_samples)
+# Crop-specific base recommendations
+CROP_PREFERENCES = {
+    'Wheat': {'prefers': 'N', 'needs_high_n': True},
+    'Rice': {'prefers': 'N', 'needs_high_n': True},
+    'Corn': {'prefers': 'N', 'needs_high_n': True},
+    'Soybean': {'prefers': 'P', 'needs_high_p': True, 'fixes_n': True},
+    'Cotton': {'prefers': 'K', 'needs_high_k': True},
+    'Tomato': {'prefers': 'Mixed', 'needs_balanced': True},
+    'Potato': {'prefers': 'P', 'needs_high_p': True},
+    'Sugarcane': {'prefers': 'K', 'needs_high_k': True}
 }
 
-df = pd.DataFrame(data)
+# Crop-specific base quantities (kg/acre)
+CROP_BASE_QUANTITIES = {
+    'Wheat': 60,
+    'Rice': 80,
+    'Corn': 70,
+    'Soybean': 40,  # Fixes nitrogen, needs less
+    'Cotton': 65,
+    'Tomato': 55,
+    'Potato': 75,
+    'Sugarcane': 90
+}
+
+# Crop-specific optimal ranges
+CROP_OPTIMAL_RANGES = {
+    'Wheat': {'n': (40, 70), 'p': (25, 50), 'k': (30, 70), 'ph': (6.0, 7.5)},
+    'Rice': {'n': (50, 80), 'p': (20, 45), 'k': (30, 70), 'ph': (5.5, 7.0)},
+    'Corn': {'n': (50, 80), 'p': (25, 50), 'k': (30, 70), 'ph': (6.0, 7.5)},
+    'Soybean': {'n': (30, 60), 'p': (30, 60), 'k': (30, 70), 'ph': (6.0, 7.0)},
+    'Cotton': {'n': (40, 70), 'p': (25, 50), 'k': (40, 80), 'ph': (5.5, 8.0)},
+    'Tomato': {'n': (40, 70), 'p': (30, 60), 'k': (40, 80), 'ph': (6.0, 7.0)},
+    'Potato': {'n': (40, 70), 'p': (30, 60), 'k': (30, 70), 'ph': (5.0, 6.5)},
+    'Sugarcane': {'n': (50, 80), 'p': (25, 50), 'k': (40, 80), 'ph': (6.0, 7.5)}
+}
+
+
+# Scalar reference rules, one row at a time. The generator uses the vectorized
+# versions below; these are kept to document the rules and for --check.
 
 # Define fertilizer recommendation rules based on nutrient levels and crop type
 def recommend_fertilizer(row):
@@ -31,21 +82,9 @@ def recommend_fertilizer(row):
     k = row['potassium']
     ph = row['ph']
     crop = row['crop_type']
-    
-    # Crop-specific base recommendations
-    crop_preferences = {
-        'Wheat': {'prefers': 'N', 'needs_high_n': True},
-        'Rice': {'prefers': 'N', 'needs_high_n': True},
-        'Corn': {'prefers': 'N', 'needs_high_n': True},
-        'Soybean': {'prefers': 'P', 'needs_high_p': True, 'fixes_n': True},
-        'Cotton': {'prefers': 'K', 'needs_high_k': True},
-        'Tomato': {'prefers': 'Mixed', 'needs_balanced': True},
-        'Potato': {'prefers': 'P', 'needs_high_p': True},
-        'Sugarcane': {'prefers': 'K', 'needs_high_k': True}
-    }
-    
-    crop_info = crop_preferences.get(crop, {'prefers': 'Mixed'})
-    
+
+    crop_info = CROP_PREFERENCES.get(crop, {'prefers': 'Mixed'})
+
     # Nitrogen deficiency
     if n < 30:
         if p < 25 and k < 30:
@@ -85,39 +124,27 @@ def recommend_fertilizer(row):
         return 'Mixed'
 
 def calculate_quantity(row):
-    # Crop-specific base quantities (kg/acre)
-    crop_base_quantities = {
-        'Wheat': 60,
-        'Rice': 80,
-        'Corn': 70,
-        'Soybean': 40,  # Fixes nitrogen, needs less
-        'Cotton': 65,
-        'Tomato': 55,
-        'Potato': 75,
-        'Sugarcane': 90
-    }
-    
     crop = row['crop_type']
-    base_quantity = crop_base_quantities.get(crop, 50)
-    
+    base_quantity = CROP_BASE_QUANTITIES.get(crop, 50)
+
     n = row['nitrogen']
     p = row['phosphorus']
     k = row['potassium']
-    
+
     # Calculate deficiency
     n_deficit = max(0, 50 - n)
     p_deficit = max(0, 40 - p)
     k_deficit = max(0, 50 - k)
-    
+
     total_deficit = n_deficit + p_deficit + k_deficit
     quantity = base_quantity + (total_deficit * 1.5)
-    
+
     # Crop-specific adjustments
     if crop in ['Rice', 'Sugarcane']:
         quantity *= 1.1  # Need more fertilizer
     elif crop == 'Soybean':
         quantity *= 0.8  # Needs less (fixes N)
-    
+
     return min(quantity, 200)  # Cap at 200 kg/acre
 
 def calculate_soil_health_score(row):
@@ -127,21 +154,9 @@ def calculate_soil_health_score(row):
     ph = row['ph']
     moisture = row['moisture']
     crop = row['crop_type']
-    
-    # Crop-specific optimal ranges
-    crop_optimal_ranges = {
-        'Wheat': {'n': (40, 70), 'p': (25, 50), 'k': (30, 70), 'ph': (6.0, 7.5)},
-        'Rice': {'n': (50, 80), 'p': (20, 45), 'k': (30, 70), 'ph': (5.5, 7.0)},
-        'Corn': {'n': (50, 80), 'p': (25, 50), 'k': (30, 70), 'ph': (6.0, 7.5)},
-        'Soybean': {'n': (30, 60), 'p': (30, 60), 'k': (30, 70), 'ph': (6.0, 7.0)},
-        'Cotton': {'n': (40, 70), 'p': (25, 50), 'k': (40, 80), 'ph': (5.5, 8.0)},
-        'Tomato': {'n': (40, 70), 'p': (30, 60), 'k': (40, 80), 'ph': (6.0, 7.0)},
-        'Potato': {'n': (40, 70), 'p': (30, 60), 'k': (30, 70), 'ph': (5.0, 6.5)},
-        'Sugarcane': {'n': (50, 80), 'p': (25, 50), 'k': (40, 80), 'ph': (6.0, 7.5)}
-    }
-    
-    optimal = crop_optimal_ranges.get(crop, {'n': (40, 70), 'p': (25, 50), 'k': (30, 70), 'ph': (6.0, 7.5)})
-    
+
+    optimal = CROP_OPTIMAL_RANGES.get(crop, {'n': (40, 70), 'p': (25, 50), 'k': (30, 70), 'ph': (6.0, 7.5)})
+
     # Calculate scores based on crop-specific optimal ranges
     n_min, n_max = optimal['n']
     if n_min <= n <= n_max:
@@ -150,7 +165,7 @@ def calculate_soil_health_score(row):
         n_score = (n / n_min) * 100
     else:
         n_score = max(70, 100 - ((n - n_max) / (100 - n_max)) * 30)
-    
+
     p_min, p_max = optimal['p']
     if p_min <= p <= p_max:
         p_score = 100
@@ -158,7 +173,7 @@ def calculate_soil_health_score(row):
         p_score = (p / p_min) * 100
     else:
         p_score = max(70, 100 - ((p - p_max) / (100 - p_max)) * 30)
-    
+
     k_min, k_max = optimal['k']
     if k_min <= k <= k_max:
         k_score = 100
@@ -166,7 +181,7 @@ def calculate_soil_health_score(row):
         k_score = (k / k_min) * 100
     else:
         k_score = max(70, 100 - ((k - k_max) / (100 - k_max)) * 30)
-    
+
     # pH optimal range (crop-specific)
     ph_min, ph_max = optimal['ph']
     if ph_min <= ph <= ph_max:
@@ -175,7 +190,7 @@ def calculate_soil_health_score(row):
         ph_score = 50 + ((ph - 4.0) / (ph_min - 4.0)) * 50
     else:
         ph_score = 100 - ((ph - ph_max) / (8.5 - ph_max)) * 30
-    
+
     # Moisture optimal range 40-60%
     if 40 <= moisture <= 60:
         moisture_score = 100
@@ -183,19 +198,213 @@ def calculate_soil_health_score(row):
         moisture_score = (moisture / 40) * 100
     else:
         moisture_score = 100 - ((moisture - 60) / 20) * 50
-    
+
     avg_score = (n_score + p_score + k_score + ph_score + moisture_score) / 5
     return round(avg_score, 2)
 
-df['fertilizer_type'] = df.apply(recommend_fertilizer, axis=1)
-df['quantity_kg_per_acre'] = df.apply(calculate_quantity, axis=1)
-df['soil_health_score'] = df.apply(calculate_soil_health_score, axis=1)
-
-# Save to CSV
-df.to_csv(OUTPUT_PATH, index=False)
-print(f"Dataset generated successfully with {len(df)} samples!")
-print(f"Saved to: {OUTPUT_PATH}")
-print(f"\nFertilizer type distribution:")
-print(df['fertilizer_type'].value_counts())
-print(f"\nSoil health score statistics:")
-print(df['soil_health_score'].describe())
+
+# Per-crop lookup arrays for the vectorized rules, indexed by position in CROP_TYPES
+def _balanced_label(crop):
+    crop_info = CROP_PREFERENCES[crop]
+    if crop == 'Soybean' or crop_info.get('needs_balanced'):
+        return 'Organic'
+    return 'Mixed' if crop_info['prefers'] == 'Mixed' else 'Organic'
+
+BALANCED_LABELS = np.array([_balanced_label(crop) for crop in CROP_TYPES], dtype=object)
+BASE_QUANTITIES = np.array([CROP_BASE_QUANTITIES[crop] for crop in CROP_TYPES], dtype=float)
+QUANTITY_MULTIPLIERS = np.array(
+    [1.1 if crop in ['Rice', 'Sugarcane'] else 0.8 if crop == 'Soybean' else 1.0 for crop in CROP_TYPES]
+)
+OPTIMAL_RANGES = {
+    nutrient: np.array([CROP_OPTIMAL_RANGES[crop][nutrient] for crop in CROP_TYPES], dtype=float)
+    for nutrient in ('n', 'p', 'k', 'ph')
+}
+
+_SORTED_CROPS = np.array(sorted(CROP_TYPES))
+_SORTED_TO_CROP = np.array([CROP_TYPES.index(crop) for crop in _SORTED_CROPS])
+
+
+def crop_index(crop_types):
+    """Map crop names to their position in CROP_TYPES"""
+    crops = np.asarray(crop_types, dtype=str)
+    positions = np.searchsorted(_SORTED_CROPS, crops)
+    if not np.array_equal(_SORTED_CROPS[np.minimum(positions, len(_SORTED_CROPS) - 1)], crops):
+        raise ValueError('Unknown crop type in dataset')
+    return _SORTED_TO_CROP[positions]
+
+
+def recommend_fertilizer_vectorized(n, p, k, crop):
+    """Vectorized recommend_fertilizer; crop is an array of CROP_TYPES indices"""
+    balanced = (30 <= n) & (n <= 70) & (25 <= p) & (p <= 60) & (30 <= k) & (k <= 70)
+    conditions = [
+        (n < 30) & (p < 25) & (k < 30),
+        n < 30,
+        (p < 25) & (k < 30),
+        p < 25,
+        k < 30,
+        balanced,
+    ]
+    choices = ['Mixed', 'N', 'Mixed', 'P', 'K', BALANCED_LABELS[crop]]
+    return np.select(conditions, choices, default='Mixed')
+
+
+def calculate_quantity_vectorized(n, p, k, crop):
+    """Vectorized calculate_quantity"""
+    total_deficit = np.maximum(0, 50 - n) + np.maximum(0, 40 - p) + np.maximum(0, 50 - k)
+    quantity = BASE_QUANTITIES[crop] + (total_deficit * 1.5)
+    quantity = quantity * QUANTITY_MULTIPLIERS[crop]
+    return np.minimum(quantity, 200)  # Cap at 200 kg/acre
+
+
+def _nutrient_score(value, low, high):
+    return np.select(
+        [(low <= value) & (value <= high), value < low],
+        [100, (value / low) * 100],
+        np.maximum(70, 100 - ((value - high) / (100 - high)) * 30),
+    )
+
+
+def calculate_soil_health_score_vectorized(n, p, k, ph, moisture, crop):
+    """Vectorized calculate_soil_health_score"""
+    scores = [
+        _nutrient_score(value, OPTIMAL_RANGES[nutrient][crop, 0], OPTIMAL_RANGES[nutrient][crop, 1])
+        for nutrient, value in (('n', n), ('p', p), ('k', k))
+    ]
+
+    ph_min = OPTIMAL_RANGES['ph'][crop, 0]
+    ph_max = OPTIMAL_RANGES['ph'][crop, 1]
+    scores.append(np.select(
+        [(ph_min <= ph) & (ph <= ph_max), ph < ph_min],
+        [100, 50 + ((ph - 4.0) / (ph_min - 4.0)) * 50],
+        100 - ((ph - ph_max) / (8.5 - ph_max)) * 30,
+    ))
+
+    scores.append(np.select(
+        [(40 <= moisture) & (moisture <= 60), moisture < 40],
+        [100, (moisture / 40) * 100],
+        100 - ((moisture - 60) / 20) * 50,
+    ))
+
+    n_score, p_score, k_score, ph_score, moisture_score = scores
+    avg_score = (n_score + p_score + k_score + ph_score + moisture_score) / 5
+    return np.round(avg_score, 2)
+
+
+def sample_features(rng, n_samples):
+    """Draw one chunk of soil readings (same draw order as the original script)"""
+    return pd.DataFrame({
+        'nitrogen': rng.uniform(0, 100, n_samples),
+        'phosphorus': rng.uniform(0, 100, n_samples),
+        'potassium': rng.uniform(0, 100, n_samples),
+        'ph': rng.uniform(4.0, 8.5, n_samples),
+        'moisture': rng.uniform(20, 80, n_samples),
+        'temperature': rng.uniform(15, 35, n_samples),
+        'crop_type': rng.choice(CROP_TYPES, n_samples)
+    })
+
+
+def label_chunk(df):
+    """Add the three label columns to a chunk of features"""
+    n = df['nitrogen'].to_numpy()
+    p = df['phosphorus'].to_numpy()
+    k = df['potassium'].to_numpy()
+    crop = crop_index(df['crop_type'].to_numpy())
+
+    df['fertilizer_type'] = recommend_fertilizer_vectorized(n, p, k, crop)
+    df['quantity_kg_per_acre'] = calculate_quantity_vectorized(n, p, k, crop)
+    df['soil_health_score'] = calculate_soil_health_score_vectorized(
+        n, p, k, df['ph'].to_numpy(), df['moisture'].to_numpy(), crop
+    )
+    return df
+
+
+def generate_chunks(n_samples=DEFAULT_SAMPLES, seed=DEFAULT_SEED, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield labelled DataFrame chunks.
+
+    All random draws come from a single RandomState(seed) stream, one chunk
+    at a time. When n_samples <= chunk_size the output is identical to the
+    original single-shot script for the same seed.
+    """
+    rng = np.random.RandomState(seed)
+    remaining = n_samples
+    while remaining > 0:
+        size = min(chunk_size, remaining)
+        yield label_chunk(sample_features(rng, size))
+        remaining -= size
+
+
+def check_chunk(df, rows=10000):
+    """Compare vectorized labels with the scalar reference rules"""
+    sample = df.head(rows)
+    expected = pd.DataFrame({
+        'fertilizer_type': sample.apply(recommend_fertilizer, axis=1),
+        'quantity_kg_per_acre': sample.apply(calculate_quantity, axis=1),
+        'soil_health_score': sample.apply(calculate_soil_health_score, axis=1),
+    })
+    for column in LABEL_COLUMNS:
+        if not np.array_equal(expected[column].to_numpy(), sample[column].to_numpy()):
+            raise AssertionError(f"Vectorized labels differ from scalar rules in column '{column}'")
+    print(f"[OK] Vectorized labels match scalar rules on {len(sample)} rows")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Generate the synthetic soil/fertilizer dataset')
+    parser.add_argument('--samples', type=int, default=DEFAULT_SAMPLES, help='number of rows to generate')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='random seed')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='rows generated and written per chunk (bounds memory use)')
+    parser.add_argument('--format', choices=FORMATS, default='csv',
+                        help='output format: csv, parquet or npy (directory of memory-mappable arrays)')
+    parser.add_argument('--output', help='output path (defaults to soil_fertilizer_dataset.<format>)')
+    parser.add_argument('--check', action='store_true',
+                        help='verify the first chunk against the scalar reference rules')
+    args = parser.parse_args(argv)
+    if args.samples <= 0 or args.chunk_size <= 0:
+        parser.error('--samples and --chunk-size must be positive')
+    args.output = args.output or DEFAULT_OUTPUTS[args.format]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    total = 0
+    type_counts = pd.Series(dtype='int64')
+    score_sum = 0.0
+    score_sq_sum = 0.0
+    score_min = np.inf
+    score_max = -np.inf
+
+    writer = open_writer(args.output, args.format, args.samples)
+    for index, chunk in enumerate(generate_chunks(args.samples, args.seed, args.chunk_size)):
+        if index == 0 and args.check:
+            check_chunk(chunk)
+
+        # Stream each chunk to disk as soon as it is labelled
+        writer.write(chunk)
+
+        total += len(chunk)
+        type_counts = type_counts.add(chunk['fertilizer_type'].value_counts(), fill_value=0)
+        scores = chunk['soil_health_score'].to_numpy()
+        score_sum += scores.sum()
+        score_sq_sum += np.square(scores).sum()
+        score_min = min(score_min, scores.min())
+        score_max = max(score_max, scores.max())
+        if args.samples > args.chunk_size:
+            print(f"  wrote {total}/{args.samples} rows")
+
+    writer.close()
+
+    mean = score_sum / total
+    std = np.sqrt(max(score_sq_sum / total - mean ** 2, 0) * total / max(total - 1, 1))
+
+    print(f"Dataset generated successfully with {total} samples!")
+    print(f"Saved to: {args.output} ({args.format})")
+    print(f"\nFertilizer type distribution:")
+    print(type_counts.astype('int64').sort_values(ascending=False))
+    print(f"\nSoil health score statistics:")
+    print(f"count {total}\nmean  {mean:.6f}\nstd   {std:.6f}\nmin   {score_min:.2f}\nmax   {score_max:.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+"""
+Gunicorn settings for the AI model service
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master (preload_app) so the model bundle is
+unpickled a single time and forked workers share its memory pages
+copy-on-write instead of each holding a private copy.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+preload_app = True
+timeout = 30
+
+
+def pre_fork(server, worker):
+    # Move everything loaded so far (models included) out of the collector's
+    # reach so garbage collection in workers doesn't dirty the shared pages
+    gc.freeze()
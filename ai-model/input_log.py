@@ -0,0 +1,207 @@
+"""
+Append-only columnar log of the inputs scored by /predict and /predict/batch.
+
+Rows are buffered in memory and written to INPUT_LOG_DIR as immutable
+segments, one uncompressed ``.npz`` archive of column arrays per flush:
+
+- ``features``: float64 (n, 6) readings in model feature order
+- ``crop_codes``: int8 position in CROP_CLASSES, -1 for unknown crops
+- ``fertilizer_codes``: int8 predicted type, position in FERTILIZER_CLASSES
+- ``quantities``, ``health_scores``: float32 raw model outputs
+- ``logged_at``: float64 unix time of each row
+
+Segment names start with a nanosecond timestamp, so sorted names are in write
+order and a reader can resume after the last segment it has seen. Segments
+are written under a temporary name and renamed, so readers never see a
+partial one. The timestamp is taken once the data is written, right before
+the rename, and readers that keep a position skip segments stamped in the
+last ``SETTLE_SECONDS``: a segment another process is still renaming can't
+appear behind a position that was already recorded. Segments are written by a background thread, so a request only
+pays for buffering its rows. retrain.py reads the log back with
+``iter_segments``.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from dataset_io import CROP_CLASSES, FERTILIZER_CLASSES
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.npz'
+# Age a segment's timestamp must reach before position-keeping readers take it
+SETTLE_SECONDS = 5.0
+
+_CROP_CLASSES = np.asarray(CROP_CLASSES)
+_FERTILIZER_CLASSES = np.asarray(FERTILIZER_CLASSES)
+
+
+def class_codes(labels, classes):
+    """Positions of labels in a sorted class array, -1 for anything else"""
+    labels = np.asarray([label if isinstance(label, str) else '' for label in labels], dtype=str)
+    positions = np.minimum(np.searchsorted(classes, labels), len(classes) - 1)
+    return np.where(classes[positions] == labels, positions, -1).astype(np.int8)
+
+
+class InputLog:
+    """Thread-safe buffered writer of input log segments; a falsy directory disables it.
+
+    A segment is due once ``flush_rows`` rows are buffered or the oldest
+    buffered row is ``flush_seconds`` old (checked when rows are recorded),
+    and at interpreter exit. Due segments are queued for a writer thread, which
+    writes them one at a time in order. ``sample_rate`` logs only that
+    fraction of rows.
+    """
+
+    def __init__(self, directory, flush_rows=1000, flush_seconds=60.0, sample_rate=1.0):
+        self.directory = directory
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+        self.sample_rate = sample_rate
+        self.rows_logged = 0
+        self.segments_written = 0
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._buffered = 0
+        self._first_buffered_at = None
+        self._sequence = 0
+        self._rng = np.random.default_rng()
+        self._pending = queue.Queue()
+        self._writer_pid = None
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            atexit.register(self.flush)
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and self.sample_rate > 0
+
+    def record(self, numeric, crop_types, fertilizer_types, quantities, health_scores):
+        """Buffer a batch of scored rows (readings, crop names and raw model outputs)"""
+        if not self.enabled:
+            return
+        now = time.time()
+        chunk = {
+            'features': np.asarray(numeric, dtype=float).reshape(-1, 6),
+            'crop_codes': class_codes(crop_types, _CROP_CLASSES),
+            'fertilizer_codes': class_codes(fertilizer_types, _FERTILIZER_CLASSES),
+            'quantities': np.asarray(quantities, dtype=np.float32),
+            'health_scores': np.asarray(health_scores, dtype=np.float32),
+        }
+        with self._lock:
+            if self.sample_rate < 1:
+                keep = self._rng.random(len(chunk['features'])) < self.sample_rate
+                chunk = {name: column[keep] for name, column in chunk.items()}
+            rows = len(chunk['features'])
+            if rows:
+                chunk['logged_at'] = np.full(rows, now)
+                self._chunks.append(chunk)
+                self._buffered += rows
+                if self._first_buffered_at is None:
+                    self._first_buffered_at = now
+            due = self._buffered >= self.flush_rows or (
+                self._first_buffered_at is not None and now - self._first_buffered_at >= self.flush_seconds)
+            if due:
+                self._queue_segment()
+
+    def flush(self):
+        """Write whatever is buffered as a segment and wait until every queued segment is written"""
+        with self._lock:
+            self._queue_segment()
+        if self._writer_pid == os.getpid():
+            self._pending.join()
+
+    def _queue_segment(self):
+        # Called with the lock held, so segments are queued in sequence order
+        chunks = self._chunks
+        if not chunks:
+            return
+        self._chunks = []
+        self._buffered = 0
+        self._first_buffered_at = None
+        self._sequence += 1
+        self._ensure_writer()
+        self._pending.put((self._sequence, chunks))
+
+    def _ensure_writer(self):
+        # Threads don't survive a fork, so each worker process starts its own
+        if self._writer_pid != os.getpid():
+            self._writer_pid = os.getpid()
+            # Segments queued before a fork belong to the parent, which writes them
+            self._pending = queue.Queue()
+            threading.Thread(target=self._write_forever, name='input-log-writer', daemon=True).start()
+
+    def _write_forever(self):
+        while True:
+            sequence, chunks = self._pending.get()
+            try:
+                self._write(sequence, chunks)
+            except Exception as e:
+                print(f"Warning: could not write input log segment: {e}")
+            self._pending.task_done()
+
+    def _write(self, sequence, chunks):
+        columns = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+        # The pid and a per-process sequence keep names unique across forked workers
+        suffix = f'-{os.getpid()}-{sequence}{SEGMENT_SUFFIX}'
+        tmp_path = os.path.join(self.directory, f'{SEGMENT_PREFIX}pending{suffix}.tmp')
+        path = tmp_path
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **columns)
+            # Stamped after the slow write, so the name is at most a rename older than the segment
+            path = os.path.join(self.directory, f'{SEGMENT_PREFIX}{time.time_ns():020d}{suffix}')
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # Logging must never fail a prediction
+            print(f"Warning: could not write input log segment {path}: {e}")
+            return
+        self.rows_logged += len(columns['features'])
+        self.segments_written += 1
+
+
+def input_log_from_env():
+    """Build an input log from INPUT_LOG_DIR / _FLUSH_ROWS / _FLUSH_SECONDS / _SAMPLE_RATE"""
+    return InputLog(
+        directory=os.getenv('INPUT_LOG_DIR'),
+        flush_rows=int(os.getenv('INPUT_LOG_FLUSH_ROWS', 1000)),
+        flush_seconds=float(os.getenv('INPUT_LOG_FLUSH_SECONDS', 60)),
+        sample_rate=float(os.getenv('INPUT_LOG_SAMPLE_RATE', 1.0)),
+    )
+
+
+def segment_time_ns(name):
+    """Nanosecond timestamp a segment name starts with"""
+    return int(name[len(SEGMENT_PREFIX):].split('-', 1)[0])
+
+
+def list_segments(directory, after=None, settle_seconds=0):
+    """Names of the complete segments in write order, optionally only those after a given name.
+
+    ``settle_seconds`` leaves out segments stamped less than that long ago.
+    """
+    if not directory or not os.path.isdir(directory):
+        return []
+    names = sorted(name for name in os.listdir(directory)
+                   if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+    if after:
+        names = [name for name in names if name > after]
+    if settle_seconds:
+        settled = time.time_ns() - int(settle_seconds * 1e9)
+        names = [name for name in names if segment_time_ns(name) < settled]
+    return names
+
+
+def read_segment(path):
+    """Column arrays of one segment"""
+    with np.load(path) as archive:
+        return {name: archive[name] for name in archive.files}
+
+
+def iter_segments(directory, after=None, settle_seconds=0):
+    """Yield (name, columns) for each segment, oldest first"""
+    for name in list_segments(directory, after, settle_seconds):
+        yield name, read_segment(os.path.join(directory, name))
@@ -0,0 +1,295 @@
+"""
+Precomputed lookup grid of model outputs for the prediction hot path.
+
+The model inputs are bounded (the ranges generate_dataset.py samples from),
+so the three model outputs can be precomputed once per crop over a regular
+grid and answered later by indexing instead of walking 300 trees:
+
+    python lookup_grid.py build model.pkl lookup_grid/ --points 11,11,11,10,7,5
+    python lookup_grid.py check lookup_grid/ model.pkl --mode linear
+
+The grid is a directory of .npy arrays (memory-mapped at load time) plus a
+meta.json with the axes, class labels and the fingerprint of the bundle it
+was built from. ``nearest`` returns the closest grid point; ``linear``
+interpolates quantity and health score between the 64 surrounding points and
+only answers rows whose surrounding points all agree on the fertilizer type.
+Rows outside the grid's ranges, and in linear mode rows near a change of
+type, are left to the real models.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# (feature, low, high) in model feature order, the ranges of the generated training data
+GRID_AXES = (
+    ('nitrogen', 0.0, 100.0),
+    ('phosphorus', 0.0, 100.0),
+    ('potassium', 0.0, 100.0),
+    ('ph', 4.0, 8.5),
+    ('moisture', 20.0, 80.0),
+    ('temperature', 15.0, 35.0),
+)
+DEFAULT_POINTS = (11, 11, 11, 10, 7, 5)
+MODES = ('nearest', 'linear')
+META_FILE = 'meta.json'
+# Grid points scored per model call while building
+BUILD_CHUNK_ROWS = 200000
+
+# Offsets of the 2**6 corners of a grid cell, for multilinear interpolation
+_CORNERS = np.array(list(itertools.product((0, 1), repeat=len(GRID_AXES))), dtype=np.intp)
+
+
+class LookupGrid:
+    """Model outputs on a regular grid per crop code, shape (n_crops, *points)"""
+
+    def __init__(self, fertilizer_codes, quantities, health_scores, low, high, fertilizer_classes,
+                 fingerprint, mode='linear'):
+        if mode not in MODES:
+            raise ValueError(f"Unknown lookup mode '{mode}', expected one of {MODES}")
+        self.fertilizer_codes = fertilizer_codes
+        self.quantities = quantities
+        self.health_scores = health_scores
+        self.low = np.asarray(low, dtype=float)
+        self.high = np.asarray(high, dtype=float)
+        self.points = np.asarray(quantities.shape[1:], dtype=np.intp)
+        self.step = (self.high - self.low) / (self.points - 1)
+        self.fertilizer_classes = np.asarray(fertilizer_classes, dtype=object)
+        self.fingerprint = fingerprint
+        self.mode = mode
+
+    @property
+    def n_crops(self):
+        return self.quantities.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.fertilizer_codes.nbytes + self.quantities.nbytes + self.health_scores.nbytes
+
+    def covers(self, features):
+        """Boolean mask of the rows whose readings and crop code lie inside the grid"""
+        values = features[:, :len(GRID_AXES)]
+        crops = features[:, len(GRID_AXES)]
+        return ((values >= self.low) & (values <= self.high)).all(axis=1) & (crops >= 0) & (crops < self.n_crops)
+
+    def _positions(self, features):
+        """Crop index and fractional grid coordinates of each row"""
+        crops = features[:, len(GRID_AXES)].astype(np.intp)
+        coords = (features[:, :len(GRID_AXES)] - self.low) / self.step
+        return crops, np.clip(coords, 0, self.points - 1)
+
+    def _flat_index(self, crops, cells):
+        return np.ravel_multi_index((crops, *cells.T), self.quantities.shape)
+
+    def lookup(self, features):
+        """(answered, fertilizer_types, quantities, health_scores) for any feature matrix.
+
+        ``answered`` marks the rows the grid serves: inside its ranges and, in
+        linear mode, with one fertilizer type on every surrounding point. The
+        other rows' outputs are left empty for the models to fill.
+        """
+        features = np.asarray(features, dtype=float)
+        answered = self.covers(features)
+        fertilizer_types = np.empty(len(features), dtype=object)
+        quantities = np.empty(len(features))
+        health_scores = np.empty(len(features))
+        if answered.any():
+            types, row_quantities, row_health, consistent = self._predict(features[answered])
+            fertilizer_types[answered], quantities[answered], health_scores[answered] = (
+                types, row_quantities, row_health)
+            answered[answered] = consistent
+        return answered, fertilizer_types, quantities, health_scores
+
+    def predict(self, features):
+        """(fertilizer_types, quantities, health_scores) for rows that ``covers`` accepts"""
+        return self._predict(np.asarray(features, dtype=float))[:3]
+
+    def _predict(self, features):
+        # Also returns whether each row's type is the same on every point the mode reads
+        crops, coords = self._positions(features)
+        nearest = self._flat_index(crops, np.rint(coords).astype(np.intp))
+        codes = self.fertilizer_codes.reshape(-1)
+        fertilizer_types = self.fertilizer_classes.take(codes[nearest])
+        if self.mode == 'nearest':
+            return (fertilizer_types,
+                    self.quantities.reshape(-1)[nearest].astype(float),
+                    self.health_scores.reshape(-1)[nearest].astype(float),
+                    np.ones(len(features), dtype=bool))
+
+        # Lower cell corner, kept one below the last point so the upper corner exists
+        base = np.minimum(np.floor(coords).astype(np.intp), self.points - 2)
+        fraction = coords - base
+        corners = base[:, None, :] + _CORNERS[None, :, :]
+        weights = np.where(_CORNERS[None, :, :] == 1, fraction[:, None, :], 1 - fraction[:, None, :]).prod(axis=2)
+        index = np.ravel_multi_index(
+            (np.repeat(crops[:, None], len(_CORNERS), axis=1), *np.moveaxis(corners, 2, 0)),
+            self.quantities.shape,
+        )
+        quantities = (self.quantities.reshape(-1)[index] * weights).sum(axis=1)
+        health_scores = (self.health_scores.reshape(-1)[index] * weights).sum(axis=1)
+        corner_codes = codes[index]
+        consistent = (corner_codes == corner_codes[:, :1]).all(axis=1)
+        return fertilizer_types, quantities, health_scores, consistent
+
+
+def grid_coordinates(low, high, points):
+    return [np.linspace(lo, hi, n) for lo, hi, n in zip(low, high, points)]
+
+
+def build_grid(model_set, output_dir, points=DEFAULT_POINTS, chunk_rows=BUILD_CHUNK_ROWS):
+    """Score every grid point of every crop with the bundle's models and save the arrays"""
+    from model_store import FERTILIZER_TYPES
+
+    os.makedirs(output_dir, exist_ok=True)
+    low = [lo for _, lo, _ in GRID_AXES]
+    high = [hi for _, _, hi in GRID_AXES]
+    fertilizer_classes = np.array(sorted(FERTILIZER_TYPES))
+    n_crops = len(model_set.label_encoder.classes_)
+    shape = (n_crops, *points)
+
+    open_memmap = np.lib.format.open_memmap
+    arrays = {
+        'fertilizer_codes': open_memmap(os.path.join(output_dir, 'fertilizer_codes.npy'), mode='w+', dtype=np.int8, shape=shape),
+        'quantities': open_memmap(os.path.join(output_dir, 'quantities.npy'), mode='w+', dtype=np.float32, shape=shape),
+        'health_scores': open_memmap(os.path.join(output_dir, 'health_scores.npy'), mode='w+', dtype=np.float32, shape=shape),
+    }
+    axes = grid_coordinates(low, high, points)
+    per_crop = int(np.prod(points))
+    for crop in range(n_crops):
+        for start in range(0, per_crop, chunk_rows):
+            flat = np.arange(start, min(start + chunk_rows, per_crop))
+            cells = np.unravel_index(flat, points)
+            features = np.column_stack([axis[cell] for axis, cell in zip(axes, cells)] + [np.full(len(flat), crop)])
+            fertilizer_types, quantities, health_scores = model_set.predict(features)
+            arrays['fertilizer_codes'][crop].reshape(-1)[flat] = np.searchsorted(
+                fertilizer_classes, np.asarray(fertilizer_types, dtype=str))
+            arrays['quantities'][crop].reshape(-1)[flat] = quantities
+            arrays['health_scores'][crop].reshape(-1)[flat] = health_scores
+        print(f"  {model_set.label_encoder.classes_[crop]}: {per_crop:,} points", flush=True)
+
+    for array in arrays.values():
+        array.flush()
+    meta = {
+        'axes': [name for name, _, _ in GRID_AXES],
+        'low': low,
+        'high': high,
+        'points': list(points),
+        'crop_classes': [str(crop) for crop in model_set.label_encoder.classes_],
+        'fertilizer_classes': fertilizer_classes.tolist(),
+        'model_fingerprint': model_set.fingerprint,
+    }
+    with open(os.path.join(output_dir, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def load_grid(grid_dir, mode='linear', mmap=True):
+    """Open a grid directory; the arrays are memory-mapped read-only unless mmap=False"""
+    with open(os.path.join(grid_dir, META_FILE)) as f:
+        meta = json.load(f)
+    arrays = [np.load(os.path.join(grid_dir, f'{name}.npy'), mmap_mode='r' if mmap else None)
+              for name in ('fertilizer_codes', 'quantities', 'health_scores')]
+    return LookupGrid(*arrays, low=meta['low'], high=meta['high'],
+                      fertilizer_classes=meta['fertilizer_classes'],
+                      fingerprint=meta['model_fingerprint'], mode=mode)
+
+
+def attach_grid(model_set, grid_dir, mode='linear'):
+    """Return a copy of a ModelSet that answers in-range rows from the grid.
+
+    Raises ValueError if the grid was built from a different bundle.
+    """
+    grid = load_grid(grid_dir, mode)
+    if grid.fingerprint != model_set.fingerprint:
+        raise ValueError(f'{grid_dir} was built from model {grid.fingerprint[:12]}, '
+                         f'the loaded model is {model_set.fingerprint[:12]}')
+    return model_set._replace(lookup_grid=grid)
+
+
+def deviation_report(model_set, grid, n_samples=20000, seed=0):
+    """Compare what a ModelSet with the grid serves with the real models on random in-range rows"""
+    from tree_engine import parity_samples
+
+    features = parity_samples(model_set.label_encoder, n_samples, seed)
+    expected_types, expected_quantities, expected_health = model_set.predict(features)
+    with_grid = model_set._replace(lookup_grid=grid)
+
+    started = time.perf_counter()
+    answered = grid.lookup(features)[0]
+    types, quantities, health_scores = with_grid.predict(features)
+    served_seconds = time.perf_counter() - started
+
+    single = features[:1]
+    rounds = 200
+    timings = {}
+    for name, predict in (('grid', grid.lookup), ('model', model_set.predict)):
+        predict(single)
+        started = time.perf_counter()
+        for _ in range(rounds):
+            predict(single)
+        timings[name] = (time.perf_counter() - started) / rounds * 1e6
+
+    quantity_error = np.abs(quantities - np.asarray(expected_quantities, dtype=float))
+    health_error = np.abs(health_scores - np.asarray(expected_health, dtype=float))
+    return {
+        'mode': grid.mode,
+        'samples': n_samples,
+        'grid_answered_rate': float(answered.mean()),
+        'type_mismatch_rate': float(np.mean(np.asarray(types, dtype=str) != np.asarray(expected_types, dtype=str))),
+        'quantity_max_abs_error': float(quantity_error.max()),
+        'quantity_mean_abs_error': float(quantity_error.mean()),
+        'health_max_abs_error': float(health_error.max()),
+        'health_mean_abs_error': float(health_error.mean()),
+        'grid_single_us': timings['grid'],
+        'model_single_us': timings['model'],
+        'served_rows_per_s': n_samples / served_seconds,
+        'grid_mb': grid.nbytes / 2**20,
+    }
+
+
+def main(argv=None):
+    from model_store import read_model_set, validate_model_set
+
+    parser = argparse.ArgumentParser(description='Precompute and check the model output lookup grid')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='score every grid point and save the grid')
+    build.add_argument('bundle')
+    build.add_argument('output_dir')
+    build.add_argument('--points', type=lambda s: tuple(int(v) for v in s.split(',')), default=DEFAULT_POINTS,
+                       help='grid points per axis (' + ','.join(name for name, _, _ in GRID_AXES) + ')')
+    check = commands.add_parser('check', help='report the deviation from the real models')
+    check.add_argument('grid_dir')
+    check.add_argument('bundle')
+    check.add_argument('--mode', choices=MODES, nargs='+', default=list(MODES))
+    check.add_argument('--samples', type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    model_set = read_model_set(args.bundle, base_dir)
+    validate_model_set(model_set)
+
+    if args.command == 'build':
+        if len(args.points) != len(GRID_AXES) or min(args.points) < 2:
+            parser.error(f'--points needs {len(GRID_AXES)} values of at least 2')
+        started = time.perf_counter()
+        build_grid(model_set, args.output_dir, args.points)
+        grid = load_grid(args.output_dir)
+        print(f"[OK] Built {args.output_dir}: {grid.n_crops} crops x {'x'.join(map(str, args.points))} points, "
+              f"{grid.nbytes / 2**20:.1f} MB in {time.perf_counter() - started:.1f}s")
+        return 0
+
+    for mode in args.mode:
+        grid = load_grid(args.grid_dir, mode)
+        if grid.fingerprint != model_set.fingerprint:
+            print(f"Warning: grid was built from model {grid.fingerprint[:12]}, not {model_set.fingerprint[:12]}")
+        report = deviation_report(model_set, grid, args.samples)
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""
+Minimal in-process metrics with Prometheus text exposition.
+
+Counters and histograms are labelled and thread-safe; values owned by other
+components (cache statistics, memory) are read from callbacks when /metrics
+is scraped. ``SlowRequestProfiler`` runs a sampled
+fraction of requests under cProfile and keeps the profiles of slow ones.
+"""
+import bisect
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from 50us (flat engine, rule layer) to 10s (huge batches)
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            bucket = bisect.bisect_left(self.buckets, value)
+            if bucket < len(self.buckets):
+                series[0][bucket] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    bucket_labels = _format_labels(self.labelnames, labels, [('le', _format_value(bound))])
+                    lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+                inf_labels = _format_labels(self.labelnames, labels, [('le', '+Inf')])
+                lines.append(f'{self.name}_bucket{inf_labels} {count}')
+                label_text = _format_labels(self.labelnames, labels)
+                lines.append(f'{self.name}_sum{label_text} {_format_value(total)}')
+                lines.append(f'{self.name}_count{label_text} {count}')
+        return lines
+
+
+class CallbackMetric:
+    """Gauge or counter read at scrape time from a callback returning [(label_values, value), ...]"""
+
+    def __init__(self, name, documentation, labelnames, callback, metric_type='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self.metric_type = metric_type
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.metric_type}']
+        for labels, value in self.callback():
+            if value is None:
+                continue
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, labelnames, callback, metric_type='gauge'):
+        return self.register(CallbackMetric(name, documentation, labelnames, callback, metric_type))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class SlowRequestProfiler:
+    """Profile a sampled fraction of requests and dump the ones slower than a threshold.
+
+    Only one request is profiled at a time, other sampled requests run
+    unprofiled while a profile is in progress.
+    """
+
+    def __init__(self, slow_ms=0, sample_rate=0.0, directory=None, max_dumps=100):
+        self.slow_seconds = slow_ms / 1000
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.max_dumps = max_dumps
+        self.dumped = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.slow_seconds > 0 and self.sample_rate > 0 and self.directory is not None
+
+    @contextmanager
+    def maybe_profile(self, name):
+        if (not self.enabled or self.dumped >= self.max_dumps or random.random() >= self.sample_rate
+                or not self._lock.acquire(blocking=False)):
+            yield
+            return
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+            elapsed = time.perf_counter() - started
+            if elapsed >= self.slow_seconds:
+                os.makedirs(self.directory, exist_ok=True)
+                filename = f'{name}-{time.strftime("%Y%m%dT%H%M%S")}-{int(elapsed * 1000)}ms-{os.getpid()}-{self.dumped}.prof'
+                profiler.dump_stats(os.path.join(self.directory, filename))
+                self.dumped += 1
+        finally:
+            self._lock.release()
+
+
+@contextmanager
+def no_stage(name):
+    """Stage timer that records nothing, for callers without metrics"""
+    yield
@@ -0,0 +1,206 @@
+"""
+Named model bundles served side by side by one process.
+
+``ModelRegistry`` maps names (regions, crops, ...) to bundle paths and loads
+each bundle on its first request. Loaded bundles are kept in least recently
+used order. When their estimated memory exceeds ``max_bytes``, the least
+recently used ones are dropped and reload on their next request. Requests
+that already hold a dropped ModelSet keep using it until they finish.
+
+Bundles are identified by content hash. Names whose files have identical
+contents share one ModelSet, and a name whose file matches a bundle the
+service already holds (``resident``) reuses that ModelSet, so a copied
+bundle costs no extra memory. The hash is also the ModelSet fingerprint, so
+the prediction cache never mixes entries of different bundles.
+
+MODEL_BUNDLES configures the registry as comma-separated ``name=path``
+pairs, with paths relative to the service directory:
+
+    MODEL_BUNDLES="north=models/north.pkl,south=models/south.pkl"
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import joblib
+
+from model_store import model_set_from_bundle, validate_model_set
+from prediction_cache import file_fingerprint
+
+
+def parse_bundle_paths(spec, base_dir):
+    """{name: absolute path} from a "name=path,name=path" spec"""
+    paths = {}
+    for entry in (spec or '').split(','):
+        if not entry.strip():
+            continue
+        name, separator, path = entry.partition('=')
+        if not separator or not name.strip() or not path.strip():
+            raise ValueError(f"Invalid MODEL_BUNDLES entry '{entry}', expected name=path")
+        paths[name.strip()] = os.path.join(base_dir, path.strip())
+    return paths
+
+
+def model_set_bytes(path, model_set):
+    """Memory estimate of a loaded bundle: its file size plus any flat-engine copies of the models"""
+    size = os.path.getsize(path)
+    if model_set.engine == 'flat':
+        size += sum(model.nbytes for model in model_set.flat_models)
+    return size
+
+
+class RegistryEntry:
+    """One loaded bundle, shared by every name whose file has the same content hash"""
+
+    def __init__(self, model_set, size):
+        self.model_set = model_set
+        self.size = size
+        self.names = set()
+        self.last_used = time.time()
+
+
+class ModelRegistry:
+    """Lazily loaded named bundles with LRU eviction under a memory cap.
+
+    ``prepare(model_set)`` finishes a freshly loaded ModelSet (e.g. compiles
+    the flat engine) the same way the default bundle is prepared.
+    ``resident()`` returns ModelSets loaded outside the registry, which are
+    reused for names with the same contents and not counted against the cap.
+    A ``max_bytes`` of 0 never evicts.
+    """
+
+    def __init__(self, paths, prepare=None, max_bytes=0, mmap_mode=None, resident=None):
+        self.paths = dict(paths)
+        self.prepare = prepare
+        self.resident = resident
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+        self.loads = 0
+        self.evictions = 0
+        self.deduplicated = 0
+        self._lock = threading.Lock()
+        # One lock per name, so a slow load only blocks requests for that bundle
+        self._load_locks = {name: threading.Lock() for name in self.paths}
+        # Content hash -> RegistryEntry, least recently used first
+        self._entries = OrderedDict()
+        self._names = {}
+
+    @property
+    def enabled(self):
+        return bool(self.paths)
+
+    def get(self, name):
+        """The ModelSet of a named bundle, loading it if needed; None if it fails to load.
+
+        Raises KeyError for names that are not configured.
+        """
+        if name not in self.paths:
+            raise KeyError(name)
+        model_set = self._lookup(name)
+        if model_set is not None:
+            return model_set
+        with self._load_locks[name]:
+            model_set = self._lookup(name)
+            if model_set is None:
+                model_set = self._load(name)
+        return model_set
+
+    def _lookup(self, name):
+        with self._lock:
+            fingerprint = self._names.get(name)
+            if fingerprint is None:
+                return None
+            entry = self._entries[fingerprint]
+            self._entries.move_to_end(fingerprint)
+            entry.last_used = time.time()
+            return entry.model_set
+
+    def _load(self, name):
+        path = self.paths[name]
+        try:
+            fingerprint = file_fingerprint(path)
+            with self._lock:
+                entry = self._entries.get(fingerprint)
+                if entry is not None:
+                    # Same contents as a bundle that is already loaded under another name
+                    self.deduplicated += 1
+                    return self._attach(name, fingerprint, entry)
+
+            shared = self._resident(fingerprint)
+            if shared is not None:
+                with self._lock:
+                    self.deduplicated += 1
+                    entry = self._entries.setdefault(fingerprint, RegistryEntry(shared, 0))
+                    return self._attach(name, fingerprint, entry)
+
+            print(f"Loading model bundle '{name}' from {path} ...")
+            model_set = model_set_from_bundle(joblib.load(path, mmap_mode=self.mmap_mode), fingerprint, path)
+            validate_model_set(model_set)
+            if self.prepare is not None:
+                model_set = self.prepare(model_set)
+            entry = RegistryEntry(model_set, model_set_bytes(path, model_set))
+        except Exception as e:
+            print(f"Error loading model bundle '{name}': {e}")
+            return None
+
+        with self._lock:
+            # Another name may have loaded the same contents meanwhile
+            entry = self._entries.setdefault(fingerprint, entry)
+            self.loads += 1
+            model_set = self._attach(name, fingerprint, entry)
+            self._evict()
+        print(f"[OK] Model bundle '{name}' loaded ({entry.size / 2**20:.1f} MB)")
+        return model_set
+
+    def _resident(self, fingerprint):
+        if self.resident is None:
+            return None
+        for model_set in self.resident():
+            if model_set is not None and model_set.fingerprint == fingerprint:
+                return model_set
+        return None
+
+    def _attach(self, name, fingerprint, entry):
+        entry.names.add(name)
+        entry.last_used = time.time()
+        self._names[name] = fingerprint
+        self._entries.move_to_end(fingerprint)
+        return entry.model_set
+
+    def _evict(self):
+        # The most recently used bundle always stays, even if it alone exceeds the cap
+        while self.max_bytes and len(self._entries) > 1 and self.loaded_bytes() > self.max_bytes:
+            fingerprint, entry = self._entries.popitem(last=False)
+            for name in entry.names:
+                del self._names[name]
+            self.evictions += 1
+            print(f"Evicted model bundle {sorted(entry.names)} ({entry.size / 2**20:.1f} MB)")
+
+    def loaded_bytes(self):
+        return sum(entry.size for entry in self._entries.values())
+
+    def fingerprints(self):
+        """Content hashes of the loaded bundles"""
+        with self._lock:
+            return set(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'bundles': sorted(self.paths),
+                'loaded': {
+                    name: {
+                        'model_version': fingerprint[:12],
+                        'engine': self._entries[fingerprint].model_set.engine,
+                        'size_mb': round(self._entries[fingerprint].size / 2**20, 1),
+                        'idle_seconds': round(time.time() - self._entries[fingerprint].last_used, 1),
+                    }
+                    for name, fingerprint in sorted(self._names.items())
+                },
+                'loaded_mb': round(self.loaded_bytes() / 2**20, 1),
+                'max_mb': round(self.max_bytes / 2**20, 1) if self.max_bytes else None,
+                'loads': self.loads,
+                'evictions': self.evictions,
+                'deduplicated': self.deduplicated,
+            }
@@ -0,0 +1,250 @@
+"""
+Loading and validation of model bundles.
+
+A loaded bundle is held in a single immutable ModelSet, so the service can
+swap a whole set of models with one reference assignment. Requests that
+already hold the previous ModelSet keep using it until they finish.
+
+Bundles record their layout under the 'layout' key:
+
+- 'separate' (the default for bundles without the key): three independent
+  estimators, 'fertilizer_model', 'quantity_model' and 'health_model'.
+- 'fused': one multi-output forest ('fused_model') predicting standardized
+  fertilizer-type indicators, quantity and health score in a single pass,
+  plus 'fertilizer_classes', 'target_mean' and 'target_scale'.
+- 'compact': written by compact_model.py. 'models' maps each model field of
+  the 'model_layout' ('separate' or 'fused') to reduced-precision flat tree
+  arrays (see FlatForest.to_compact_arrays); a fused bundle also keeps its
+  class and target scaling entries. No scikit-learn objects are unpickled.
+"""
+import functools
+import os
+import time
+from typing import Any, NamedTuple
+
+import joblib
+import numpy as np
+
+from metrics import no_stage
+from prediction_cache import file_fingerprint
+from tree_engine import FlatForest
+
+LEGACY_MODEL_FILES = (
+    'fertilizer_type_model.pkl',
+    'fertilizer_quantity_model.pkl',
+    'soil_health_model.pkl',
+    'label_encoder.pkl',
+)
+
+FERTILIZER_TYPES = {'N', 'P', 'K', 'Organic', 'Mixed'}
+
+# Probe readings used to validate a bundle before it is swapped in
+VALIDATION_SAMPLES = np.array([
+    [45, 30, 35, 6.5, 55, 25],
+    [10, 10, 10, 5.0, 30, 18],
+    [90, 80, 85, 8.0, 75, 33],
+    [50, 50, 50, 7.0, 50, 25],
+], dtype=float)
+
+
+LAYOUTS = ('separate', 'fused')
+
+# Request fields in model feature order, with the defaults used for missing values.
+# The encoded crop type is appended as the last model feature.
+FEATURE_FIELDS = (
+    ('nitrogen', 0),
+    ('phosphorus', 0),
+    ('potassium', 0),
+    ('ph', 7.0),
+    ('moisture', 50),
+    ('temperature', 25),
+)
+DEFAULT_CROP_TYPE = 'Wheat'
+
+
+@functools.lru_cache(maxsize=8)
+def crop_code_table(classes):
+    """Dict from crop name to encoded value for a tuple of label encoder classes"""
+    return {crop: code for code, crop in enumerate(classes)}
+
+
+class FusedModel:
+    """Multi-output forest that predicts all three targets in one traversal.
+
+    The forest is trained on standardized targets: one indicator column per
+    fertilizer class followed by quantity and health score. Predictions are
+    mapped back to the original scale; the fertilizer type is the class with
+    the highest indicator.
+    """
+
+    def __init__(self, forest, fertilizer_classes, target_mean, target_scale):
+        self.forest = forest
+        self.fertilizer_classes = np.asarray(fertilizer_classes, dtype=object)
+        self.target_mean = np.asarray(target_mean, dtype=float)
+        self.target_scale = np.asarray(target_scale, dtype=float)
+
+    @classmethod
+    def from_bundle(cls, bundle):
+        return cls(bundle['fused_model'], bundle['fertilizer_classes'],
+                   bundle['target_mean'], bundle['target_scale'])
+
+    def with_forest(self, forest):
+        return FusedModel(forest, self.fertilizer_classes, self.target_mean, self.target_scale)
+
+    def predict_all(self, features):
+        raw = self.forest.predict(features) * self.target_scale + self.target_mean
+        n_classes = len(self.fertilizer_classes)
+        fertilizer_types = self.fertilizer_classes.take(np.argmax(raw[:, :n_classes], axis=1))
+        return fertilizer_types, raw[:, n_classes], raw[:, n_classes + 1]
+
+
+class ModelSet(NamedTuple):
+    """The models of one bundle plus where they came from"""
+    fertilizer_model: Any
+    quantity_model: Any
+    health_model: Any
+    label_encoder: Any
+    fingerprint: str
+    source: str
+    loaded_at: float
+    engine: str = 'sklearn'
+    # FlatForest versions of the three models (see tree_engine.py), used for
+    # batches of up to flat_max_rows rows where they beat scikit-learn's overhead
+    flat_models: Any = None
+    flat_max_rows: int = 0
+    layout: str = 'separate'
+    fused_model: Any = None
+    # LookupGrid of precomputed outputs (see lookup_grid.py) that answers rows
+    # inside its ranges; the models only score the rest
+    lookup_grid: Any = None
+    # metadata['version'] of the bundle, counted up by every retrain.py run
+    bundle_version: Any = None
+
+    def encode_crop_types(self, crop_types):
+        """Encode crop names through a prebuilt dict (unknown crops map to 0)"""
+        codes = crop_code_table(tuple(self.label_encoder.classes_.tolist()))
+        return np.fromiter((codes.get(crop, 0) for crop in crop_types), dtype=np.intp, count=len(crop_types))
+
+    def active_models(self, n_rows):
+        """Predictors used for a batch of n_rows: (fused,) or (fertilizer, quantity, health)"""
+        use_flat = self.flat_models is not None and n_rows <= self.flat_max_rows
+        if self.fused_model is not None:
+            return (self.flat_models[0] if use_flat else self.fused_model,)
+        if use_flat:
+            return self.flat_models
+        return self.fertilizer_model, self.quantity_model, self.health_model
+
+    def predict(self, features, stage=no_stage):
+        """Run each model once over a feature matrix, timing each call with ``stage(name)``"""
+        if self.lookup_grid is None:
+            return self._predict_models(features, stage)
+
+        with stage('lookup_grid'):
+            answered, fertilizer_types, quantities, health_scores = self.lookup_grid.lookup(features)
+        if answered.all():
+            return fertilizer_types, quantities, health_scores
+        # Rows outside the grid, or too close to a change of fertilizer type, go to the models
+        missing = ~answered
+        fertilizer_types[missing], quantities[missing], health_scores[missing] = (
+            self._predict_models(features[missing], stage))
+        return fertilizer_types, quantities, health_scores
+
+    def _predict_models(self, features, stage=no_stage):
+        predictors = self.active_models(len(features))
+        if self.fused_model is not None:
+            with stage('fused_model'):
+                return predictors[0].predict_all(features)
+
+        fertilizer_model, quantity_model, health_model = predictors
+        with stage('fertilizer_model'):
+            fertilizer_types = fertilizer_model.predict(features)
+        with stage('quantity_model'):
+            quantities = quantity_model.predict(features)
+        with stage('health_model'):
+            health_scores = health_model.predict(features)
+        return fertilizer_types, quantities, health_scores
+
+
+def read_model_set(bundle_path, legacy_dir, mmap_mode=None):
+    """Load a ModelSet from a model.pkl bundle, or from the legacy individual files"""
+    if os.path.exists(bundle_path):
+        print(f"Loading bundled models from {bundle_path} ...")
+        bundle = joblib.load(bundle_path, mmap_mode=mmap_mode)
+        return model_set_from_bundle(bundle, file_fingerprint(bundle_path), bundle_path)
+
+    # Fallback to legacy individual files
+    print("Bundled model not found. Falling back to individual model files...")
+    paths = [os.path.join(legacy_dir, name) for name in LEGACY_MODEL_FILES]
+    fertilizer_model, quantity_model, health_model, label_encoder = (
+        joblib.load(path, mmap_mode=mmap_mode) for path in paths
+    )
+    return ModelSet(
+        fertilizer_model, quantity_model, health_model, label_encoder,
+        fingerprint=file_fingerprint(*paths),
+        source=legacy_dir,
+        loaded_at=time.time(),
+    )
+
+
+def model_set_from_bundle(bundle, fingerprint, source):
+    """Build a ModelSet from a loaded bundle dict, following its layout"""
+    layout = bundle.get('layout', 'separate')
+    bundle_version = bundle.get('metadata', {}).get('version')
+    if layout == 'compact':
+        return compact_model_set(bundle, fingerprint, source, bundle_version)
+    if layout == 'fused':
+        return ModelSet(
+            None, None, None, bundle['label_encoder'],
+            fingerprint=fingerprint,
+            source=source,
+            loaded_at=time.time(),
+            layout='fused',
+            fused_model=FusedModel.from_bundle(bundle),
+            bundle_version=bundle_version,
+        )
+    if layout != 'separate':
+        raise ValueError(f"Unknown bundle layout '{layout}', expected one of {LAYOUTS}")
+    return ModelSet(
+        bundle['fertilizer_model'],
+        bundle['quantity_model'],
+        bundle['health_model'],
+        bundle['label_encoder'],
+        fingerprint=fingerprint,
+        source=source,
+        loaded_at=time.time(),
+        bundle_version=bundle_version,
+    )
+
+
+def compact_model_set(bundle, fingerprint, source, bundle_version=None):
+    """ModelSet over the FlatForests of a compact bundle"""
+    models = {field: FlatForest.from_compact_arrays(arrays) for field, arrays in bundle['models'].items()}
+    common = dict(fingerprint=fingerprint, source=source, loaded_at=time.time(), engine='compact',
+                  bundle_version=bundle_version)
+    if bundle['model_layout'] == 'fused':
+        fused_model = FusedModel(models['fused_model'], bundle['fertilizer_classes'],
+                                 bundle['target_mean'], bundle['target_scale'])
+        return ModelSet(None, None, None, bundle['label_encoder'], layout='fused', fused_model=fused_model,
+                        **common)
+    return ModelSet(models['fertilizer_model'], models['quantity_model'], models['health_model'],
+                    bundle['label_encoder'], **common)
+
+
+def validate_model_set(model_set):
+    """Run probe predictions for every known crop; raises ValueError if the bundle is unusable"""
+    classes = model_set.label_encoder.classes_
+    if len(classes) == 0:
+        raise ValueError('Label encoder has no crop classes')
+
+    rows = np.repeat(VALIDATION_SAMPLES, len(classes), axis=0)
+    crops = np.tile(np.asarray(classes), len(VALIDATION_SAMPLES))
+    features = np.column_stack([rows, model_set.encode_crop_types(crops)])
+    fertilizer_types, quantities, health_scores = model_set.predict(features)
+
+    unknown = set(np.asarray(fertilizer_types).tolist()) - FERTILIZER_TYPES
+    if unknown:
+        raise ValueError(f'Fertilizer model predicts unknown types: {sorted(unknown)}')
+    for name, values in (('quantity', quantities), ('health', health_scores)):
+        values = np.asarray(values, dtype=float)
+        if values.shape != (len(features),) or not np.isfinite(values).all():
+            raise ValueError(f'{name} model returned invalid predictions')
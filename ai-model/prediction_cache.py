@@ -0,0 +1,107 @@
+"""
+In-process LRU cache for raw model outputs, keyed on quantized soil inputs.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class PredictionCache:
+    """Thread-safe LRU cache with optional TTL and hit/miss/eviction counters.
+
+    Keys are (crop_type, N, P, K, pH, moisture, temperature) with the numeric
+    values rounded to ``precision`` decimals, so readings that only differ
+    below sensor precision share an entry. A ``max_size`` of 0 disables the
+    cache and a ``ttl`` of 0 keeps entries until they are evicted.
+    """
+
+    def __init__(self, max_size=10000, ttl=300.0, precision=2):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.precision = precision
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def make_key(self, crop_type, values):
+        return (str(crop_type),) + tuple(round(value, self.precision) for value in values)
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl > 0 else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop all entries, e.g. because a different model bundle was loaded"""
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl,
+                'precision': self.precision,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+
+def cache_from_env():
+    """Build a cache from PREDICTION_CACHE_SIZE / _TTL / _PRECISION"""
+    return PredictionCache(
+        max_size=int(os.getenv('PREDICTION_CACHE_SIZE', 10000)),
+        ttl=float(os.getenv('PREDICTION_CACHE_TTL', 300)),
+        precision=int(os.getenv('PREDICTION_CACHE_PRECISION', 2)),
+    )
+
+
+def file_fingerprint(*paths):
+    """Content hash of one or more model files, used to detect a changed bundle"""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,282 @@
+"""
+Drift-aware retraining of the model bundle from the logged /predict inputs
+
+    python retrain.py --dry-run               # drift report for the new inputs, no training
+    python retrain.py                         # retrain if the drift or new-data thresholds are crossed
+    python retrain.py --force --mode full     # full retrain on the dataset plus every logged input
+
+With INPUT_LOG_DIR set, the service logs every scored input (see input_log.py).
+This script reads the segments logged since the current bundle was trained and
+compares their feature distribution with the training distribution stored in
+the bundle (see drift.py). It retrains when the largest PSI reaches
+--psi-threshold or at least --min-new-rows new inputs were logged.
+
+New rows are labelled with the generate_dataset.py rules, which label the
+training dataset too. Two modes:
+
+- incremental: each forest is warm-started with --add-trees new trees fit on
+  the new rows, and the oldest trees beyond --max-trees are dropped.
+- full: the layout is retrained from scratch on --data plus every logged row.
+
+``--mode auto`` picks full when the PSI reaches --full-psi-threshold or the new
+rows can't extend the current forests, incremental otherwise.
+
+Each result is saved as model_versions/model-v<version>.pkl and then copied
+over the live bundle, so a service with MODEL_WATCH_INTERVAL (or a POST to
+/admin/reload) picks it up. The bundle metadata records the version, its
+parent, the last log segment used and the new reference statistics.
+"""
+import argparse
+import copy
+import os
+import shutil
+import sys
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.model_selection import train_test_split
+
+import train_model
+from dataset_io import CROP_CLASSES, FEATURE_COLUMNS, load_feature_matrix
+from drift import FeatureStats, drift_report
+from generate_dataset import label_chunk
+from input_log import SETTLE_SECONDS, iter_segments
+from prediction_cache import file_fingerprint
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BUNDLE_PATH = os.path.join(BASE_DIR, 'model.pkl')
+# Resolved against BASE_DIR like app.py, so the script replaces the bundle the service loads
+CONFIGURED_BUNDLE_PATH = os.path.join(BASE_DIR, os.getenv('MODEL_BUNDLE_PATH', 'model.pkl'))
+DEFAULT_LOG_DIR = os.path.join(BASE_DIR, 'input_log')
+MODES = ('auto', 'incremental', 'full')
+
+
+def reference_stats(bundle, data_path):
+    """Training distribution of a bundle, recomputed from the dataset for bundles that predate it"""
+    stored = (bundle or {}).get('metadata', {}).get('feature_stats')
+    if stored:
+        return FeatureStats.from_dict(stored)
+    print(f"Bundle has no feature stats, computing the reference from {data_path}")
+    return FeatureStats.reference(load_feature_matrix(data_path))
+
+
+def read_log(log_dir, reference, after=None, until=None):
+    """Stream the log segments after ``after`` (up to ``until``) into drift stats.
+
+    Returns (stats, features of the rows with a known crop, last segment name).
+    Segments younger than SETTLE_SECONDS are left for the next run, so one
+    still being renamed by a worker can't land behind the returned position.
+    """
+    stats = reference.empty_like()
+    chunks = []
+    last = after
+    for name, columns in iter_segments(log_dir, after, settle_seconds=SETTLE_SECONDS if until is None else 0):
+        if until is not None and name > until:
+            break
+        stats.update(columns['features'], columns['crop_codes'])
+        known = columns['crop_codes'] >= 0
+        chunks.append(np.column_stack([columns['features'][known], columns['crop_codes'][known]]))
+        last = name
+    features = np.concatenate(chunks) if chunks else np.empty((0, len(FEATURE_COLUMNS) + 1))
+    return stats, features, last
+
+
+def label_rows(X):
+    """Targets for logged feature rows from the dataset generator's labelling rules"""
+    df = pd.DataFrame(X[:, :len(FEATURE_COLUMNS)], columns=FEATURE_COLUMNS)
+    df['crop_type'] = np.asarray(CROP_CLASSES, dtype=object)[X[:, -1].astype(int)]
+    df = label_chunk(df)
+    return (df['fertilizer_type'].to_numpy(dtype=object), df['quantity_kg_per_acre'].to_numpy(dtype=float),
+            df['soil_health_score'].to_numpy(dtype=float))
+
+
+def retrain_reasons(report, new_rows, args):
+    """Why a retrain is due, empty when it is not"""
+    if args.force:
+        return ['forced']
+    if new_rows < args.min_train_rows:
+        return []
+    reasons = []
+    if report['max_psi'] >= args.psi_threshold:
+        reasons.append(f"drift (max PSI {report['max_psi']:.3f} >= {args.psi_threshold})")
+    if new_rows >= args.min_new_rows:
+        reasons.append(f"new data ({new_rows:,} rows >= {args.min_new_rows:,})")
+    return reasons
+
+
+def extend_forest(forest, X, y, add_trees, max_trees):
+    """Warm-start add_trees trees fit on (X, y), then keep only the newest max_trees"""
+    forest.set_params(warm_start=True, n_estimators=len(forest.estimators_) + add_trees)
+    forest.fit(X, y)
+    forest.set_params(warm_start=False)
+    if len(forest.estimators_) > max_trees:
+        del forest.estimators_[:len(forest.estimators_) - max_trees]
+        forest.set_params(n_estimators=max_trees)
+    return forest
+
+
+def can_extend(bundle, y_type):
+    """Whether new rows can extend the bundle's forests (a classifier needs every class it knows)"""
+    if bundle is None or bundle.get('layout') == 'compact':
+        # Compact bundles hold pruned flat arrays, not forests that can grow
+        return False
+    if bundle.get('layout', 'separate') == 'fused':
+        return True
+    return np.array_equal(np.unique(np.asarray(y_type, dtype=str)), bundle['fertilizer_model'].classes_.astype(str))
+
+
+def train_incremental(bundle, X, y_type, y_quantity, y_health, add_trees, max_trees):
+    """Extend a copy of the bundle's forests with trees fit on the new rows"""
+    bundle = copy.deepcopy(bundle)
+    if bundle.get('layout', 'separate') == 'fused':
+        # Same indicator columns and standardization as the existing trees
+        _, Y = train_model.fused_targets(y_type, y_quantity, y_health, bundle['fertilizer_classes'])
+        extend_forest(bundle['fused_model'], X, (Y - bundle['target_mean']) / bundle['target_scale'],
+                      add_trees, max_trees)
+    else:
+        extend_forest(bundle['fertilizer_model'], X, y_type, add_trees, max_trees)
+        extend_forest(bundle['quantity_model'], X, y_quantity, add_trees, max_trees)
+        extend_forest(bundle['health_model'], X, y_health, add_trees, max_trees)
+    return bundle
+
+
+def train_full(layout, data_path, X_log, y_log):
+    """Retrain from scratch on the dataset plus labelled logged rows"""
+    X_base, *base_targets = train_model.load_training_data(data_path)
+    X = np.concatenate([X_base, X_log])
+    targets = [np.concatenate([base, logged]) for base, logged in zip(base_targets, y_log)]
+    print(f"Full retrain on {len(X_base):,} dataset rows and {len(X_log):,} logged rows")
+    return train_model.build_bundle(layout, X, *targets)
+
+
+def publish(bundle, bundle_path, versions_dir):
+    """Save the versioned bundle and atomically replace the live one with it"""
+    os.makedirs(versions_dir, exist_ok=True)
+    version_path = os.path.join(versions_dir, f"model-v{bundle['metadata']['version']:04d}.pkl")
+    # Uncompressed so MODEL_MMAP_MODE can memory-map the arrays
+    joblib.dump(bundle, version_path)
+    tmp_path = f'{bundle_path}.tmp-{os.getpid()}'
+    shutil.copyfile(version_path, tmp_path)
+    os.replace(tmp_path, bundle_path)
+    return version_path
+
+
+def print_report(report):
+    print(f"\n{report['rows']:,} new rows vs {report['reference_rows']:,} reference rows")
+    print(f"{'feature':<14}{'psi':>10}{'mean shift (sd)':>18}")
+    for name, entry in report['features'].items():
+        print(f"{name:<14}{entry['psi']:>10.4f}{entry['mean_shift']:>18.3f}")
+    print(f"{'crop_type':<14}{report['crop_type_psi']:>10.4f}")
+    if report['unknown_crop_rows']:
+        print(f"({report['unknown_crop_rows']:,} rows with an unknown crop are not used for training)")
+
+
+def run(args):
+    if not os.path.exists(args.bundle) and os.path.abspath(args.bundle) != DEFAULT_BUNDLE_PATH:
+        # A configured bundle that is missing is a mistake, not a request to train from scratch
+        raise SystemExit(f'Bundle not found: {args.bundle}')
+    bundle = joblib.load(args.bundle) if os.path.exists(args.bundle) else None
+    metadata = (bundle or {}).get('metadata', {})
+    reference = reference_stats(bundle, args.data)
+
+    position = metadata.get('input_log_position')
+    stats, X_new, last_segment = read_log(args.log_dir, reference, position)
+    report = drift_report(reference, stats)
+    print_report(report)
+
+    reasons = retrain_reasons(report, len(X_new), args)
+    if not reasons:
+        print(f"\nNo retrain needed (PSI threshold {args.psi_threshold}, {args.min_new_rows:,} new rows, "
+              f"at least {args.min_train_rows:,} rows)")
+        return 0
+    print(f"\nRetrain due: {', '.join(reasons)}")
+    if args.dry_run:
+        return 0
+
+    y_new = label_rows(X_new)
+    mode = args.mode
+    if mode == 'auto':
+        severe = report['rows'] and report['max_psi'] >= args.full_psi_threshold
+        mode = 'full' if severe or not len(X_new) or not can_extend(bundle, y_new[0]) else 'incremental'
+    elif mode == 'incremental' and not can_extend(bundle, y_new[0]):
+        raise SystemExit('Cannot train incrementally: no bundle, or the new rows miss fertilizer classes it knows')
+
+    # Held-out new rows compare the current and the retrained bundle
+    X_train, y_train, X_test, y_test = X_new, y_new, None, None
+    if len(X_new) >= 50:
+        split = train_test_split(X_new, *y_new, test_size=args.test_size, random_state=42)
+        X_train, X_test = split[0], split[1]
+        y_train, y_test = split[2::2], split[3::2]
+
+    started = time.perf_counter()
+    if mode == 'incremental':
+        candidate = train_incremental(bundle, X_train, *y_train, args.add_trees, args.max_trees)
+        candidate['metadata'] = dict(metadata, feature_stats=reference.merge(stats).to_dict(),
+                                     training_rows=metadata.get('training_rows', 0) + len(X_train))
+    else:
+        # Rows logged before the current bundle, plus the new training rows
+        X_old = read_log(args.log_dir, reference, until=position)[1] if position else X_new[:0]
+        X_log = np.concatenate([X_old, X_train])
+        y_log = [np.concatenate([old, new]) for old, new in zip(label_rows(X_old), y_train)]
+        layout = args.layout or (bundle or {}).get('model_layout') or (bundle or {}).get('layout', 'separate')
+        candidate = train_full(layout, args.data, X_log, y_log)
+    train_seconds = time.perf_counter() - started
+    print(f"[OK] {mode.capitalize()} retrain took {train_seconds:.1f}s")
+
+    if X_test is not None:
+        results = {'candidate': train_model.evaluate(candidate, X_test, *y_test)}
+        if bundle is not None:
+            results = {'current': train_model.evaluate(bundle, X_test, *y_test), **results}
+        train_model.print_comparison(results)
+        candidate['metadata']['test_metrics'] = results['candidate']
+
+    previous_version = metadata.get('version', 0)
+    candidate['metadata'].update({
+        'trained_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'sklearn_version': sklearn.__version__,
+        'version': previous_version + 1,
+        'parent_version': previous_version,
+        'parent_fingerprint': file_fingerprint(args.bundle)[:12] if bundle is not None else None,
+        'input_log_position': last_segment,
+        'retrain': {'mode': mode, 'reasons': reasons, 'new_rows': int(len(X_new)), 'drift': report},
+    })
+    version_path = publish(candidate, args.bundle, args.versions_dir)
+    print(f"\nSaved version {previous_version + 1} to {version_path} and published it to {args.bundle}")
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Retrain the model bundle when the logged inputs drift')
+    parser.add_argument('--bundle', default=CONFIGURED_BUNDLE_PATH,
+                        help='live bundle to check and replace (default: MODEL_BUNDLE_PATH or model.pkl)')
+    parser.add_argument('--log-dir', default=os.getenv('INPUT_LOG_DIR') or DEFAULT_LOG_DIR,
+                        help='input log directory (default: INPUT_LOG_DIR or input_log/)')
+    parser.add_argument('--data', default=train_model.DATASET_PATH, help='base dataset for full retrains')
+    parser.add_argument('--versions-dir', default=os.path.join(BASE_DIR, 'model_versions'),
+                        help='where every published version is kept')
+    parser.add_argument('--mode', choices=MODES, default='auto', help='retrain mode')
+    parser.add_argument('--layout', choices=train_model.LAYOUTS,
+                        help='layout for full retrains (default: the current one)')
+    parser.add_argument('--psi-threshold', type=float, default=0.1, help='max PSI that triggers a retrain')
+    parser.add_argument('--full-psi-threshold', type=float, default=0.25,
+                        help='max PSI from which auto mode retrains from scratch')
+    parser.add_argument('--min-new-rows', type=int, default=10000, help='new rows that trigger a retrain')
+    parser.add_argument('--min-train-rows', type=int, default=1000,
+                        help='new rows needed before drift is trusted enough to retrain')
+    parser.add_argument('--add-trees', type=int, default=20, help='trees added per forest by an incremental retrain')
+    parser.add_argument('--max-trees', type=int, default=200, help='trees kept per forest, oldest dropped first')
+    parser.add_argument('--test-size', type=float, default=0.2, help='held-out fraction of the new rows')
+    parser.add_argument('--force', action='store_true', help='retrain even if no threshold is crossed')
+    parser.add_argument('--dry-run', action='store_true', help='report drift and the decision, train nothing')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    return run(parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,302 @@
+"""
+Crop-aware rule layer applied on top of the raw model outputs.
+
+The vectorized functions take NumPy arrays (one element per sample) and are
+driven by per-crop lookup tables built once at import. The scalar functions
+used by the original single-sample path are thin wrappers over them.
+"""
+from typing import Any, NamedTuple
+
+import numpy as np
+
+from metrics import no_stage
+
+# Crop-specific preferences and requirements
+CROP_RULES = {
+    'Wheat': {
+        'prefers': 'N',
+        'base_quantity': 60,
+        'needs_high_n': True
+    },
+    'Rice': {
+        'prefers': 'N',
+        'base_quantity': 80,
+        'needs_high_n': True
+    },
+    'Corn': {
+        'prefers': 'N',
+        'base_quantity': 70,
+        'needs_high_n': True
+    },
+    'Soybean': {
+        'prefers': 'P',
+        'base_quantity': 40,
+        'needs_high_p': True,
+        'fixes_n': True  # Fixes nitrogen, needs less
+    },
+    'Cotton': {
+        'prefers': 'K',
+        'base_quantity': 65,
+        'needs_high_k': True
+    },
+    'Tomato': {
+        'prefers': 'Mixed',
+        'base_quantity': 55,
+        'needs_balanced': True
+    },
+    'Potato': {
+        'prefers': 'P',
+        'base_quantity': 75,
+        'needs_high_p': True
+    },
+    'Sugarcane': {
+        'prefers': 'K',
+        'base_quantity': 90,
+        'needs_high_k': True
+    }
+}
+
+CROP_SUGGESTIONS = {
+    'Wheat': 'Apply nitrogen in split doses during tillering and flowering stages.',
+    'Rice': 'Maintain water level and apply balanced NPK during transplanting.',
+    'Corn': 'Apply nitrogen during V6 and tasseling stages for better yield.',
+    'Soybean': 'Inoculate seeds with Rhizobium for nitrogen fixation.',
+    'Cotton': 'Apply potassium during boll development stage.',
+    'Tomato': 'Maintain consistent moisture and apply calcium to prevent blossom end rot.',
+    'Potato': 'Apply phosphorus during tuber initiation for better development.',
+    'Sugarcane': 'Apply higher potassium during grand growth period.'
+}
+
+# Rule tables are indexed by position in CROP_TYPES; the extra last row holds
+# the "no rules" defaults used for crops we don't know about.
+CROP_TYPES = tuple(CROP_RULES)
+UNKNOWN_CROP = len(CROP_TYPES)
+
+_SORTED_CROPS = np.array(sorted(CROP_TYPES))
+_SORTED_TO_RULE = np.array([CROP_TYPES.index(crop) for crop in _SORTED_CROPS])
+
+
+def _crop_table(key, default, dtype):
+    values = [CROP_RULES[crop].get(key, default) for crop in CROP_TYPES]
+    return np.array(values + [default], dtype=dtype)
+
+
+PREFERS = _crop_table('prefers', '', object)
+BASE_QUANTITY = _crop_table('base_quantity', 0, float)
+HAS_BASE_QUANTITY = BASE_QUANTITY > 0
+NEEDS_HIGH_N = _crop_table('needs_high_n', False, bool)
+NEEDS_HIGH_P = _crop_table('needs_high_p', False, bool)
+NEEDS_HIGH_K = _crop_table('needs_high_k', False, bool)
+
+# Extra quantity multiplier (Rice/Sugarcane need more, Soybean fixes N)
+QUANTITY_MULTIPLIER = np.ones(len(CROP_TYPES) + 1)
+QUANTITY_MULTIPLIER[CROP_TYPES.index('Rice')] = 1.1
+QUANTITY_MULTIPLIER[CROP_TYPES.index('Sugarcane')] = 1.1
+QUANTITY_MULTIPLIER[CROP_TYPES.index('Soybean')] = 0.8
+
+# Deficiency analysis: status/severity codes and the per-nutrient thresholds
+STATUS_LABELS = ('None', 'Deficient', 'Excessive', 'Optimal', 'Acidic', 'Alkaline')
+STATUS_NONE, STATUS_DEFICIENT, STATUS_EXCESSIVE, STATUS_OPTIMAL, STATUS_ACIDIC, STATUS_ALKALINE = range(6)
+
+SEVERITY_LABELS = ('None', 'Moderate', 'High')
+SEVERITY_NONE, SEVERITY_MODERATE, SEVERITY_HIGH = range(3)
+
+# (nutrient, deficient below, excessive above, high severity below, high severity above)
+NUTRIENT_THRESHOLDS = (
+    ('Nitrogen', 30, 70, 20, 80),
+    ('Phosphorus', 25, 60, 15, 70),
+    ('Potassium', 30, 70, 20, 80),
+)
+DEFICIENCY_NUTRIENTS = tuple(name for name, *_ in NUTRIENT_THRESHOLDS) + ('pH',)
+
+DEFICIENCY_RECOMMENDATIONS = {
+    ('Nitrogen', STATUS_DEFICIENT): 'Apply nitrogen-rich fertilizer immediately',
+    ('Nitrogen', STATUS_EXCESSIVE): 'Reduce nitrogen application',
+    ('Phosphorus', STATUS_DEFICIENT): 'Apply phosphorus-rich fertilizer',
+    ('Phosphorus', STATUS_EXCESSIVE): 'Reduce phosphorus application',
+    ('Potassium', STATUS_DEFICIENT): 'Apply potassium-rich fertilizer',
+    ('Potassium', STATUS_EXCESSIVE): 'Reduce potassium application',
+    ('pH', STATUS_OPTIMAL): 'pH is in optimal range',
+    ('pH', STATUS_ACIDIC): 'Apply lime to raise pH',
+    ('pH', STATUS_ALKALINE): 'Apply sulfur or organic matter to lower pH',
+}
+
+# Improvement suggestions, in the order they are reported
+SUGGESTIONS = (
+    "⚠️ Soil health is below optimal. Consider regular soil testing and balanced fertilization.",
+    "✓ Use organic fertilizers like compost, manure, or bio-fertilizers for sustainable farming.",
+    "📊 Mixed fertilizer recommended. Use NPK blend based on specific crop requirements.",
+    "💧 Soil moisture is low. Implement proper irrigation practices.",
+    "🌧️ Soil moisture is high. Improve drainage to prevent waterlogging.",
+    "🌡️ Low temperature detected. Consider using mulch or protective covers.",
+    "🌡️ High temperature detected. Ensure adequate irrigation and shade management.",
+) + tuple(f"🌾 {CROP_SUGGESTIONS[crop]}" for crop in CROP_TYPES) + (
+    "✓ Soil conditions are good. Maintain current practices and monitor regularly.",
+)
+SUGGESTION_CROP_OFFSET = 7
+SUGGESTION_DEFAULT = len(SUGGESTIONS) - 1
+
+
+def crop_rule_index(crop_types):
+    """Map crop names to rows of the rule tables (UNKNOWN_CROP if not listed)"""
+    crops = np.asarray(crop_types, dtype=str).reshape(-1)
+    positions = np.minimum(np.searchsorted(_SORTED_CROPS, crops), len(_SORTED_CROPS) - 1)
+    return np.where(_SORTED_CROPS[positions] == crops, _SORTED_TO_RULE[positions], UNKNOWN_CROP)
+
+
+def apply_crop_specific_adjustments_batch(crop_index, fertilizer_types, quantities, nitrogen, phosphorus, potassium):
+    """Vectorized crop-specific adjustments, returns (fertilizer_types, quantities) arrays"""
+    fertilizer_types = np.array(fertilizer_types, dtype=object)
+    quantities = np.asarray(quantities, dtype=float)
+    prefers = PREFERS[crop_index]
+
+    # If soil is balanced but crop prefers specific nutrient, consider that preference
+    organic = fertilizer_types == 'Organic'
+    fertilizer_types[organic & (prefers == 'N') & (nitrogen < 50)] = 'N'
+    fertilizer_types[organic & (prefers == 'P') & (phosphorus < 45)] = 'P'
+    fertilizer_types[organic & (prefers == 'K') & (potassium < 50)] = 'K'
+    fertilizer_types[organic & (prefers == 'Mixed')] = 'Mixed'
+
+    # Adjust for deficiencies (only the first matching need is considered)
+    organic = fertilizer_types == 'Organic'
+    low_n = NEEDS_HIGH_N[crop_index] & (nitrogen < 40)
+    low_p = ~low_n & NEEDS_HIGH_P[crop_index] & (phosphorus < 30)
+    low_k = ~low_n & ~low_p & NEEDS_HIGH_K[crop_index] & (potassium < 35)
+    fertilizer_types[organic & low_n & (nitrogen < 35)] = 'N'
+    fertilizer_types[organic & low_p & (phosphorus < 25)] = 'P'
+    fertilizer_types[organic & low_k & (potassium < 30)] = 'K'
+
+    # Scale the quantity relative to crop-specific base (original base was 50)
+    scaled = BASE_QUANTITY[crop_index] * (quantities / 50) * QUANTITY_MULTIPLIER[crop_index]
+    quantities = np.where(HAS_BASE_QUANTITY[crop_index], scaled, quantities)
+
+    return fertilizer_types, np.clip(quantities, 20, 200)  # Keep within reasonable bounds
+
+
+def analyze_deficiencies_batch(nitrogen, phosphorus, potassium, ph):
+    """Vectorized deficiency analysis, returns (status, severity) code arrays of shape (n, 4)"""
+    ph = np.asarray(ph, dtype=float)
+    status = np.empty((ph.shape[0], len(DEFICIENCY_NUTRIENTS)), dtype=np.int8)
+    severity = np.empty_like(status)
+
+    for column, (levels, (_, low, high, severe_low, severe_high)) in enumerate(
+        zip((nitrogen, phosphorus, potassium), NUTRIENT_THRESHOLDS)
+    ):
+        levels = np.asarray(levels, dtype=float)
+        deficient = levels < low
+        excessive = ~deficient & (levels > high)
+        severe = np.where(deficient, levels < severe_low, levels > severe_high)
+        status[:, column] = np.select([deficient, excessive], [STATUS_DEFICIENT, STATUS_EXCESSIVE], STATUS_NONE)
+        severity[:, column] = np.where(severe, SEVERITY_HIGH, SEVERITY_MODERATE)
+
+    acidic = ph < 6.0
+    alkaline = ~acidic & (ph > 7.5)
+    status[:, -1] = np.select([acidic, alkaline], [STATUS_ACIDIC, STATUS_ALKALINE], STATUS_OPTIMAL)
+    severity[:, -1] = np.where((ph >= 6.0) & (ph <= 7.5), SEVERITY_NONE, SEVERITY_MODERATE)
+
+    return status, severity
+
+
+def deficiency_reports(levels, status, severity):
+    """Expand deficiency codes into the per-sample lists of dicts returned by the API"""
+    levels = np.asarray(levels, dtype=float).tolist()
+    status = status.tolist()
+    severity = severity.tolist()
+    reports = []
+    for row_levels, row_status, row_severity in zip(levels, status, severity):
+        deficiencies = []
+        for nutrient, level, code, severity_code in zip(DEFICIENCY_NUTRIENTS, row_levels, row_status, row_severity):
+            if code == STATUS_NONE:
+                continue
+            deficiencies.append({
+                'nutrient': nutrient,
+                'level': level,
+                'status': STATUS_LABELS[code],
+                'severity': SEVERITY_LABELS[severity_code],
+                'recommendation': DEFICIENCY_RECOMMENDATIONS[(nutrient, code)]
+            })
+        reports.append(deficiencies)
+    return reports
+
+
+def generate_improvement_suggestions_batch(moisture, temperature, crop_index, fertilizer_types, health_scores):
+    """Vectorized suggestions, returns a boolean (n, len(SUGGESTIONS)) matrix of suggestion flags"""
+    fertilizer_types = np.asarray(fertilizer_types, dtype=object)
+    moisture = np.asarray(moisture, dtype=float)
+    temperature = np.asarray(temperature, dtype=float)
+    flags = np.zeros((len(crop_index), len(SUGGESTIONS)), dtype=bool)
+
+    flags[:, 0] = np.asarray(health_scores, dtype=float) < 60
+    flags[:, 1] = fertilizer_types == 'Organic'
+    flags[:, 2] = fertilizer_types == 'Mixed'
+    flags[:, 3] = moisture < 40
+    flags[:, 4] = moisture > 60
+    flags[:, 5] = temperature < 20
+    flags[:, 6] = temperature > 30
+
+    known = crop_index < UNKNOWN_CROP
+    flags[np.flatnonzero(known), SUGGESTION_CROP_OFFSET + crop_index[known]] = True
+
+    flags[:, SUGGESTION_DEFAULT] = ~flags.any(axis=1)
+    return flags
+
+
+def suggestion_messages(flags):
+    """Expand a suggestion flag matrix into per-sample message lists"""
+    return [[SUGGESTIONS[code] for code in np.flatnonzero(row)] for row in flags]
+
+
+class RuleOutputs(NamedTuple):
+    """Rule layer results for a batch: adjusted model outputs plus deficiency and suggestion codes"""
+    fertilizer_types: Any
+    quantities: Any
+    status: Any
+    severity: Any
+    suggestion_flags: Any
+
+
+def apply_rules(numeric, crop_types, fertilizer_types, quantities, health_scores, stage=no_stage):
+    """Run the whole rule layer over raw model outputs.
+
+    ``numeric`` is the (n, 6) matrix of request readings in FEATURE_FIELDS
+    order; ``stage(name)`` times each step.
+    """
+    nitrogen, phosphorus, potassium, ph, moisture, temperature = np.asarray(numeric, dtype=float).T
+    crop_index = crop_rule_index(crop_types)
+
+    # Apply crop-specific adjustments to make recommendations more crop-aware
+    with stage('crop_adjustments'):
+        fertilizer_types, quantities = apply_crop_specific_adjustments_batch(
+            crop_index, fertilizer_types, quantities, nitrogen, phosphorus, potassium
+        )
+
+    with stage('deficiency_analysis'):
+        status, severity = analyze_deficiencies_batch(nitrogen, phosphorus, potassium, ph)
+
+    with stage('suggestions'):
+        flags = generate_improvement_suggestions_batch(
+            moisture, temperature, crop_index, fertilizer_types, health_scores
+        )
+    return RuleOutputs(fertilizer_types, quantities, status, severity, flags)
+
+
+def apply_crop_specific_adjustments(crop_type, fertilizer_type, quantity, nitrogen, phosphorus, potassium):
+    """Apply crop-specific adjustments to recommendations"""
+    fertilizer_types, quantities = apply_crop_specific_adjustments_batch(
+        crop_rule_index([crop_type]), [fertilizer_type], [quantity], nitrogen, phosphorus, potassium
+    )
+    return fertilizer_types[0], float(quantities[0])
+
+
+def analyze_deficiencies(nitrogen, phosphorus, potassium, ph):
+    """Analyze nutrient deficiencies"""
+    status, severity = analyze_deficiencies_batch([nitrogen], [phosphorus], [potassium], [ph])
+    return deficiency_reports([[nitrogen, phosphorus, potassium, ph]], status, severity)[0]
+
+
+def generate_improvement_suggestions(nitrogen, phosphorus, potassium, ph, moisture, temperature, crop_type, fertilizer_type, health_score):
+    """Generate improvement suggestions"""
+    flags = generate_improvement_suggestions_batch(
+        [moisture], [temperature], crop_rule_index([crop_type]), [fertilizer_type], [health_score]
+    )
+    return suggestion_messages(flags)[0]
@@ -0,0 +1,45 @@
+"""
+Bundle selection when MODEL_BUNDLES is unset: the "model" field and the
+X-Model header are ignored and the default bundle answers.
+
+    python -m pytest test_model_selection.py
+"""
+import pytest
+
+import app
+from model_registry import ModelRegistry
+
+SAMPLE = {'nitrogen': 45, 'phosphorus': 30, 'potassium': 35, 'ph': 6.5, 'moisture': 55, 'temperature': 25,
+          'crop_type': 'Wheat'}
+
+
+@pytest.fixture
+def default_models(monkeypatch):
+    """A stand-in default ModelSet, with loading and the bundle watcher switched off"""
+    default = object()
+    monkeypatch.setattr(app, 'models', default)
+    monkeypatch.setattr(app, 'ensure_models_loaded', lambda: None)
+    return default
+
+
+def test_selector_ignored_without_registry(monkeypatch, default_models):
+    monkeypatch.setattr(app, 'model_registry', ModelRegistry({}))
+    assert app.select_models('predict', 'north') == (default_models, None)
+    assert app.select_models('predict', ['not', 'a', 'name']) == (default_models, None)
+    assert app.select_models('predict', None) == (default_models, None)
+
+
+def test_unknown_name_rejected_with_registry(monkeypatch, default_models):
+    monkeypatch.setattr(app, 'model_registry', ModelRegistry({'south': '/nonexistent/south.pkl'}))
+    model_set, (body, status) = app.select_models('predict', 'north')
+    assert model_set is None and status == 404 and body['code'] == 'unknown_model'
+    assert app.select_models('predict', None) == (default_models, None)
+
+
+def test_predict_with_model_field_uses_default_bundle(monkeypatch, default_models):
+    monkeypatch.setattr(app, 'model_registry', ModelRegistry({}))
+    served = []
+    monkeypatch.setattr(app, 'predict_one', lambda model_set, values, crop_type: served.append(model_set) or {})
+    response = app.app.test_client().post('/predict', json=dict(SAMPLE, model='north'), headers={'X-Model': 'north'})
+    assert response.status_code == 200
+    assert served == [default_models]
@@ -0,0 +1,375 @@
+"""
+Train the fertilizer recommendation models and save them as a model.pkl bundle
+
+    python train_model.py                              # three separate forests
+    python train_model.py --layout fused               # one multi-output forest
+    python train_model.py --compare                    # accuracy and latency of both layouts
+    python train_model.py --search --jobs -1           # cross-validated hyperparameter search first
+
+The dataset can be any format written by generate_dataset.py (CSV, Parquet
+or an npy directory). CSV and Parquet datasets are converted once into an
+npy cache under --cache-dir, keyed by the file's content hash, and every run
+after that memory-maps the cached arrays instead of parsing the file again.
+See model_store.py for the bundle layouts.
+
+--search scores every combination of SEARCH_GRID for each model of the
+layout with k-fold cross-validation. All models and parameter sets share the
+same folds, and the (model, parameters, fold) fits run in parallel worker
+processes, which open the memory-mapped feature matrix instead of receiving
+a copy. The best parameters per model are used for the saved bundle.
+"""
+import argparse
+import contextlib
+import itertools
+import os
+import shutil
+import time
+
+import joblib
+import numpy as np
+import sklearn
+from joblib import Parallel, delayed
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+from sklearn.metrics import accuracy_score, mean_absolute_error, r2_score
+from sklearn.model_selection import StratifiedKFold, train_test_split
+from sklearn.preprocessing import LabelEncoder
+
+from dataset_io import CROP_CLASSES, infer_format, load_dataset, load_feature_matrix, load_targets, open_writer
+from drift import FeatureStats
+from model_store import LAYOUTS, FusedModel, model_set_from_bundle
+from prediction_cache import file_fingerprint
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DATASET_PATH = os.path.join(BASE_DIR, 'soil_fertilizer_dataset.csv')
+BUNDLE_PATH = os.path.join(BASE_DIR, 'model.pkl')
+CACHE_DIR = os.path.join(BASE_DIR, 'dataset_cache')
+
+FOREST_PARAMS = {'n_estimators': 100, 'max_depth': 10, 'random_state': 42}
+
+# Candidate overrides of FOREST_PARAMS tried by --search
+SEARCH_GRID = {
+    'max_depth': [8, 10, 14, None],
+    'min_samples_leaf': [1, 3],
+    'max_features': [1.0, 'sqrt'],
+}
+
+# Models trained for each layout, as (bundle field, target) pairs
+LAYOUT_MODELS = {
+    'separate': (('fertilizer_model', 'type'), ('quantity_model', 'quantity'), ('health_model', 'health')),
+    'fused': (('fused_model', 'all'),),
+}
+
+
+class StageTimer:
+    """Wall time per training stage, printed as each stage finishes"""
+
+    def __init__(self):
+        self.seconds = {}
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.seconds[name] = self.seconds.get(name, 0.0) + elapsed
+            print(f"[time] {name}: {elapsed:.2f}s")
+
+    def print_summary(self):
+        total = sum(self.seconds.values())
+        print(f"\n{'stage':<24}{'seconds':>10}{'share':>8}")
+        for name, seconds in self.seconds.items():
+            print(f"{name:<24}{seconds:>10.2f}{seconds / max(total, 1e-9):>8.0%}")
+        print(f"{'total':<24}{total:>10.2f}")
+
+
+def crop_label_encoder():
+    """LabelEncoder matching the crop encoding used by dataset_io"""
+    encoder = LabelEncoder()
+    encoder.fit(CROP_CLASSES)
+    return encoder
+
+
+def cached_dataset(path, cache_dir=CACHE_DIR):
+    """npy copy of a CSV or Parquet dataset, written on first use; npy datasets are returned as is"""
+    if infer_format(path) == 'npy':
+        return path
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(cache_dir, f'{name}-{file_fingerprint(path)[:16]}')
+    if os.path.isdir(cache_path):
+        return cache_path
+
+    df = load_dataset(path)
+    tmp_path = f'{cache_path}.tmp-{os.getpid()}'
+    writer = open_writer(tmp_path, 'npy', n_samples=len(df))
+    writer.write(df)
+    writer.close()
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Another run cached the same file first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    print(f"Cached {len(df)} rows of {path} in {cache_path}")
+    return cache_path
+
+
+def load_training_data(path, cache_dir=None):
+    """Feature matrix and targets; with a cache_dir the features stay memory-mapped from the npy cache"""
+    if cache_dir:
+        path = cached_dataset(path, cache_dir)
+        X = load_feature_matrix(path)
+    else:
+        X = np.asarray(load_feature_matrix(path))
+    targets = load_targets(path)
+    return X, targets['fertilizer_type'], targets['quantity_kg_per_acre'], targets['soil_health_score']
+
+
+def fit_forest(estimator, params, X, y, n_jobs=None):
+    """Fit a forest on n_jobs cores, then reset it to predict on one core as the service expects"""
+    model = estimator(**{**FOREST_PARAMS, **params, 'n_jobs': n_jobs}).fit(X, y)
+    model.n_jobs = None
+    return model
+
+
+def train_separate(X, y_type, y_quantity, y_health, params=None, n_jobs=None):
+    """Three independent forests, one per target; params maps a model field to its FOREST_PARAMS overrides"""
+    params = params or {}
+    return {
+        'layout': 'separate',
+        'fertilizer_model': fit_forest(RandomForestClassifier, params.get('fertilizer_model', {}),
+                                       X, y_type, n_jobs),
+        'quantity_model': fit_forest(RandomForestRegressor, params.get('quantity_model', {}),
+                                     X, y_quantity, n_jobs),
+        'health_model': fit_forest(RandomForestRegressor, params.get('health_model', {}),
+                                   X, y_health, n_jobs),
+    }
+
+
+def fused_targets(y_type, y_quantity, y_health, classes=None):
+    """Indicator columns per fertilizer class followed by quantity and health score"""
+    classes = np.unique(y_type) if classes is None else np.asarray(classes)
+    indicators = (np.asarray(y_type)[:, None] == classes[None, :]).astype(float)
+    return classes, np.column_stack([indicators, y_quantity, y_health])
+
+
+def train_fused(X, y_type, y_quantity, y_health, params=None, n_jobs=None):
+    """One multi-output forest over standardized targets, so no target dominates the splits"""
+    classes, Y = fused_targets(y_type, y_quantity, y_health)
+    mean = Y.mean(axis=0)
+    scale = Y.std(axis=0)
+    scale[scale == 0] = 1.0
+    forest = fit_forest(RandomForestRegressor, (params or {}).get('fused_model', {}),
+                        X, (Y - mean) / scale, n_jobs)
+    return {
+        'layout': 'fused',
+        'fused_model': forest,
+        'fertilizer_classes': classes.astype(object),
+        'target_mean': mean,
+        'target_scale': scale,
+    }
+
+
+TRAINERS = {'separate': train_separate, 'fused': train_fused}
+
+
+def build_bundle(layout, X, y_type, y_quantity, y_health, params=None, n_jobs=None):
+    bundle = TRAINERS[layout](X, y_type, y_quantity, y_health, params, n_jobs)
+    bundle['label_encoder'] = crop_label_encoder()
+    bundle['metadata'] = {
+        'trained_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'sklearn_version': sklearn.__version__,
+        'training_rows': int(len(X)),
+        # Counted up by retrain.py, which also compares new inputs against feature_stats
+        'version': 1,
+        'feature_stats': FeatureStats.reference(X).to_dict(),
+    }
+    if params:
+        bundle['metadata']['forest_params'] = params
+    return bundle
+
+
+def parameter_grid(grid=SEARCH_GRID):
+    """Every combination of the grid's values, as FOREST_PARAMS overrides"""
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def fold_score(field, target, params, X, y_type, y_quantity, y_health, train, test):
+    """Validation score of one model fitted on one fold: accuracy for the type, R^2 for the rest.
+
+    A fused forest scores the mean of its type accuracy and both R^2 values.
+    """
+    X_train, X_test = X[train], X[test]
+    if target == 'type':
+        model = fit_forest(RandomForestClassifier, params, X_train, y_type[train])
+        return accuracy_score(y_type[test], model.predict(X_test))
+    if target in ('quantity', 'health'):
+        y = y_quantity if target == 'quantity' else y_health
+        model = fit_forest(RandomForestRegressor, params, X_train, y[train])
+        return r2_score(y[test], model.predict(X_test))
+
+    bundle = train_fused(X_train, y_type[train], y_quantity[train], y_health[train], {field: params})
+    fertilizer_types, quantities, health_scores = FusedModel.from_bundle(bundle).predict_all(X_test)
+    return np.mean([
+        accuracy_score(y_type[test], np.asarray(fertilizer_types, dtype=y_type.dtype)),
+        r2_score(y_quantity[test], quantities),
+        r2_score(y_health[test], health_scores),
+    ])
+
+
+def search_params(layout, X, y_type, y_quantity, y_health, rows=None, folds=3, n_jobs=-1, grid=SEARCH_GRID):
+    """Cross-validated grid search for each model of a layout over shared folds of ``rows``.
+
+    Workers get X itself and row indices, so a memory-mapped X is opened, not copied.
+    Returns ({model field: best overrides}, {model field: [(overrides, mean score), ...]}).
+    """
+    rows = np.arange(len(X)) if rows is None else np.asarray(rows)
+    # Integer class codes are shipped to the workers far cheaper than label strings
+    _, y_type = np.unique(np.asarray(y_type), return_inverse=True)
+    y_quantity = np.asarray(y_quantity)
+    y_health = np.asarray(y_health)
+    # One split for everything, stratified on the fertilizer type
+    kfold = StratifiedKFold(n_splits=folds, shuffle=True, random_state=42)
+    splits = [(rows[train], rows[test]) for train, test in kfold.split(rows, y_type[rows])]
+    candidates = parameter_grid(grid)
+    tasks = [
+        (field, target, index, train, test)
+        for field, target in LAYOUT_MODELS[layout]
+        for index in range(len(candidates))
+        for train, test in splits
+    ]
+    print(f"Searching {len(candidates)} parameter sets x {folds} folds for {layout} layout "
+          f"({len(tasks)} fits, n_jobs={n_jobs})")
+    scores = Parallel(n_jobs=n_jobs)(
+        delayed(fold_score)(field, target, candidates[index], X, y_type, y_quantity, y_health, train, test)
+        for field, target, index, train, test in tasks
+    )
+
+    totals = {}
+    for (field, _, index, _, _), score in zip(tasks, scores):
+        totals.setdefault(field, np.zeros(len(candidates)))[index] += score / folds
+    best = {field: candidates[int(np.argmax(means))] for field, means in totals.items()}
+    ranking = {field: sorted(zip(candidates, means.tolist()), key=lambda item: -item[1])
+               for field, means in totals.items()}
+    return best, ranking
+
+
+def print_search(ranking, top=3):
+    for field, results in ranking.items():
+        print(f"\n{field}")
+        for params, score in results[:top]:
+            print(f"  {score:.4f}  {params}")
+
+
+def evaluate(bundle, X, y_type, y_quantity, y_health, latency_rounds=200):
+    """Accuracy metrics plus single-sample latency and batch throughput"""
+    model_set = model_set_from_bundle(bundle, fingerprint='', source='memory')
+    fertilizer_types, quantities, health_scores = model_set.predict(X)
+
+    single = X[:1]
+    model_set.predict(single)
+    started = time.perf_counter()
+    for _ in range(latency_rounds):
+        model_set.predict(single)
+    single_ms = (time.perf_counter() - started) / latency_rounds * 1000
+
+    batch = X[:1000]
+    started = time.perf_counter()
+    model_set.predict(batch)
+    batch_seconds = time.perf_counter() - started
+
+    return {
+        'type_accuracy': accuracy_score(y_type, np.asarray(fertilizer_types, dtype=str)),
+        'quantity_mae': mean_absolute_error(y_quantity, quantities),
+        'quantity_r2': r2_score(y_quantity, quantities),
+        'health_mae': mean_absolute_error(y_health, health_scores),
+        'health_r2': r2_score(y_health, health_scores),
+        'single_ms': single_ms,
+        'batch_rows_per_s': len(batch) / batch_seconds,
+    }
+
+
+def print_comparison(results):
+    columns = ['type_accuracy', 'quantity_mae', 'quantity_r2', 'health_mae', 'health_r2',
+               'single_ms', 'batch_rows_per_s']
+    print(f"\n{'layout':<10}" + ''.join(f"{column:>18}" for column in columns))
+    for layout, metrics in results.items():
+        print(f"{layout:<10}" + ''.join(f"{metrics[column]:>18.4f}" for column in columns))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Train the fertilizer recommendation model bundle')
+    parser.add_argument('--data', default=DATASET_PATH, help='dataset path (CSV, Parquet or npy directory)')
+    parser.add_argument('--layout', choices=LAYOUTS, default='separate', help='bundle layout to train')
+    parser.add_argument('--output', default=BUNDLE_PATH, help='where to write the bundle')
+    parser.add_argument('--test-size', type=float, default=0.2, help='held-out fraction for evaluation')
+    parser.add_argument('--compare', action='store_true',
+                        help='train every layout and print accuracy and latency side by side (no bundle saved)')
+    parser.add_argument('--search', action='store_true',
+                        help='pick forest parameters per model by cross-validated search over SEARCH_GRID')
+    parser.add_argument('--cv-folds', type=int, default=3, help='folds for --search, shared by every model')
+    parser.add_argument('--jobs', type=int, default=-1, help='worker processes / cores to train with (-1: all)')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='where CSV and Parquet datasets are cached as npy')
+    parser.add_argument('--no-cache', action='store_true', help='parse the dataset without caching it')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    stage = StageTimer()
+
+    with stage('load_data'):
+        X, y_type, y_quantity, y_health = load_training_data(
+            args.data, cache_dir=None if args.no_cache else args.cache_dir)
+    print(f"Loaded {len(X)} samples from {args.data}")
+    train_rows, test_rows = train_test_split(np.arange(len(X)), test_size=args.test_size, random_state=42)
+    X_train, X_test = X[train_rows], X[test_rows]
+    type_train, type_test = y_type[train_rows], y_type[test_rows]
+    quantity_train, quantity_test = y_quantity[train_rows], y_quantity[test_rows]
+    health_train, health_test = y_health[train_rows], y_health[test_rows]
+
+    layouts = LAYOUTS if args.compare else (args.layout,)
+    params = {}
+    search_results = {}
+    results = {}
+    for layout in layouts:
+        if args.search:
+            with stage(f'search_{layout}'):
+                params[layout], search_results[layout] = search_params(
+                    layout, X, y_type, y_quantity, y_health, train_rows, args.cv_folds, args.jobs)
+            print_search(search_results[layout])
+        with stage(f'train_{layout}'):
+            started = time.perf_counter()
+            bundle = build_bundle(layout, X_train, type_train, quantity_train, health_train,
+                                  params.get(layout), args.jobs)
+            train_seconds = time.perf_counter() - started
+        with stage(f'evaluate_{layout}'):
+            results[layout] = evaluate(bundle, X_test, type_test, quantity_test, health_test)
+        results[layout]['train_seconds'] = train_seconds
+        print(f"[OK] Trained '{layout}' layout in {train_seconds:.1f}s")
+
+    print_comparison(results)
+    if args.compare:
+        stage.print_summary()
+        return
+
+    # Refit on all rows for the shipped bundle
+    with stage('refit'):
+        bundle = build_bundle(args.layout, X, y_type, y_quantity, y_health, params.get(args.layout), args.jobs)
+    bundle['metadata']['test_metrics'] = results[args.layout]
+    if args.search:
+        bundle['metadata']['search'] = {
+            field: [{'params': candidate, 'score': score} for candidate, score in ranking]
+            for field, ranking in search_results[args.layout].items()
+        }
+    bundle['metadata']['stage_seconds'] = dict(stage.seconds)
+    with stage('save'):
+        # Uncompressed so MODEL_MMAP_MODE can memory-map the arrays
+        joblib.dump(bundle, args.output)
+    print(f"\nSaved '{args.layout}' bundle to: {args.output}")
+    stage.print_summary()
+
+
+if __name__ == '__main__':
+    main()
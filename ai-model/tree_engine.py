@@ -0,0 +1,407 @@
+"""
+Flat-array inference engine for the scikit-learn tree ensembles.
+
+``flatten_model`` copies every tree of a fitted RandomForest/ExtraTrees (or a
+single DecisionTree) into one set of contiguous node arrays. ``FlatForest``
+then walks all trees for a whole batch at once with NumPy, one tree level per
+step, and accumulates leaf values in the same order as scikit-learn so the
+outputs match ``estimator.predict`` exactly.
+
+    python tree_engine.py export model.pkl flat_models.npz
+    python tree_engine.py check model.pkl
+"""
+import argparse
+import sys
+
+import numpy as np
+
+# Rows traversed per step, bounds the (rows x trees) index arrays
+BATCH_ROWS = 4096
+
+FLAT_ARRAYS = ('feature', 'threshold', 'left', 'right', 'missing_left', 'value', 'roots')
+# Compact bundles store class probabilities as int16 fractions of this
+PROBABILITY_SCALE = 32767
+
+
+def float32_floor(values):
+    """Largest float32 at or below each value.
+
+    Inputs are compared as float32, and for a float32 x, ``x <= t`` holds exactly
+    when ``x <= float32_floor(t)``, so thresholds stored this way split the same way.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    rounded = values.astype(np.float32)
+    too_high = rounded > values
+    rounded[too_high] = np.nextafter(rounded[too_high], np.float32(-np.inf))
+    return rounded
+
+
+class FlatForest:
+    """Contiguous node arrays for every tree of an ensemble.
+
+    Leaves point to themselves, so a fixed number of steps (the deepest tree)
+    takes every sample to its leaf without any per-tree branching. ``value``
+    holds per-node outputs: class probabilities for classifiers, regression
+    targets (one column per output) for regressors.
+    """
+
+    def __init__(self, feature, threshold, left, right, missing_left, value, roots, depth,
+                 n_features, classes=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.missing_left = missing_left
+        self.value = value
+        self.roots = roots
+        self.depth = int(depth)
+        self.n_features = int(n_features)
+        self.classes_ = classes
+        self._packed_children = None
+
+    @property
+    def is_classifier(self):
+        return self.classes_ is not None
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    @property
+    def n_nodes(self):
+        return len(self.feature)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in FLAT_ARRAYS)
+
+    def _children(self):
+        # Left/right children interleaved, so one gather picks the next node
+        if getattr(self, '_packed_children', None) is None:
+            self._packed_children = np.column_stack([self.left, self.right]).reshape(-1)
+        return self._packed_children
+
+    def _walk(self, X):
+        """Yield the node of every (tree, sample) pair at each level, roots first, shape (n_trees, n_samples)"""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        n_samples = X.shape[0]
+        flat_X = X.reshape(-1)
+        row_offsets = np.arange(n_samples) * X.shape[1]
+        has_missing = np.isnan(flat_X).any()
+        children = self._children()
+
+        nodes = np.repeat(self.roots[:, None], n_samples, axis=1)
+        yield nodes
+        for _ in range(self.depth):
+            values = flat_X[self.feature[nodes] + row_offsets]
+            go_right = ~(values <= self.threshold[nodes])
+            if has_missing:
+                go_right &= ~(np.isnan(values) & self.missing_left[nodes])
+            nodes = children[2 * nodes + go_right]
+            yield nodes
+
+    def _traverse(self, X):
+        """Leaf node index of every (tree, sample) pair, shape (n_trees, n_samples)"""
+        for nodes in self._walk(X):
+            pass
+        return nodes
+
+    def apply(self, X):
+        """Leaf node index of every (sample, tree) pair, shape (n_samples, n_trees)"""
+        return self._traverse(X).T
+
+    def _accumulate(self, X):
+        out = np.empty((X.shape[0], self.value.shape[1]))
+        for start in range(0, X.shape[0], BATCH_ROWS):
+            leaves = self._traverse(X[start:start + BATCH_ROWS])
+            # Reducing over the leading (tree) axis adds one tree at a time in
+            # estimator order, the same summation order scikit-learn uses
+            out[start:start + BATCH_ROWS] = self.value[leaves].sum(axis=0)
+        out /= self.n_trees
+        return out
+
+    def predict_proba(self, X):
+        if not self.is_classifier:
+            raise AttributeError('predict_proba is only available for classifiers')
+        return self._accumulate(X)
+
+    def predict(self, X):
+        X = np.asarray(X)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f'Expected input with {self.n_features} features, got shape {X.shape}')
+        out = self._accumulate(X)
+        if self.is_classifier:
+            return self.classes_.take(np.argmax(out, axis=1))
+        return out[:, 0] if out.shape[1] == 1 else out
+
+    def contributions(self, X):
+        """Path contributions of each feature: (bias (n_outputs,), (n_samples, n_features, n_outputs), outputs).
+
+        Every split on a sample's path credits the change from the node's value
+        to its child's value to the node's feature (Saabas). Internal node
+        values are kept in ``value``, so this is one extra gather per level,
+        and bias plus the contributions summed over features equals the
+        forest's output for the sample. ``outputs`` is that output summed over
+        the leaves as ``predict`` does, so ties between classes break the same way.
+        """
+        X = np.asarray(X)
+        n_outputs = self.value.shape[1]
+        bias = self.value[self.roots].mean(axis=0, dtype=np.float64)
+        out = np.empty((X.shape[0], self.n_features, n_outputs))
+        outputs = np.empty((X.shape[0], n_outputs))
+        for start in range(0, X.shape[0], BATCH_ROWS):
+            chunk = X[start:start + BATCH_ROWS]
+            n_keys = len(chunk) * self.n_features
+            # One bincount slot per (sample, feature) pair
+            row_keys = np.arange(len(chunk)) * self.n_features
+            totals = np.zeros((n_outputs, n_keys))
+            parents = None
+            for nodes in self._walk(chunk):
+                if parents is not None:
+                    keys = (self.feature[parents] + row_keys).reshape(-1)
+                    # Leaves point to themselves, so finished paths add zeros
+                    deltas = (self.value[nodes] - self.value[parents]).reshape(-1, n_outputs)
+                    for output in range(n_outputs):
+                        totals[output] += np.bincount(keys, weights=deltas[:, output], minlength=n_keys)
+                parents = nodes
+            out[start:start + len(chunk)] = totals.T.reshape(len(chunk), self.n_features, n_outputs)
+            outputs[start:start + len(chunk)] = self.value[parents].sum(axis=0)
+        out /= self.n_trees
+        outputs /= self.n_trees
+        return bias, out, outputs
+
+    def to_arrays(self, prefix=''):
+        arrays = {prefix + name: getattr(self, name) for name in FLAT_ARRAYS}
+        arrays[prefix + 'depth'] = np.array(self.depth)
+        arrays[prefix + 'n_features'] = np.array(self.n_features)
+        if self.is_classifier:
+            arrays[prefix + 'classes'] = np.asarray(self.classes_, dtype=str)
+        return arrays
+
+    def to_compact_arrays(self):
+        """Reduced-precision arrays for a compact bundle: int8 features, float32
+        thresholds and values (int16 probabilities for classifiers), int32 indices"""
+        if self.n_features > np.iinfo(np.int8).max or self.n_nodes >= 2**31:
+            raise ValueError('Forest is too large for the compact format')
+        if self.is_classifier:
+            value = np.rint(self.value * PROBABILITY_SCALE).astype(np.int16)
+        else:
+            value = self.value.astype(np.float32)
+        arrays = {
+            'feature': self.feature.astype(np.int8),
+            'threshold': float32_floor(self.threshold),
+            'left': self.left.astype(np.int32),
+            'right': self.right.astype(np.int32),
+            'missing_left': self.missing_left.astype(bool),
+            'value': value,
+            'roots': self.roots.astype(np.int32),
+            'depth': np.array(self.depth),
+            'n_features': np.array(self.n_features),
+        }
+        if self.is_classifier:
+            arrays['classes'] = np.asarray(self.classes_, dtype=str)
+        return arrays
+
+    @classmethod
+    def from_compact_arrays(cls, arrays):
+        """FlatForest over compact arrays; only int16 probabilities are widened (to float32)"""
+        value = arrays['value']
+        if value.dtype == np.int16:
+            value = value.astype(np.float32) / np.float32(PROBABILITY_SCALE)
+        return cls.from_arrays(dict(arrays, value=value))
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=''):
+        classes = arrays.get(prefix + 'classes')
+        if classes is not None and classes.dtype.kind == 'U':
+            classes = classes.astype(object)
+        return cls(
+            *(arrays[prefix + name] for name in FLAT_ARRAYS),
+            depth=arrays[prefix + 'depth'],
+            n_features=arrays[prefix + 'n_features'],
+            classes=classes,
+        )
+
+
+def tree_estimators(model):
+    if hasattr(model, 'tree_'):
+        return [model]
+    estimators = getattr(model, 'estimators_', None)
+    if not isinstance(estimators, list) or not all(hasattr(e, 'tree_') for e in estimators):
+        raise TypeError(f'{type(model).__name__} is not a forest or tree of decision trees')
+    return estimators
+
+
+def tree_arrays(estimator, classes=None):
+    """Node arrays of one fitted decision tree; children are tree-local indices, -1 for leaves"""
+    tree = estimator.tree_
+    n_nodes = tree.node_count
+    if classes is not None:
+        # Same normalisation as DecisionTreeClassifier.predict_proba
+        proba = tree.value[:, 0, :len(classes)]
+        normalizer = proba.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        value = proba / normalizer
+    else:
+        value = tree.value[:, :, 0]
+    return {
+        'feature': tree.feature,
+        'threshold': tree.threshold,
+        'left': tree.children_left,
+        'right': tree.children_right,
+        'missing_left': np.asarray(getattr(tree, 'missing_go_to_left', np.zeros(n_nodes, dtype=np.uint8)), dtype=bool),
+        'value': value,
+        'depth': tree.max_depth,
+    }
+
+
+def flat_forest_from_trees(trees, n_features, classes=None):
+    """Concatenate per-tree node arrays (see ``tree_arrays``) into a FlatForest"""
+    features, thresholds, lefts, rights, missing, values, roots = [], [], [], [], [], [], []
+    offset = 0
+    depth = 0
+    for tree in trees:
+        n_nodes = len(tree['left'])
+        node_ids = np.arange(n_nodes)
+        is_leaf = tree['left'] == -1
+
+        roots.append(offset)
+        features.append(np.where(is_leaf, 0, tree['feature']))
+        thresholds.append(np.where(is_leaf, np.inf, tree['threshold']))
+        lefts.append(np.where(is_leaf, node_ids, tree['left']) + offset)
+        rights.append(np.where(is_leaf, node_ids, tree['right']) + offset)
+        missing.append(tree['missing_left'] & ~is_leaf)
+        values.append(tree['value'])
+
+        depth = max(depth, tree['depth'])
+        offset += n_nodes
+
+    index_dtype = np.int32 if offset < 2**31 else np.int64
+    return FlatForest(
+        feature=np.concatenate(features).astype(np.intp),
+        threshold=np.concatenate(thresholds).astype(np.float64),
+        left=np.concatenate(lefts).astype(index_dtype),
+        right=np.concatenate(rights).astype(index_dtype),
+        missing_left=np.concatenate(missing),
+        value=np.ascontiguousarray(np.concatenate(values), dtype=np.float64),
+        roots=np.asarray(roots, dtype=index_dtype),
+        depth=depth,
+        n_features=n_features,
+        classes=classes,
+    )
+
+
+def flatten_model(model):
+    """Flatten a fitted DecisionTree* or RandomForest*/ExtraTrees* estimator"""
+    estimators = tree_estimators(model)
+    classes = getattr(model, 'classes_', None)
+    if classes is not None and getattr(model, 'n_outputs_', 1) != 1:
+        raise TypeError('Multi-output classifiers are not supported')
+    return flat_forest_from_trees([tree_arrays(estimator, classes) for estimator in estimators],
+                                  model.n_features_in_, classes)
+
+
+def parity_samples(label_encoder, n_samples=2000, seed=0):
+    """Random feature rows over the training ranges, for every crop the encoder knows"""
+    rng = np.random.RandomState(seed)
+    return np.column_stack([
+        rng.uniform(0, 100, n_samples),
+        rng.uniform(0, 100, n_samples),
+        rng.uniform(0, 100, n_samples),
+        rng.uniform(4.0, 8.5, n_samples),
+        rng.uniform(20, 80, n_samples),
+        rng.uniform(15, 35, n_samples),
+        rng.randint(0, len(label_encoder.classes_), n_samples),
+    ])
+
+
+def check_parity(model, flat, X):
+    """Return the largest difference between sklearn and flat outputs (0.0 means identical)"""
+    expected = model.predict(X)
+    actual = flat.predict(X)
+    if flat.is_classifier:
+        return float(np.mean(expected != actual))
+    return float(np.max(np.abs(np.asarray(expected, dtype=float) - actual)))
+
+
+MODEL_FIELDS = ('fertilizer_model', 'quantity_model', 'health_model')
+
+
+def compile_model_set(model_set, max_rows, tolerance=0.0):
+    """Return a copy of a ModelSet that runs batches of up to max_rows on FlatForest.
+
+    Raises ValueError if any model's outputs differ from scikit-learn by more
+    than ``tolerance`` on the parity samples.
+    """
+    X = parity_samples(model_set.label_encoder)
+    if model_set.fused_model is not None:
+        forest = model_set.fused_model.forest
+        flat = flatten_model(forest)
+        deviation = check_parity(forest, flat, X)
+        if deviation > tolerance:
+            raise ValueError(f'fused_model: flat engine deviates from scikit-learn by {deviation}')
+        flat_models = (model_set.fused_model.with_forest(flat),)
+        return model_set._replace(engine='flat', flat_models=flat_models, flat_max_rows=max_rows)
+
+    flat_models = []
+    for field in MODEL_FIELDS:
+        model = getattr(model_set, field)
+        flat = flatten_model(model)
+        deviation = check_parity(model, flat, X)
+        if deviation > tolerance:
+            raise ValueError(f'{field}: flat engine deviates from scikit-learn by {deviation}')
+        flat_models.append(flat)
+    return model_set._replace(engine='flat', flat_models=tuple(flat_models), flat_max_rows=max_rows)
+
+
+def save_flat_models(path, models):
+    """Write flattened models ({field: FlatForest}) to a single .npz archive"""
+    arrays = {}
+    for field, flat in models.items():
+        arrays.update(flat.to_arrays(prefix=f'{field}.'))
+    np.savez(path, **arrays)
+
+
+def load_flat_models(path):
+    with np.load(path, allow_pickle=False) as archive:
+        arrays = dict(archive)
+    fields = sorted({name.split('.', 1)[0] for name in arrays})
+    return {field: FlatForest.from_arrays(arrays, prefix=f'{field}.') for field in fields}
+
+
+def main(argv=None):
+    import joblib
+
+    parser = argparse.ArgumentParser(description='Flatten tree ensembles into NumPy node arrays')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='write flattened models to an .npz archive')
+    export.add_argument('bundle')
+    export.add_argument('output')
+    check = commands.add_parser('check', help='compare flat and scikit-learn outputs')
+    check.add_argument('bundle')
+    check.add_argument('--samples', type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    bundle = joblib.load(args.bundle)
+    fields = ('fused_model',) if bundle.get('layout') == 'fused' else MODEL_FIELDS
+    flat_models = {field: flatten_model(bundle[field]) for field in fields}
+
+    if args.command == 'export':
+        save_flat_models(args.output, flat_models)
+        for field, flat in flat_models.items():
+            print(f"{field}: {flat.n_trees} trees, {flat.n_nodes} nodes, depth {flat.depth}, "
+                  f"{flat.nbytes / 2**20:.2f} MB")
+        print(f"Saved to: {args.output}")
+        return 0
+
+    X = parity_samples(bundle['label_encoder'], args.samples)
+    worst = 0.0
+    for field, flat in flat_models.items():
+        deviation = check_parity(bundle[field], flat, X)
+        worst = max(worst, deviation)
+        print(f"{field}: max deviation {deviation}")
+    return 0 if worst == 0.0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
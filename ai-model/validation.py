@@ -0,0 +1,120 @@
+"""
+Precompiled validation of /predict and /predict/batch samples.
+
+``SampleSchema`` turns the field table into a tuple of (name, default, low,
+high) entries once, then checks and converts a sample in a single pass:
+missing readings take their FEATURE_FIELDS default, numbers and numeric
+strings are converted to float, and NaN, infinities and readings outside the
+ranges the backend accepts are rejected before any model work runs.
+
+Every problem is reported as ``{'field', 'code', 'message'}`` with one of the
+codes in ERROR_CODES. Unknown crop types are accepted and scored like the
+model's first crop class, as before; only a crop_type that is not a string
+is rejected.
+"""
+import math
+
+from model_store import DEFAULT_CROP_TYPE, FEATURE_FIELDS
+
+# Inclusive reading ranges, the same limits as the backend's soil data validation
+FIELD_RANGES = {
+    'nitrogen': (0, 100),
+    'phosphorus': (0, 100),
+    'potassium': (0, 100),
+    'ph': (4.0, 8.5),
+    'moisture': (0, 100),
+    'temperature': (0, 50),
+}
+
+ERROR_CODES = ('invalid_payload', 'invalid_type', 'not_finite', 'out_of_range')
+
+
+class ValidationError(ValueError):
+    """Rejected sample; ``errors`` lists every problem found, ``index`` is its batch position"""
+
+    def __init__(self, errors, index=None):
+        super().__init__(errors[0]['message'])
+        self.errors = errors
+        self.index = index
+
+    @property
+    def code(self):
+        return self.errors[0]['code']
+
+    def to_dict(self):
+        body = {'error': str(self), 'code': self.code, 'errors': self.errors}
+        if self.index is not None:
+            body['index'] = self.index
+        return body
+
+
+def field_error(field, code, message):
+    return {'field': field, 'code': code, 'message': message}
+
+
+class SampleSchema:
+    """Single-pass validator and parser for prediction samples"""
+
+    def __init__(self, fields=FEATURE_FIELDS, ranges=FIELD_RANGES, default_crop_type=DEFAULT_CROP_TYPE):
+        self.fields = tuple(
+            (name, float(default)) + tuple(float(limit) for limit in ranges.get(name, (-math.inf, math.inf)))
+            for name, default in fields
+        )
+        self.default_crop_type = default_crop_type
+
+    def parse(self, data):
+        """(values, crop_type) of a valid sample; raises ValidationError otherwise"""
+        if not isinstance(data, dict):
+            raise ValidationError([field_error(None, 'invalid_payload', 'Expected a JSON object')])
+
+        values = []
+        errors = []
+        for name, default, low, high in self.fields:
+            raw = data.get(name, default)
+            if type(raw) is float:
+                value = raw
+            else:
+                value = self._coerce(raw)
+                if value is None:
+                    errors.append(field_error(name, 'invalid_type', f'{name} must be a number'))
+                    continue
+            # Comparisons with NaN are false, so finite in-range values take one check
+            if not low <= value <= high:
+                if math.isfinite(value):
+                    errors.append(field_error(name, 'out_of_range', f'{name} must be between {low:g} and {high:g}'))
+                else:
+                    errors.append(field_error(name, 'not_finite', f'{name} must be a finite number'))
+            values.append(value)
+
+        crop_type = data.get('crop_type', self.default_crop_type)
+        if not isinstance(crop_type, str):
+            errors.append(field_error('crop_type', 'invalid_type', 'crop_type must be a string'))
+
+        if errors:
+            raise ValidationError(errors)
+        return values, crop_type
+
+    def parse_batch(self, samples):
+        """(values, crop_types) of a list of samples; the error of the first invalid one carries its index"""
+        values = []
+        crop_types = []
+        parse = self.parse
+        for index, sample in enumerate(samples):
+            try:
+                row, crop_type = parse(sample)
+            except ValidationError as e:
+                e.index = index
+                raise
+            values.append(row)
+            crop_types.append(crop_type)
+        return values, crop_types
+
+    @staticmethod
+    def _coerce(raw):
+        # Numeric strings are still accepted; booleans, nulls and containers are not
+        if isinstance(raw, bool) or not isinstance(raw, (int, float, str)):
+            return None
+        try:
+            return float(raw)
+        except (ValueError, OverflowError):
+            return None
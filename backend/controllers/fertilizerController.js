@@ -63,7 +63,12 @@ exports.recommendFertilizer = async (req, res) => {
     res.json({ success: true, data: populatedRecommendation, prediction });
   } catch (error) {
     console.error('Fertilizer recommendation error:', error.message);
-    const statusCode = error.response?.status === 503 ? 503 : 500;
+    // The AI service sheds load with 429/503; pass that on as a retryable 503
+    const overloaded = [429, 503].includes(error.response?.status);
+    const statusCode = overloaded ? 503 : 500;
+    if (overloaded) {
+      res.set('Retry-After', error.response.headers?.['retry-after'] || '1');
+    }
     res.status(statusCode).json({
       success: false,
       message: error.response?.data?.error || 'AI model service is currently unavailable',
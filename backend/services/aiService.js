@@ -13,8 +13,14 @@ exports.getFertilizerPrediction = async (payload) => {
       throw new Error('AI model service is currently unavailable. Please ensure the AI model server is running on port 5000.');
     }
     if (error.response) {
-      // Server responded with error status
-      throw new Error(error.response.data?.error || 'AI model service returned an error');
+      // Server responded with error status; keep the response so callers can map the status
+      const status = error.response.status;
+      const message = status === 429 || status === 503
+        ? 'AI model service is busy. Please try again shortly.'
+        : error.response.data?.error || 'AI model service returned an error';
+      const serviceError = new Error(message);
+      serviceError.response = error.response;
+      throw serviceError;
     }
     throw error;
   }